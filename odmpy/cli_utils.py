@@ -58,6 +58,7 @@ class OdmpyNoninteractiveOptions(str, Enum):
     DownloadSelectedId = "selected_loans_ids"
     ExportLoans = "export_loans_path"
     Check = "check_signed_in"
+    Watch = "watch"
 
     def __str__(self):
         return str(self.value)
@@ -27,3 +27,19 @@ class LibbyNotConfiguredError(OdmpyRuntimeError):
     """
 
     pass
+
+
+class DownloadIncompleteError(OdmpyRuntimeError):
+    """
+    Raised when a download ends before the expected number of bytes is received.
+    """
+
+    pass
+
+
+class DownloadStalledError(DownloadIncompleteError):
+    """
+    Raised when a download is aborted because its transfer rate is too low.
+    """
+
+    pass
@@ -0,0 +1,235 @@
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of odmpy.
+#
+# odmpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# odmpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Dict, Tuple, Mapping
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+#
+# Persistent on-disk cache for GET requests, revalidated with ETag/Last-Modified
+#
+
+# request headers that can change the response for the same url
+VARY_HEADERS = ("Accept", "Accept-Language", "Authorization")
+# response headers that are kept with the cached body
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+DEFAULT_MAX_SIZE = 500 * 1024 * 1024  # bytes
+
+_caches: Dict[Path, "HttpCache"] = {}
+_caches_lock = threading.Lock()
+
+
+class HttpCache(object):
+    """
+    A simple content-addressed cache for GET responses.
+
+    Only responses with an ETag or Last-Modified validator are stored. A cached
+    response is always revalidated with a conditional request so that a cache hit
+    costs a 304 instead of the full body.
+    Entries are evicted least recently used first once the cache exceeds its max size.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_size: int = DEFAULT_MAX_SIZE,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        """
+        Constructor.
+
+        :param cache_dir: Folder to store the cached responses in
+        :param max_size: Max size of the cache in bytes
+        :param logger:
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        if not self.cache_dir.exists():
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._size = sum(f.stat().st_size for f in self.cache_dir.glob("*/*.body"))
+
+    @staticmethod
+    def cache_key(url: str, headers: Mapping[str, str]) -> str:
+        """
+        Generate a cache key from the url and the headers that may vary the response.
+
+        :param url:
+        :param headers:
+        :return:
+        """
+        key = url + "\n" + "\n".join(f"{h}:{headers.get(h, '')}" for h in VARY_HEADERS)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        folder = self.cache_dir.joinpath(key[:2])
+        return folder.joinpath(f"{key}.json"), folder.joinpath(f"{key}.body")
+
+    def get(self, key: str) -> Optional[Tuple[Dict, Path]]:
+        """
+        Get the cached metadata and body file for a key.
+
+        :param key:
+        :return:
+        """
+        meta_path, body_path = self._paths(key)
+        if not (meta_path.exists() and body_path.exists()):
+            return None
+        try:
+            with meta_path.open("r", encoding="utf-8") as f:
+                return json.load(f), body_path
+        except (OSError, ValueError) as err:
+            self.logger.debug("Unable to read cache entry %s: %s", key, err)
+            return None
+
+    def put(self, key: str, res: requests.Response) -> None:
+        """
+        Store a response.
+
+        :param key:
+        :param res:
+        :return:
+        """
+        meta_path, body_path = self._paths(key)
+        meta = {
+            "url": res.url,
+            "encoding": res.encoding,
+            "headers": {h: res.headers[h] for h in STORED_HEADERS if h in res.headers},
+        }
+        with self._lock:
+            if body_path.exists():
+                self._size -= body_path.stat().st_size
+            body_path.parent.mkdir(parents=True, exist_ok=True)
+            body_path.write_bytes(res.content)
+            with meta_path.open("w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            self._size += len(res.content)
+            if self._size > self.max_size:
+                self._evict()
+
+    def touch(self, key: str) -> None:
+        """
+        Mark an entry as recently used.
+
+        :param key:
+        :return:
+        """
+        _, body_path = self._paths(key)
+        try:
+            os.utime(body_path)
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache is within
+        90% of the max size. Caller must hold the lock.
+
+        :return:
+        """
+        body_files = []
+        for f in self.cache_dir.glob("*/*.body"):
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            body_files.append((stat.st_mtime, stat.st_size, f))
+        body_files.sort()
+        target_size = int(self.max_size * 0.9)
+        for _, size, body_path in body_files:
+            if self._size <= target_size:
+                break
+            for p in (body_path.with_suffix(".json"), body_path):
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+            self._size -= size
+            self.logger.debug("Evicted cache entry %s", body_path.stem)
+
+    def send(
+        self, session: requests.Session, req: requests.PreparedRequest, **kwargs
+    ) -> requests.Response:
+        """
+        Send a request via the cache. Only GET requests are cached.
+
+        :param session:
+        :param req:
+        :param kwargs: Arguments for `session.send()`
+        :return:
+        """
+        if req.method != "GET" or not req.url or "Range" in req.headers:
+            return session.send(req, **kwargs)
+
+        key = self.cache_key(req.url, req.headers)
+        cached = self.get(key)
+        if cached:
+            meta, _ = cached
+            if meta["headers"].get("ETag"):
+                req.headers["If-None-Match"] = meta["headers"]["ETag"]
+            if meta["headers"].get("Last-Modified"):
+                req.headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+
+        res = session.send(req, **kwargs)
+        if cached and res.status_code == 304:
+            meta, body_path = cached
+            self.logger.debug("Cache hit for %s", req.url)
+            self.touch(key)
+            cached_res = requests.Response()
+            cached_res.status_code = 200
+            cached_res.reason = "OK"
+            cached_res.url = meta.get("url") or req.url
+            cached_res.request = req
+            cached_res.encoding = meta.get("encoding")
+            cached_res.headers = CaseInsensitiveDict(res.headers)
+            cached_res.headers.update(meta["headers"])
+            # pylint: disable-next=protected-access
+            cached_res._content = body_path.read_bytes()
+            return cached_res
+
+        if (
+            res.status_code == 200
+            and (res.headers.get("ETag") or res.headers.get("Last-Modified"))
+            and "no-store" not in res.headers.get("Cache-Control", "")
+        ):
+            self.put(key, res)
+        return res
+
+
+def get_cache(cache_dir: Optional[str]) -> Optional[HttpCache]:
+    """
+    Get the shared cache instance for a folder.
+
+    :param cache_dir:
+    :return: None if cache_dir is not set
+    """
+    if not cache_dir:
+        return None
+    cache_path = Path(cache_dir).expanduser().absolute()
+    with _caches_lock:
+        if cache_path not in _caches:
+            _caches[cache_path] = HttpCache(cache_path)
+        return _caches[cache_path]
@@ -15,18 +15,24 @@
 # You should have received a copy of the GNU General Public License
 # along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
 #
+import base64
+import binascii
+import hashlib
 import json
 import logging
+import os
 import re
 import sys
+import time
 from collections import OrderedDict
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from enum import Enum
 from pathlib import Path
-from typing import Optional, NamedTuple, Dict, List, Tuple
+from typing import Optional, NamedTuple, Dict, List, Tuple, Callable, Any
 from typing import OrderedDict as OrderedDictType
 from urllib import request
-from urllib.parse import urljoin
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse
 
 
 if sys.version_info >= (3, 8):
@@ -34,9 +40,10 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import TypedDict
 import requests
-from requests.adapters import HTTPAdapter, Retry
 
+from .http_cache import HttpCache
 from .libby_errors import ClientConnectionError, ClientTimeoutError, ErrorHandler
+from .sessions import new_session
 
 #
 # Client for the Libby web API, and helper functions to make sense
@@ -105,6 +112,13 @@ USER_AGENT = (
     "Version/14.0.2 Safari/605.1.15"
 )
 DEWEY_CLIENT_VERSION = "18.5.2"
+DEFAULT_SYNC_TTL = 60  # seconds
+DOWNLOAD_CHUNK_SIZE = 1024 * 64  # bytes
+# renew the identity chip when it expires within this period
+CHIP_RENEW_MARGIN = timedelta(days=1)
+# renew interval if the identity expiry cannot be determined
+CHIP_RENEW_INTERVAL = timedelta(days=1)
+CHIP_RENEWED_KEY = "__odmpy_chip_renewed"
 
 EBOOK_DOWNLOADABLE_FORMATS = (
     LibbyFormats.EBookEPubAdobe,
@@ -286,12 +300,20 @@ class LibbyClient(object):
                 json.dump(self.identity, f)
 
         self.max_retries = max_retries
-        libby_session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(total=max_retries, backoff_factor=0.1))
-        for prefix in ("http://", "https://"):
-            libby_session.mount(prefix, adapter)
-        self.libby_session = libby_session
+        # not shared with other clients because it holds the auth cookie,
+        # but the connection pools are
+        self.libby_session = new_session(max_retries)
         self.user_agent = kwargs.pop("user_agent", USER_AGENT)
+        self.cache: Optional[HttpCache] = kwargs.pop("cache", None)
+        # max age (seconds) of the sync snapshot before a fresh chip/sync is made
+        self.sync_ttl: float = kwargs.pop("sync_ttl", DEFAULT_SYNC_TTL)
+        self._sync_snapshot: Optional[Dict] = None
+        self._sync_snapshot_time: float = 0
+        # parsed openbook/toc of opened loans, so that resuming a download
+        # does not need to open the loan again
+        self.loan_cache_folder = (
+            self.settings_folder.joinpath("loans") if self.settings_folder else None
+        )
         self.api_base = "https://sentry.libbyapp.com/"
 
     @staticmethod
@@ -349,11 +371,19 @@ class LibbyClient(object):
             session = self.libby_session
 
         try:
-            res = session.send(
-                session.prepare_request(req),
-                timeout=self.timeout,
-                allow_redirects=allow_redirects,
-            )
+            if self.cache:
+                res = self.cache.send(
+                    session,
+                    session.prepare_request(req),
+                    timeout=self.timeout,
+                    allow_redirects=allow_redirects,
+                )
+            else:
+                res = session.send(
+                    session.prepare_request(req),
+                    timeout=self.timeout,
+                    allow_redirects=allow_redirects,
+                )
             self.logger.debug("body: %s", res.text)
 
             res.raise_for_status()
@@ -391,6 +421,7 @@ class LibbyClient(object):
         if self.identity_settings_file and self.identity_settings_file.exists():
             self.identity_settings_file.unlink()
         self.identity = {}
+        self.invalidate_sync()
 
     def has_chip(self) -> bool:
         """
@@ -411,6 +442,17 @@ class LibbyClient(object):
             or self.identity.get("__odmpy_sync_code")  # for backwards compat
         )
 
+    def _save_chip(self, chip: Dict) -> None:
+        """
+        Persist a chip together with the time it was obtained.
+
+        :param chip:
+        :return:
+        """
+        self.save_settings(
+            dict(chip, **{CHIP_RENEWED_KEY: datetime.now(tz=timezone.utc).timestamp()})
+        )
+
     def get_chip(self, auto_save: bool = True, authenticated: bool = False) -> Dict:
         """
         Get an identity chip (contains auth token).
@@ -425,9 +467,10 @@ class LibbyClient(object):
             method="POST",
             authenticated=authenticated,
         )
+        self.invalidate_sync()
         if auto_save:
             # persist to settings
-            self.save_settings(res)
+            self._save_chip(res)
         return res
 
     def renew_chip(self, auto_save: bool = True, authenticated: bool = True) -> Dict:
@@ -447,10 +490,61 @@ class LibbyClient(object):
         )
         if auto_save:
             # persist to settings
-            self.save_settings(res)
+            self._save_chip(res)
         return res
 
+    def identity_expiry(self) -> Optional[datetime]:
+        """
+        Get the expiry of the identity token from its (JWT) claims.
 
+        :return: None if the expiry cannot be determined
+        """
+        token = self.get_token()
+        if not token or token.count(".") != 2:
+            return None
+        payload = token.split(".")[1]
+        try:
+            claims = json.loads(
+                base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+            )
+            return datetime.fromtimestamp(int(claims["exp"]), tz=timezone.utc)
+        except (binascii.Error, ValueError, TypeError, KeyError) as err:
+            self.logger.debug("Unable to parse identity expiry: %s", err)
+            return None
+
+    def chip_needs_renewal(self, margin: timedelta = CHIP_RENEW_MARGIN) -> bool:
+        """
+        Check if the identity chip is near expiry and should be renewed.
+
+        :param margin: Renew if the identity expires within this period
+        :return:
+        """
+        if not self.identity.get("chip"):
+            # nothing to renew
+            return False
+        now = datetime.now(tz=timezone.utc)
+        expiry = self.identity_expiry()
+        if expiry:
+            return expiry - now <= margin
+        renewed = self.identity.get(CHIP_RENEWED_KEY)
+        if not renewed:
+            return True
+        return (
+            now - datetime.fromtimestamp(renewed, tz=timezone.utc)
+            >= CHIP_RENEW_INTERVAL
+        )
+
+    def renew_chip_if_needed(self, margin: timedelta = CHIP_RENEW_MARGIN) -> bool:
+        """
+        Renew the identity chip only if it is near expiry.
+
+        :param margin: Renew if the identity expires within this period
+        :return: True if the chip was renewed
+        """
+        if not self.chip_needs_renewal(margin):
+            return False
+        self.renew_chip()
+        return True
 
     def get_token(self) -> Optional[str]:
         return self.identity_token or self.identity.get("identity")
@@ -467,20 +561,39 @@ class LibbyClient(object):
             raise ValueError(f"Invalid code: {code}")
 
         res: Dict = self.make_request("chip/clone/code", data={"code": code})
+        self.invalidate_sync()
         if auto_save:
             # persist to settings
             self.save_settings({"__libby_sync_code": code})
         return res
 
-    def sync(self) -> Dict:
+    def sync(self, force: bool = False) -> Dict:
         """
         Get the user account state, which includes loans, holds, etc.
+        The result is reused for up to `sync_ttl` seconds.
 
+        :param force: Ignore the cached snapshot
         :return:
         """
+        if (
+            not force
+            and self._sync_snapshot is not None
+            and time.monotonic() - self._sync_snapshot_time < self.sync_ttl
+        ):
+            return self._sync_snapshot
         res: Dict = self.make_request("chip/sync")
+        self._sync_snapshot = res
+        self._sync_snapshot_time = time.monotonic()
         return res
 
+    def invalidate_sync(self) -> None:
+        """
+        Discard the cached sync snapshot, e.g. after the account state has changed.
+
+        :return:
+        """
+        self._sync_snapshot = None
+
     def auth_form(self, website_id) -> Dict:
         """
         Get the parameters required to link a card.
@@ -508,6 +621,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"auth/link/{website_id}", json_data=data, method="POST"
         )
+        self.invalidate_sync()
         return res
 
     def update_card_name(self, card_id: str, card_name: str) -> Dict:
@@ -521,6 +635,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"card/{card_id}", params={"card_name": card_name}, method="PUT"
         )
+        self.invalidate_sync()
         return res
 
     def is_logged_in(self) -> bool:
@@ -805,6 +920,168 @@ class LibbyClient(object):
         )
         return res.content
 
+    @staticmethod
+    def _urlretrieve_to(
+        endpoint: str,
+        part_file_path: Path,
+        headers: Optional[Dict] = None,
+        timeout: int = 15,
+        progress_callback: Optional[Callable[[int], Any]] = None,
+    ) -> None:
+        """
+        Streaming variant of `_urlretrieve()` that writes to a file in chunks,
+        resuming from an existing partial file if the server supports it.
+        The resumed range is validated with `If-Range` and `Content-Range`, and
+        the partial file is restarted if it no longer matches the server's file.
+
+        :param endpoint: fulfillment url
+        :param part_file_path: Partial download file path
+        :param headers:
+        :param timeout:
+        :param progress_callback: Called with the number of bytes written
+        :return:
+        """
+        request_headers = dict(headers or {})
+        validator_file_path = part_file_path.with_name(
+            f"{part_file_path.name}.validator"
+        )
+        while True:
+            already_downloaded_len = (
+                part_file_path.stat().st_size if part_file_path.exists() else 0
+            )
+            if already_downloaded_len:
+                request_headers["Range"] = f"bytes={already_downloaded_len}-"
+                if validator_file_path.exists():
+                    # server sends the full file instead if it has changed
+                    request_headers["If-Range"] = validator_file_path.read_text(
+                        encoding="utf-8"
+                    )
+            else:
+                request_headers.pop("Range", None)
+                request_headers.pop("If-Range", None)
+
+            opener = request.build_opener()
+            req = request.Request(endpoint, headers=request_headers)
+            try:
+                res = opener.open(req, timeout=timeout)
+            except HTTPError as err:
+                if err.code != 416 or not already_downloaded_len:
+                    raise
+                err.close()
+                if (
+                    err.headers.get("Content-Range", "")
+                    == f"bytes */{already_downloaded_len}"
+                ):
+                    # partial file is already complete
+                    break
+                res = None
+            if (
+                res is not None
+                and already_downloaded_len
+                and getattr(res, "status", None) == 206
+                and not res.headers.get("Content-Range", "").startswith(
+                    f"bytes {already_downloaded_len}-"
+                )
+            ):
+                res.close()
+                res = None
+            if res is None:
+                # partial file does not match the server's, so start over
+                if progress_callback:
+                    progress_callback(-already_downloaded_len)
+                part_file_path.unlink()
+                continue
+
+            try:
+                if already_downloaded_len and getattr(res, "status", None) != 206:
+                    # server ignored the Range request or the file has changed,
+                    # so start over
+                    if progress_callback:
+                        progress_callback(-already_downloaded_len)
+                    already_downloaded_len = 0
+                if not already_downloaded_len:
+                    etag = res.headers.get("ETag") or ""
+                    validator = (
+                        etag
+                        if etag and not etag.startswith("W/")
+                        else res.headers.get("Last-Modified") or ""
+                    )
+                    if validator:
+                        validator_file_path.write_text(validator, encoding="utf-8")
+                    elif validator_file_path.exists():
+                        validator_file_path.unlink()
+                with part_file_path.open(
+                    "ab" if already_downloaded_len else "wb"
+                ) as outfile:
+                    while True:
+                        chunk = res.read(DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        outfile.write(chunk)
+                        if progress_callback:
+                            progress_callback(len(chunk))
+            finally:
+                res.close()
+            break
+
+        if validator_file_path.exists():
+            validator_file_path.unlink()
+
+    def download_loan_file(
+        self,
+        loan_id: str,
+        card_id: str,
+        format_id: str,
+        file_path: Path,
+        progress_callback: Optional[Callable[[int], Any]] = None,
+    ) -> Path:
+        """
+        Streaming variant of `fulfill_loan_file()` that saves the loan file to `file_path`.
+        The file is downloaded in chunks to a `.part` file, which is renamed once complete.
+        Open epub/pdf loans resume from an existing `.part` file.
+
+        :param loan_id:
+        :param card_id:
+        :param format_id:
+        :param file_path:
+        :param progress_callback: Called with the number of bytes written
+        :return:
+        """
+        if format_id not in DOWNLOADABLE_FORMATS:
+            raise ValueError(f"Unsupported format_id: {format_id}")
+
+        headers = self.default_headers()
+        headers["Accept"] = "*/*"
+        part_file_path = file_path.with_name(f"{file_path.name}.part")
+
+        if format_id in (LibbyFormats.EBookEPubOpen, LibbyFormats.EBookPDFOpen):
+            res_redirect: requests.Response = self.make_request(
+                f"card/{card_id}/loan/{loan_id}/fulfill/{format_id}",
+                headers=headers,
+                return_res=True,
+                allow_redirects=False,
+            )
+            self._urlretrieve_to(
+                res_redirect.headers["Location"],
+                part_file_path,
+                headers=headers,
+                timeout=self.timeout,
+                progress_callback=progress_callback,
+            )
+        else:
+            # odm/acsm loan files are small
+            res: requests.Response = self.make_request(
+                f"card/{card_id}/loan/{loan_id}/fulfill/{format_id}",
+                headers=headers,
+                return_res=True,
+            )
+            with part_file_path.open("wb") as outfile:
+                outfile.write(res.content)
+            if progress_callback:
+                progress_callback(len(res.content))
+        part_file_path.replace(file_path)
+        return file_path
+
     def open_loan(self, loan_type: str, card_id: str, title_id: str) -> Dict:
         """
         Gets the meta urls needed to fulfill a loan.
@@ -857,19 +1134,145 @@ class LibbyClient(object):
         openbook["download_base"] = download_base
         return download_base, openbook
 
-    def process_audiobook(
+    def _loan_cache_file(self, loan: Dict) -> Optional[Path]:
+        """
+        Path of the cached openbook/toc for a loan.
+        A new checkout of the same title gets a new cache entry.
+
+        :param loan:
+        :return:
+        """
+        if not self.loan_cache_folder:
+            return None
+        key = "\n".join([loan["cardId"], loan["id"], loan.get("checkoutDate", "")])
+        return self.loan_cache_folder.joinpath(
+            f'{hashlib.sha256(key.encode("utf-8")).hexdigest()}.json'
+        )
+
+    def _save_loan_cache(
+        self, loan: Dict, openbook: Dict, toc: OrderedDictType[str, PartMeta]
+    ) -> None:
+        """
+        Cache the openbook and toc of an opened loan, together with the
+        content cookies that were set when the loan was opened.
+        Only the unexpired cookies for the hosts of the part urls are cached,
+        not e.g. the Libby API cookies, and like the identity settings,
+        they are saved in plain text. The cache file is only readable by the user.
+
+        :param loan:
+        :param openbook:
+        :param toc:
+        :return:
+        """
+        cache_file = self._loan_cache_file(loan)
+        if not cache_file:
+            return
+        content_hosts = {urlparse(part["url"]).hostname or "" for part in toc.values()}
+        cookies = []
+        for c in self.libby_session.cookies:
+            domain = c.domain.lstrip(".")
+            if not domain or (c.expires and c.expires < time.time()):
+                continue
+            if not any(
+                host == domain or host.endswith(f".{domain}") for host in content_hosts
+            ):
+                continue
+            cookies.append(
+                {
+                    "name": c.name,
+                    "value": c.value,
+                    "domain": c.domain,
+                    "path": c.path,
+                    "expires": c.expires,
+                    "secure": c.secure,
+                }
+            )
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(
+            os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+            "w",
+            encoding="utf-8",
+        ) as f:
+            json.dump({"openbook": openbook, "toc": toc, "cookies": cookies}, f)
+        # the mode is only applied to new files, e.g. not one saved by an earlier version
+        cache_file.chmod(0o600)
+
+    def _load_loan_cache(
         self, loan: Dict
+    ) -> Optional[Tuple[Dict, OrderedDictType[str, PartMeta]]]:
+        """
+        Get the cached openbook and toc of a loan, and restore its content cookies.
+
+        :param loan:
+        :return:
+        """
+        cache_file = self._loan_cache_file(loan)
+        if not (cache_file and cache_file.exists()):
+            return None
+        try:
+            with cache_file.open("r", encoding="utf-8") as f:
+                cached = json.load(f)
+            toc: OrderedDictType[str, PartMeta] = OrderedDict()
+            for url, part in cached["toc"].items():
+                part["chapters"] = [ChapterMarker(*c) for c in part["chapters"]]
+                toc[url] = part
+            for cookie in cached["cookies"]:
+                self.libby_session.cookies.set(**cookie)
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            self.logger.debug("Unable to read cached loan %s: %s", cache_file, err)
+            return None
+        return cached["openbook"], toc
+
+    def clear_loan_cache(self, loan: Dict) -> None:
+        """
+        Remove the cached openbook and toc of a loan.
+
+        :param loan:
+        :return:
+        """
+        cache_file = self._loan_cache_file(loan)
+        if cache_file and cache_file.exists():
+            cache_file.unlink()
+
+    def process_audiobook(
+        self, loan: Dict, use_cache: bool = False
     ) -> Tuple[Dict, OrderedDictType[str, PartMeta]]:
         """
         Returns the data needed to download an audiobook.
 
         :param loan:
+        :param use_cache: Reuse the openbook and toc from an earlier run if available,
+                          instead of opening the loan again. The content cookies
+                          may have expired, so downloads should call
+                          `refresh_loan()` if they are rejected.
         :return:
         """
+        if use_cache:
+            cached = self._load_loan_cache(loan)
+            if cached:
+                self.logger.debug("Using cached openbook for loan %s", loan["id"])
+                return cached
         download_base, openbook = self.prepare_loan(loan)
         toc = parse_toc(download_base, openbook["nav"]["toc"], openbook["spine"])
+        if use_cache:
+            self._save_loan_cache(loan, openbook, toc)
         return openbook, toc
 
+    def refresh_loan(self, loan: Dict) -> OrderedDictType[str, PartMeta]:
+        """
+        Open a loan again to renew the content cookies, e.g. after a content
+        request is rejected with a 401/403. The cached openbook and toc
+        are updated.
+
+        :param loan:
+        :return: The refreshed toc, since the part urls may have changed
+        """
+        download_base, openbook = self.prepare_loan(loan)
+        toc = parse_toc(download_base, openbook["nav"]["toc"], openbook["spine"])
+        if self.loan_cache_folder:
+            self._save_loan_cache(loan, openbook, toc)
+        return toc
+
     def process_ebook(self, loan: Dict) -> Tuple[str, Dict]:
         """
         Returns the data needed to download an ebook directly.
@@ -891,6 +1294,7 @@ class LibbyClient(object):
         self.make_request(
             f"card/{card_id}/loan/{title_id}", method="DELETE", return_res=True
         )
+        self.invalidate_sync()
 
     def return_loan(self, loan: Dict) -> None:
         """
@@ -900,6 +1304,7 @@ class LibbyClient(object):
         :return:
         """
         self.return_title(loan["id"], loan["cardId"])
+        self.clear_loan_cache(loan)
 
     def borrow_title(
         self, title_id: str, title_format: str, card_id: str, days: int = 21
@@ -923,6 +1328,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"card/{card_id}/loan/{title_id}", json_data=data, method="POST"
         )
+        self.invalidate_sync()
         return res
 
     def borrow_hold(self, hold: Dict) -> Dict:
@@ -956,6 +1362,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"card/{card_id}/loan/{title_id}", json_data=data, method="PUT"
         )
+        self.invalidate_sync()
         return res
 
     def renew_loan(self, loan: Dict) -> Dict:
@@ -980,4 +1387,5 @@ class LibbyClient(object):
             json_data={"days_to_suspend": 0, "email_address": ""},
             method="POST",
         )
+        self.invalidate_sync()
         return res
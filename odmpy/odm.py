@@ -17,16 +17,22 @@
 #
 
 import argparse
+import atexit
+import functools
 import io
 import json
 import logging
 import os
+import random
 import sys
+import threading
 import time
 from http.client import HTTPConnection
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 
+import requests
+from requests.adapters import DEFAULT_POOLSIZE
 from termcolor import colored
 
 from .cli_utils import (
@@ -37,22 +43,12 @@ from .cli_utils import (
     DEFAULT_FORMAT_FIELDS,
 )
 from .errors import LibbyNotConfiguredError, OdmpyRuntimeError
+from .http_cache import get_cache
 from .libby import LibbyClient, LibbyFormats
 from .libby_errors import ClientBadRequestError, ClientError
 from .overdrive import OverDriveClient
-from .processing import (
-    process_odm,
-    process_audiobook_loan,
-    process_odm_return,
-    process_ebook_loan,
-)
-from .processing.shared import (
-    generate_names,
-    generate_cover,
-    get_best_cover_url,
-    init_session,
-    extract_authors_from_openbook,
-)
+from . import processing
+from .sessions import configure_sessions, get_session
 from .utils import slugify, plural_or_singular_noun as ps
 
 #
@@ -73,23 +69,109 @@ __version__ = "0.8.1"  # also update ../setup.py
 TAGS_ENDPOINT = "https://api.github.com/repos/ping/odmpy/tags"
 REPOSITORY_URL = "https://github.com/ping/odmpy"
 OLD_SETTINGS_FOLDER_DEFAULT = Path("./odmpy_settings")
+VERSION_CHECK_CACHE_FILENAME = "version_check.json"
+VERSION_CHECK_TTL = 24 * 60 * 60  # seconds
+VERSION_CHECK_EXIT_WAIT = 1  # seconds
+WATCH_SNAPSHOT_FILENAME = "watch_loans.json"
+WATCH_JITTER = 0.1  # fraction of the polling interval
+
+
+def _read_version_cache(cache_file: Path, ignore_expiry: bool = False) -> Optional[str]:
+    """
+    Get the latest version from the version check cache.
+
+    :param cache_file:
+    :param ignore_expiry:
+    :return: None if the cache is missing or expired
+    """
+    # noinspection PyBroadException
+    try:
+        with cache_file.open("r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if ignore_expiry or 0 <= time.time() - cached["checked_at"] < VERSION_CHECK_TTL:
+            return str(cached["version"])
+    except:  # noqa: E722, pylint: disable=bare-except
+        pass
+    return None
 
 
-def check_version(timeout: int, max_retries: int) -> None:
-    sess = init_session(max_retries)
+def _write_version_cache(cache_file: Path, latest_version: str) -> None:
+    # noinspection PyBroadException
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with cache_file.open("w", encoding="utf-8") as f:
+            json.dump({"version": latest_version, "checked_at": time.time()}, f)
+    except:  # noqa: E722, pylint: disable=bare-except
+        pass
+
+
+def _warn_new_version(latest_version: str) -> None:
+    if latest_version and latest_version != __version__:
+        logger.warning(
+            f"⚠️  A new version {latest_version} is available at {REPOSITORY_URL}."
+        )
+
+
+def check_version(
+    timeout: int, max_retries: int, cache_file: Optional[Path] = None
+) -> None:
+    """
+    Check if a newer version is available.
+    The attempt is cached in `cache_file` for `VERSION_CHECK_TTL` seconds,
+    even if it fails.
+
+    :param timeout:
+    :param max_retries:
+    :param cache_file:
+    :return:
+    """
+    if cache_file:
+        cached_version = _read_version_cache(cache_file)
+        if cached_version is not None:
+            _warn_new_version(cached_version)
+            return
+        # record the attempt first, in case odmpy exits before the request completes
+        _write_version_cache(
+            cache_file, _read_version_cache(cache_file, ignore_expiry=True) or ""
+        )
+
+    sess = get_session("version_check", max_retries=max_retries)
     # noinspection PyBroadException
     try:
         res = sess.get(TAGS_ENDPOINT, timeout=timeout)
         res.raise_for_status()
-        curr_version = res.json()[0].get("name", "")
-        if curr_version and curr_version != __version__:
-            logger.warning(
-                f"⚠️  A new version {curr_version} is available at {REPOSITORY_URL}."
-            )
+        latest_version = res.json()[0].get("name", "")
+        if cache_file:
+            _write_version_cache(cache_file, latest_version)
+        _warn_new_version(latest_version)
     except:  # noqa: E722, pylint: disable=bare-except
         pass
 
 
+def start_version_check(
+    timeout: int, max_retries: int, cache_file: Optional[Path] = None
+) -> threading.Thread:
+    """
+    Run `check_version()` in a background thread so that it never delays the command
+    by more than `VERSION_CHECK_EXIT_WAIT` seconds at exit.
+
+    :param timeout:
+    :param max_retries:
+    :param cache_file:
+    :return:
+    """
+    thread = threading.Thread(
+        target=check_version,
+        args=(timeout, max_retries, cache_file),
+        name="odmpy-version-check",
+        daemon=True,
+    )
+    thread.start()
+    # give a quick check the chance to finish on short commands
+    atexit.register(thread.join, VERSION_CHECK_EXIT_WAIT)
+    return thread
+
+
 def add_common_libby_arguments(parser_libby: argparse.ArgumentParser) -> None:
     parser_libby.add_argument(
         "--settings",
@@ -177,6 +259,19 @@ def add_common_download_arguments(parser_dl: argparse.ArgumentParser) -> None:
         default="aac",
         help="Audio codec of merged m4b file. (requires ffmpeg; using libfdk_aac requires ffmpeg compiled with libfdk_aac support). For audiobooks. Has no effect if mergeformat is not set to m4b.",
     )
+    parser_dl.add_argument(
+        "--mergejobs",
+        dest="merge_jobs",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help=(
+            "Number of ffmpeg processes used to encode a merged m4b file. If more than 1,\n"
+            "parts are encoded concurrently and then joined without re-encoding\n"
+            "(requires ffprobe). "
+            "For audiobooks. Has no effect if mergeformat is not set to m4b."
+        ),
+    )
     parser_dl.add_argument(
         "-k",
         "--keepcover",
@@ -295,6 +390,147 @@ def add_common_download_arguments(parser_dl: argparse.ArgumentParser) -> None:
         action="store_true",
         help="Hide the download progress bar (e.g. during testing).",
     )
+    parser_dl.add_argument(
+        "--parallel",
+        dest="parallel_downloads",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help="Number of audiobook parts or ebook contents to download concurrently. Default 1.",
+    )
+    parser_dl.add_argument(
+        "--segments",
+        dest="download_segments",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help=(
+            "Number of concurrent Range requests to download each audiobook part with. "
+            "Small parts are downloaded in a single request. Default 1."
+        ),
+    )
+    parser_dl.add_argument(
+        "--resumeretries",
+        dest="resume_retries",
+        type=int,
+        default=5,
+        metavar="N",
+        help=(
+            "Number of times to resume an audiobook part download "
+            "after it is interrupted by a network error. Default 5."
+        ),
+    )
+    parser_dl.add_argument(
+        "--minspeed",
+        dest="min_speed",
+        type=int,
+        default=0,
+        metavar="KB_PER_SEC",
+        help=(
+            "Reconnect an audiobook part download if its speed stays below this (KB/s) "
+            "for the --minspeedwindow period, e.g. 8. Default 0 (disabled)."
+        ),
+    )
+    parser_dl.add_argument(
+        "--minspeedwindow",
+        dest="min_speed_window",
+        type=positive_int,
+        default=60,
+        metavar="SECONDS",
+        help="Period over which the --minspeed download speed is measured. Default 60.",
+    )
+    parser_dl.add_argument(
+        "--cachedir",
+        dest="cache_dir",
+        type=str,
+        default="",
+        metavar="CACHE_FOLDER",
+        help=(
+            "Folder to cache downloaded metadata and ebook contents in. "
+            "Cached responses are revalidated with the server before reuse."
+        ),
+    )
+    parser_dl.add_argument(
+        "--statedb",
+        dest="state_db",
+        type=str,
+        default="",
+        metavar="STATE_FILE",
+        help=(
+            "SQLite file to record saved loans and parts in. Recorded downloads "
+            "are skipped even if the book folder or file name format changes."
+        ),
+    )
+
+
+def get_bundled_content_ids(selected_loan: Dict) -> List[str]:
+    """
+    Get the title ids of the contents bundled with a loan, e.g. a PDF with an audiobook
+
+    :param selected_loan:
+    :return:
+    """
+    format_id = LibbyClient.get_loan_format(selected_loan)
+    format_info: Dict = next(
+        iter([f for f in selected_loan.get("formats", []) if f["id"] == format_id]),
+        {},
+    )
+    if format_info.get("isBundleParent") and format_info.get("bundledContent", []):
+        return list(set([bc["titleId"] for bc in format_info["bundledContent"]]))
+    return []
+
+
+def prefetch_loans_media(
+    libby_client: LibbyClient,
+    overdrive_client: OverDriveClient,
+    selected_loans: List[Dict],
+    cards: List[Dict],
+    args: argparse.Namespace,
+) -> None:
+    """
+    Retrieve the media info needed to process the selected loans and their
+    bundled contents in bulk, instead of one title at a time.
+
+    :param libby_client:
+    :param overdrive_client:
+    :param selected_loans:
+    :param cards:
+    :param args:
+    :return:
+    """
+    title_ids = []
+    bundled_content_ids: Dict[str, List[str]] = {}
+    for selected_loan in selected_loans:
+        if (
+            args.generate_opf
+            or libby_client.is_downloadable_magazine_loan(selected_loan)
+            or (
+                args.libby_direct
+                and libby_client.is_downloadable_ebook_loan(selected_loan)
+            )
+        ):
+            title_ids.append(selected_loan["id"])
+        if not libby_client.is_downloadable_audiobook_loan(selected_loan):
+            continue
+        card: Dict = next(
+            iter([c for c in cards if c["cardId"] == selected_loan["cardId"]]), {}
+        )
+        try:
+            bundled_content_ids.setdefault(card.get("advantageKey", ""), []).extend(
+                get_bundled_content_ids(selected_loan)
+            )
+        except ValueError:
+            # loan format cannot be determined, will be reported later
+            continue
+    try:
+        if title_ids:
+            overdrive_client.prefetch_media(title_ids)
+        for library_key, library_title_ids in bundled_content_ids.items():
+            if library_key and library_title_ids:
+                overdrive_client.prefetch_library_media(library_key, library_title_ids)
+    except requests.RequestException as err:
+        # not critical since media will then be retrieved individually
+        logger.warning("Unable to prefetch media info: %s", err)
 
 
 def extract_bundled_contents(
@@ -304,18 +540,11 @@ def extract_bundled_contents(
     cards: List[Dict],
     args: argparse.Namespace,
 ):
-    format_id = libby_client.get_loan_format(selected_loan)
-    format_info: Dict = next(
-        iter([f for f in selected_loan.get("formats", []) if f["id"] == format_id]),
-        {},
-    )
     card: Dict = next(
         iter([c for c in cards if c["cardId"] == selected_loan["cardId"]]), {}
     )
-    if format_info.get("isBundleParent") and format_info.get("bundledContent", []):
-        bundled_contents_ids = list(
-            set([bc["titleId"] for bc in format_info["bundledContent"]])
-        )
+    bundled_contents_ids = get_bundled_content_ids(selected_loan)
+    if bundled_contents_ids:
         for bundled_content_id in bundled_contents_ids:
             bundled_media = overdrive_client.library_media(
                 card["advantageKey"], bundled_content_id
@@ -325,7 +554,7 @@ def extract_bundled_contents(
             try:
                 # patch in cardId from parent loan details
                 bundled_media["cardId"] = selected_loan["cardId"]
-                extract_loan_file(libby_client, bundled_media, args)
+                extract_loan_file(libby_client, bundled_media, args, overdrive_client)
             except ClientError:
                 # Oddly having a valid loan to the audiobook does not always mean
                 # having access to the bundled content? Ref https://github.com/ping/odmpy/issues/54
@@ -337,7 +566,10 @@ def extract_bundled_contents(
 
 
 def extract_loan_file(
-    libby_client: LibbyClient, selected_loan: Dict, args: argparse.Namespace
+    libby_client: LibbyClient,
+    selected_loan: Dict,
+    args: argparse.Namespace,
+    overdrive_client: Optional[OverDriveClient] = None,
 ) -> Optional[Path]:
     """
     Extracts the ODM / ACSM / EPUB(open) file
@@ -345,8 +577,19 @@ def extract_loan_file(
     :param libby_client:
     :param selected_loan:
     :param args:
+    :param overdrive_client: Shared client with prefetched media
     :return: The path to the ODM file
     """
+    from tqdm import tqdm
+
+    from .processing.shared import (
+        generate_names,
+        generate_cover,
+        get_best_cover_url,
+        init_session,
+        extract_authors_from_openbook,
+    )
+
     try:
         format_id = LibbyClient.get_loan_format(selected_loan)
     except ValueError as err:
@@ -436,27 +679,37 @@ def extract_loan_file(
     # needlessly use up the fulfillment limits
     if not loan_file_path.exists():
         if format_id in (LibbyFormats.EBookOverdrive, LibbyFormats.MagazineOverDrive):
-            process_ebook_loan(
+            processing.process_ebook_loan(
                 loan=selected_loan,
                 cover_path=cover_path,
                 openbook=openbook,
                 libby_client=libby_client,
                 args=args,
                 logger=logger,
+                od_client=overdrive_client,
             )
         else:
             # formats: odm, acsm, open-epub, open-pdf
             try:
-                odm_res_content = libby_client.fulfill_loan_file(
-                    selected_loan["id"], selected_loan["cardId"], format_id
-                )
-                with loan_file_path.open("wb") as f:
-                    f.write(odm_res_content)
-                    logger.info(
-                        'Downloaded %s to "%s"',
-                        file_ext,
-                        colored(str(loan_file_path), "magenta"),
+                with tqdm(
+                    desc=loan_file_path.name,
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+                    disable=args.hide_progress,
+                ) as progress_bar:
+                    libby_client.download_loan_file(
+                        selected_loan["id"],
+                        selected_loan["cardId"],
+                        format_id,
+                        loan_file_path,
+                        progress_callback=progress_bar.update,
                     )
+                logger.info(
+                    'Downloaded %s to "%s"',
+                    file_ext,
+                    colored(str(loan_file_path), "magenta"),
+                )
             except ClientError as ce:
                 if ce.http_status == 400 and libby_client.is_downloadable_ebook_loan(
                     selected_loan
@@ -484,6 +737,250 @@ def extract_loan_file(
     return loan_file_path
 
 
+def filter_downloadable_loans(
+    libby_client: LibbyClient, loans: List[Dict], args: argparse.Namespace
+) -> List[Dict]:
+    """
+    Get the loans that can be downloaded with the selected options.
+
+    :param libby_client:
+    :param loans:
+    :param args:
+    :return: Loans sorted by checkout date so that the most recent is at the bottom
+    """
+    return sorted(
+        [
+            book
+            for book in loans
+            if (
+                (not args.exclude_audiobooks)
+                and libby_client.is_downloadable_audiobook_loan(book)
+            )
+            or (args.include_ebooks and libby_client.is_downloadable_ebook_loan(book))
+            or (
+                args.include_magazines
+                and libby_client.is_downloadable_magazine_loan(book)
+            )
+        ],
+        key=lambda ln: ln["checkoutDate"],  # type: ignore[no-any-return]
+    )
+
+
+def download_loan(
+    libby_client: LibbyClient,
+    overdrive_client: OverDriveClient,
+    selected_loan: Dict,
+    cards: List[Dict],
+    args: argparse.Namespace,
+) -> None:
+    """
+    Download a loan non-interactively.
+
+    :param libby_client:
+    :param overdrive_client:
+    :param selected_loan:
+    :param cards:
+    :param args:
+    :return:
+    """
+    logger.info(
+        'Opening %s "%s"...',
+        selected_loan.get("type", {}).get("id"),
+        colored(selected_loan["title"], "blue"),
+    )
+    if libby_client.is_downloadable_audiobook_loan(selected_loan):
+        if args.libby_direct:
+            openbook, toc = libby_client.process_audiobook(
+                selected_loan, use_cache=True
+            )
+            processing.process_audiobook_loan(
+                selected_loan,
+                openbook,
+                toc,
+                libby_client.libby_session,
+                args,
+                logger,
+                od_client=overdrive_client,
+                refresh_session=functools.partial(
+                    libby_client.refresh_loan, selected_loan
+                ),
+            )
+        else:
+            processing.process_odm(
+                extract_loan_file(libby_client, selected_loan, args, overdrive_client),
+                selected_loan,
+                args,
+                logger,
+                cleanup_odm_license=not args.keepodm,
+                od_client=overdrive_client,
+            )
+        extract_bundled_contents(
+            libby_client, overdrive_client, selected_loan, cards, args
+        )
+    elif libby_client.is_downloadable_ebook_loan(
+        selected_loan
+    ) or libby_client.is_downloadable_magazine_loan(selected_loan):
+        extract_loan_file(libby_client, selected_loan, args, overdrive_client)
+
+
+def _loan_snapshot(loans: List[Dict]) -> Dict[str, str]:
+    # a loan that is returned and borrowed again gets a new checkout date
+    return {
+        f'{loan["cardId"]}:{loan["id"]}': loan.get("checkoutDate", "") for loan in loans
+    }
+
+
+def diff_loans(snapshot: Dict[str, str], loans: List[Dict]) -> List[Dict]:
+    """
+    Get the loans that are new or changed since the snapshot was taken.
+
+    :param snapshot: Checkout dates by loan key, from the last poll
+    :param loans:
+    :return:
+    """
+    loans_snapshot = _loan_snapshot(loans)
+    return [
+        loan
+        for loan, (key, checkout_date) in zip(loans, loans_snapshot.items())
+        if snapshot.get(key) != checkout_date
+    ]
+
+
+def _read_watch_snapshot(snapshot_file: Optional[Path]) -> Optional[Dict[str, str]]:
+    if not (snapshot_file and snapshot_file.exists()):
+        return None
+    try:
+        with snapshot_file.open("r", encoding="utf-8") as f:
+            snapshot: Dict[str, str] = json.load(f)
+            return snapshot
+    except (OSError, ValueError) as err:
+        logger.warning("Unable to read loans snapshot %s: %s", snapshot_file, err)
+        return None
+
+
+def _write_watch_snapshot(
+    snapshot_file: Optional[Path], snapshot: Dict[str, str]
+) -> None:
+    if not snapshot_file:
+        return
+    try:
+        with snapshot_file.open("w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+    except OSError as err:
+        logger.warning("Unable to save loans snapshot %s: %s", snapshot_file, err)
+
+
+def watch_loans(
+    libby_client: LibbyClient,
+    overdrive_client: OverDriveClient,
+    loans: List[Dict],
+    cards: List[Dict],
+    args: argparse.Namespace,
+    downloaded_loans: Optional[List[Dict]] = None,
+    sleep: Optional[Callable[[float], None]] = None,
+    max_polls: int = 0,
+) -> None:
+    """
+    Poll Libby for loans and download the loans that are new or changed
+    since the last poll. The polling interval is doubled each time nothing
+    is found, up to `args.watch_max_interval`.
+
+    :param libby_client:
+    :param overdrive_client:
+    :param loans: Downloadable loans from the initial sync
+    :param cards:
+    :param args:
+    :param downloaded_loans: Loans that have already been downloaded in this run
+    :param sleep: Defaults to time.sleep, used by unittests
+    :param max_polls: Stop after this number of polls, used by unittests
+    :return:
+    """
+    snapshot_file = (
+        libby_client.settings_folder.joinpath(WATCH_SNAPSHOT_FILENAME)
+        if libby_client.settings_folder
+        else None
+    )
+    snapshot = _read_watch_snapshot(snapshot_file)
+    if snapshot is None:
+        # first watch, so only loans borrowed from now on are downloaded
+        snapshot = _loan_snapshot(loans)
+    snapshot.update(_loan_snapshot(downloaded_loans or []))
+
+    logger.info(
+        "Watching for new loans every %s %s. Press Ctrl+C to stop.",
+        colored(str(args.watch_interval), "blue"),
+        ps(args.watch_interval, "second"),
+    )
+    polls = 0
+    idle_polls = 0
+    try:
+        while True:
+            pending_loans = diff_loans(snapshot, loans)
+            failed_loans: List[Dict] = []
+            if pending_loans:
+                logger.info(
+                    "Found %s new %s.",
+                    colored(str(len(pending_loans)), "blue"),
+                    ps(len(pending_loans), "loan"),
+                )
+                prefetch_loans_media(
+                    libby_client, overdrive_client, pending_loans, cards, args
+                )
+                for loan in pending_loans:
+                    try:
+                        download_loan(libby_client, overdrive_client, loan, cards, args)
+                    except (
+                        OdmpyRuntimeError,
+                        ClientError,
+                        requests.RequestException,
+                    ) as err:
+                        # retried in the next poll
+                        logger.error(
+                            'Unable to download "%s": %s',
+                            loan.get("title", ""),
+                            colored(str(err), "red"),
+                        )
+                        failed_loans.append(loan)
+            updated_snapshot = _loan_snapshot(
+                [loan for loan in loans if loan not in failed_loans]
+            )
+            for key in _loan_snapshot(failed_loans):
+                if key in snapshot:
+                    updated_snapshot[key] = snapshot[key]
+            if updated_snapshot != snapshot or not (
+                snapshot_file and snapshot_file.exists()
+            ):
+                _write_watch_snapshot(snapshot_file, updated_snapshot)
+            snapshot = updated_snapshot
+
+            polls += 1
+            if max_polls and polls >= max_polls:
+                break
+
+            if pending_loans:
+                idle_polls = 0
+            interval = min(
+                args.watch_interval * (2**idle_polls), args.watch_max_interval
+            )
+            if not pending_loans and interval < args.watch_max_interval:
+                idle_polls += 1
+            (sleep or time.sleep)(interval + random.uniform(0, interval * WATCH_JITTER))
+
+            try:
+                if libby_client.renew_chip_if_needed():
+                    logger.debug("Renewed identity.")
+                synced_state = libby_client.sync(force=True)
+                loans = filter_downloadable_loans(
+                    libby_client, synced_state.get("loans", []), args
+                )
+                cards = synced_state.get("cards", [])
+            except (ClientError, requests.RequestException) as err:
+                # keep the last loans so that nothing is enqueued, and back off
+                logger.warning("Unable to sync loans: %s", err)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching for new loans.")
+
+
 def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None:
     """
 
@@ -532,12 +1029,32 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         default=1,
         help="Number of retries if a network request fails. Default 1.",
     )
+    parser.add_argument(
+        "--poolconnections",
+        dest="pool_connections",
+        type=positive_int,
+        default=DEFAULT_POOLSIZE,
+        help=f"Number of host connection pools to keep alive. Default {DEFAULT_POOLSIZE}.",
+    )
+    parser.add_argument(
+        "--poolsize",
+        dest="pool_maxsize",
+        type=positive_int,
+        default=DEFAULT_POOLSIZE,
+        help=(
+            "Max number of connections to keep alive per host. "
+            f"Raised to the --parallel value if lower. Default {DEFAULT_POOLSIZE}."
+        ),
+    )
     parser.add_argument(
         "--noversioncheck",
         dest="dont_check_version",
         default=False,
         action="store_true",
-        help="Do not check if newer version is available.",
+        help=(
+            "Do not check if newer version is available. "
+            "The check runs in the background at most once a day."
+        ),
     )
 
     subparsers = parser.add_subparsers(
@@ -569,6 +1086,15 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         action="store_true",
         help="Keep the downloaded odm and license files. For audiobooks.",
     )
+    parser_libby.add_argument(
+        "--streamepub",
+        dest="stream_epub",
+        action="store_true",
+        help=(
+            "Write contents directly into the epub instead of staging them "
+            "\nin a folder first. For direct eBook and magazine downloads."
+        ),
+    )
     parser_libby.add_argument(
         "--latest",
         dest=OdmpyNoninteractiveOptions.DownloadLatestN,
@@ -602,6 +1128,35 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
             "If the loan with the ID does not exist, it will be skipped."
         ),
     )
+    parser_libby.add_argument(
+        "--watch",
+        dest=OdmpyNoninteractiveOptions.Watch,
+        action="store_true",
+        help=(
+            "Non-interactive mode that keeps running and downloads loans\n"
+            "as they are borrowed. Can be combined with --latest/--select/--selectid\n"
+            "to download existing loans first."
+        ),
+    )
+    parser_libby.add_argument(
+        "--watchinterval",
+        dest="watch_interval",
+        type=positive_int,
+        default=300,
+        metavar="SECONDS",
+        help="Seconds between checks for new loans in --watch mode. Default 300.",
+    )
+    parser_libby.add_argument(
+        "--watchmaxinterval",
+        dest="watch_max_interval",
+        type=positive_int,
+        default=3600,
+        metavar="SECONDS",
+        help=(
+            "The interval is doubled each time no new loans are found, "
+            "\nup to this number of seconds. Default 3600."
+        ),
+    )
     parser_libby.add_argument(
         "--exportloans",
         dest=OdmpyNoninteractiveOptions.ExportLoans,
@@ -705,21 +1260,21 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
             download_dir.mkdir(parents=True, exist_ok=True)
         args.download_dir = str(download_dir.expanduser())
 
-    if hasattr(args, "settings_folder"):
-        default_config_folder = (
-            Path(
-                os.environ.get("APPDATA")
-                or os.environ.get("XDG_CONFIG_HOME")
-                or Path(os.environ.get("HOME", "./")).joinpath(".config")
-            )
-            .joinpath("odmpy")
-            .expanduser()
+    default_config_folder = (
+        Path(
+            os.environ.get("APPDATA")
+            or os.environ.get("XDG_CONFIG_HOME")
+            or Path(os.environ.get("HOME", "./")).joinpath(".config")
         )
+        .joinpath("odmpy")
+        .expanduser()
+    )
+    if OLD_SETTINGS_FOLDER_DEFAULT.joinpath("libby.json").exists():
+        # handle backward-compat for versions <= 0.8.1
+        default_config_folder = OLD_SETTINGS_FOLDER_DEFAULT
+    if hasattr(args, "settings_folder"):
         if args.settings_folder:
             args.settings_folder = str(Path(args.settings_folder).expanduser())
-        elif OLD_SETTINGS_FOLDER_DEFAULT.joinpath("libby.json").exists():
-            # handle backward-compat for versions <= 0.8.1
-            args.settings_folder = str(OLD_SETTINGS_FOLDER_DEFAULT)
         else:
             args.settings_folder = str(default_config_folder)
 
@@ -731,8 +1286,23 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         logging.WARNING if logger.level == logging.DEBUG else logging.ERROR
     )
 
+    configure_sessions(
+        pool_connections=args.pool_connections,
+        pool_maxsize=max(
+            args.pool_maxsize,
+            getattr(args, "parallel_downloads", 1)
+            * getattr(args, "download_segments", 1),
+        ),
+    )
+
     if not args.dont_check_version:
-        check_version(args.timeout, args.retries)
+        start_version_check(
+            args.timeout,
+            args.retries,
+            cache_file=Path(
+                getattr(args, "settings_folder", None) or default_config_folder
+            ).joinpath(VERSION_CHECK_CACHE_FILENAME),
+        )
 
     if hasattr(args, "obsolete_retries") and args.obsolete_retries:
         # retire --retry on the subcommands, after v0.6.7
@@ -769,6 +1339,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                     max_retries=args.retries,
                     timeout=args.timeout,
                     logger=logger,
+                    cache=get_cache(getattr(args, "cache_dir", "")),
                 )
             else:
                 libby_client = LibbyClient(
@@ -776,12 +1347,14 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                     max_retries=args.retries,
                     timeout=args.timeout,
                     logger=logger,
+                    cache=get_cache(getattr(args, "cache_dir", "")),
                 )
 
             overdrive_client = OverDriveClient(
                 user_agent=libby_client.user_agent,
                 timeout=args.timeout,
                 retry=args.retries,
+                cache=libby_client.cache,
             )
 
             if args.command_name == OdmpyCommands.Libby and args.reset_settings:
@@ -849,28 +1422,13 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                         "Could not log in with code.\n"
                         "Make sure that you have entered the right code and within the time limit."
                     ) from ce
-            libby_client.renew_chip()
+            if libby_client.renew_chip_if_needed():
+                logger.debug("Renewed identity.")
             synced_state = libby_client.sync()
             cards = synced_state.get("cards", [])
             # sort by checkout date so that recent most is at the bottom
-            libby_loans = sorted(
-                [
-                    book
-                    for book in synced_state.get("loans", [])
-                    if (
-                        (not args.exclude_audiobooks)
-                        and libby_client.is_downloadable_audiobook_loan(book)
-                    )
-                    or (
-                        args.include_ebooks
-                        and libby_client.is_downloadable_ebook_loan(book)
-                    )
-                    or (
-                        args.include_magazines
-                        and libby_client.is_downloadable_magazine_loan(book)
-                    )
-                ],
-                key=lambda ln: ln["checkoutDate"],  # type: ignore[no-any-return]
+            libby_loans = filter_downloadable_loans(
+                libby_client, synced_state.get("loans", []), args
             )
 
             if args.command_name == OdmpyCommands.Libby and args.export_loans_path:
@@ -894,10 +1452,13 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                     logger.info("No renewable loans found.")
                     return
 
-            if not libby_loans:
+            watch_mode = args.command_name == OdmpyCommands.Libby and args.watch
+            if not libby_loans and not watch_mode:
                 logger.info("No downloadable loans found.")
                 return
 
+            selected_loans: List[Dict] = []
+
             if args.command_name == OdmpyCommands.Libby and (
                 args.selected_loans_indices
                 or args.download_latest_n
@@ -943,72 +1504,27 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                         if loan["id"] in selected_loans_ids:
                             selected_loans_indices.append(n)
                 selected_loans_indices = sorted(list(set(selected_loans_indices)))
-                selected_loans: List[Dict] = [
-                    libby_loans[j - 1] for j in selected_loans_indices
-                ]
-                if args.libby_direct:
-                    for selected_loan in selected_loans:
-                        logger.info(
-                            'Opening %s "%s"...',
-                            selected_loan.get("type", {}).get("id"),
-                            colored(selected_loan["title"], "blue"),
-                        )
-                        if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                            openbook, toc = libby_client.process_audiobook(
-                                selected_loan
-                            )
-                            process_audiobook_loan(
-                                selected_loan,
-                                openbook,
-                                toc,
-                                libby_client.libby_session,
-                                args,
-                                logger,
-                            )
-                            extract_bundled_contents(
-                                libby_client,
-                                overdrive_client,
-                                selected_loan,
-                                cards,
-                                args,
-                            )
-                            continue
-                        elif libby_client.is_downloadable_ebook_loan(
-                            selected_loan
-                        ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                            extract_loan_file(libby_client, selected_loan, args)
-                            continue
-                    return
-
+                selected_loans = [libby_loans[j - 1] for j in selected_loans_indices]
+                prefetch_loans_media(
+                    libby_client, overdrive_client, selected_loans, cards, args
+                )
                 for selected_loan in selected_loans:
-                    logger.info(
-                        'Opening %s "%s"...',
-                        selected_loan.get("type", {}).get("id"),
-                        colored(selected_loan["title"], "blue"),
+                    download_loan(
+                        libby_client, overdrive_client, selected_loan, cards, args
                     )
-                    if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                        process_odm(
-                            extract_loan_file(libby_client, selected_loan, args),
-                            selected_loan,
-                            args,
-                            logger,
-                            cleanup_odm_license=not args.keepodm,
-                        )
-                        extract_bundled_contents(
-                            libby_client,
-                            overdrive_client,
-                            selected_loan,
-                            cards,
-                            args,
-                        )
-
-                    elif libby_client.is_downloadable_ebook_loan(
-                        selected_loan
-                    ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                        extract_loan_file(libby_client, selected_loan, args)
-                        continue
-
-                return  # non-interactive libby downloads
+                if not watch_mode:
+                    return  # non-interactive libby downloads
+
+            if watch_mode:
+                watch_loans(
+                    libby_client,
+                    overdrive_client,
+                    libby_loans,
+                    cards,
+                    args,
+                    downloaded_loans=selected_loans,
+                )
+                return
 
             # Interactive mode
             holds = synced_state.get("holds", [])
@@ -1180,6 +1696,13 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
 
             if args.command_name == OdmpyCommands.Libby:
                 # do downloads
+                prefetch_loans_media(
+                    libby_client,
+                    overdrive_client,
+                    [libby_loans[int(c) - 1] for c in loan_choices],
+                    cards,
+                    args,
+                )
                 if args.libby_direct:
                     for c in loan_choices:
                         selected_loan = libby_loans[int(c) - 1]
@@ -1190,15 +1713,19 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                         )
                         if libby_client.is_downloadable_audiobook_loan(selected_loan):
                             openbook, toc = libby_client.process_audiobook(
-                                selected_loan
+                                selected_loan, use_cache=True
                             )
-                            process_audiobook_loan(
+                            processing.process_audiobook_loan(
                                 selected_loan,
                                 openbook,
                                 toc,
                                 libby_client.libby_session,
                                 args,
                                 logger,
+                                od_client=overdrive_client,
+                                refresh_session=functools.partial(
+                                    libby_client.refresh_loan, selected_loan
+                                ),
                             )
                             extract_bundled_contents(
                                 libby_client,
@@ -1211,7 +1738,9 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                         elif libby_client.is_downloadable_ebook_loan(
                             selected_loan
                         ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                            extract_loan_file(libby_client, selected_loan, args)
+                            extract_loan_file(
+                                libby_client, selected_loan, args, overdrive_client
+                            )
                             continue
 
                     return
@@ -1224,12 +1753,15 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                         colored(selected_loan["title"], "blue"),
                     )
                     if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                        process_odm(
-                            extract_loan_file(libby_client, selected_loan, args),
+                        processing.process_odm(
+                            extract_loan_file(
+                                libby_client, selected_loan, args, overdrive_client
+                            ),
                             selected_loan,
                             args,
                             logger,
                             cleanup_odm_license=not args.keepodm,
+                            od_client=overdrive_client,
                         )
                         extract_bundled_contents(
                             libby_client,
@@ -1242,7 +1774,9 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                     elif libby_client.is_downloadable_ebook_loan(
                         selected_loan
                     ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                        extract_loan_file(libby_client, selected_loan, args)
+                        extract_loan_file(
+                            libby_client, selected_loan, args, overdrive_client
+                        )
                         continue
                 return
 
@@ -1260,7 +1794,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
 
         # Return Book
         if args.command_name == OdmpyCommands.Return:
-            process_odm_return(args, logger)
+            processing.process_odm_return(args, logger)
             return
 
         if args.command_name in (OdmpyCommands.Download, OdmpyCommands.Information):
@@ -1269,7 +1803,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                     'Opening odm "%s"...',
                     colored(args.odm_file, "blue"),
                 )
-            res = process_odm(Path(args.odm_file), {}, args, logger)
+            res = processing.process_odm(Path(args.odm_file), {}, args, logger)
             return res
 
     except OdmpyRuntimeError as run_err:
@@ -17,11 +17,13 @@
 #
 
 import logging
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from urllib.parse import urljoin
 
 import requests
-from requests.adapters import HTTPAdapter, Retry
+
+from .http_cache import HttpCache
+from .sessions import get_session
 
 #
 # Basic skeletal client for the OverDrive Thunder API
@@ -49,18 +51,20 @@ class OverDriveClient(object):
             - user_agent: User Agent string for requests
             - timeout: The timeout interval for a network request. Default 15 (seconds).
             - retries: The number of times to retry a network request on failure. Default 0.
+            - cache: An optional `HttpCache` for GET requests
         """
         self.logger = logging.getLogger(__name__)
         self.user_agent = kwargs.pop("user_agent", USER_AGENT)
         self.timeout = int(kwargs.pop("timeout", 15))
         self.retries = int(kwargs.pop("retry", 0))
 
-        session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(total=self.retries, backoff_factor=0.1))
-        # noinspection HttpUrlsUsage
-        for prefix in ("http://", "https://"):
-            session.mount(prefix, adapter)
-        self.session = kwargs.pop("session", None) or session
+        self.session = kwargs.pop("session", None) or get_session(
+            max_retries=self.retries
+        )
+        self.cache: Optional[HttpCache] = kwargs.pop("cache", None)
+        # in-memory map of prefetched media, keyed by (lower-cased) title and reserve ids
+        self._media: Dict[str, Dict] = {}
+        self._library_media: Dict[Tuple[str, str], Dict] = {}
 
     def default_headers(self) -> Dict:
         """
@@ -120,7 +124,14 @@ class OverDriveClient(object):
             params=params,
             data=data,
         )
-        res = self.session.send(self.session.prepare_request(req), timeout=self.timeout)
+        if self.cache:
+            res = self.cache.send(
+                self.session, self.session.prepare_request(req), timeout=self.timeout
+            )
+        else:
+            res = self.session.send(
+                self.session.prepare_request(req), timeout=self.timeout
+            )
         self.logger.debug("body: %s", res.text)
         res.raise_for_status()
 
@@ -136,6 +147,8 @@ class OverDriveClient(object):
         :param title_id: A unique id that identifies the content.
         :return:
         """
+        if not kwargs and title_id.lower() in self._media:
+            return self._media[title_id.lower()]
         params = self.default_params()
         params.update(kwargs)
         return self.make_request(f"media/{title_id}", params=params)
@@ -152,6 +165,24 @@ class OverDriveClient(object):
         params.update(kwargs)
         return self.make_request("media/bulk", params=params)
 
+    def prefetch_media(self, title_ids: List[str], batch_size: int = 25) -> None:
+        """
+        Retrieve titles in bulk so that subsequent `media()` calls for them
+        are served from memory.
+
+        :param title_ids: The ids can be titleIds or reserveIds.
+        :param batch_size: Max number of titles per request
+        :return:
+        """
+        pending_ids = [
+            t for t in dict.fromkeys(title_ids) if t.lower() not in self._media
+        ]
+        for i in range(0, len(pending_ids), batch_size):
+            for media in self.media_bulk(pending_ids[i : i + batch_size]):
+                for media_id in (media.get("id"), media.get("reserveId")):
+                    if media_id:
+                        self._media[str(media_id).lower()] = media
+
     def library(self, library_key: str, **kwargs) -> Dict:
         """
         Get a library's configuration data.
@@ -172,6 +203,8 @@ class OverDriveClient(object):
         :param title_id:
         :return:
         """
+        if not kwargs and (library_key, title_id.lower()) in self._library_media:
+            return self._library_media[(library_key, title_id.lower())]
         params = self.default_params()
         params.update({"titleIds": title_id})
         params.update(kwargs)
@@ -179,6 +212,46 @@ class OverDriveClient(object):
             f"libraries/{library_key}/media/{title_id}", params=params
         )
 
+    def library_media_bulk(
+        self, library_key: str, title_ids: List[str], **kwargs
+    ) -> List[Dict]:
+        """
+        Get a list of titles. Like `media_bulk()`, this returns a plain list of
+        media, but with the library's availability for each title.
+
+        :param library_key: A unique key that identifies the library
+        :param title_ids: The ids passed in this request can be titleIds or reserveIds.
+        :return:
+        """
+        params = self.default_params()
+        params.update({"titleIds": ",".join(title_ids)})
+        params.update(kwargs)
+        return self.make_request(f"libraries/{library_key}/media/bulk", params=params)
+
+    def prefetch_library_media(
+        self, library_key: str, title_ids: List[str], batch_size: int = 25
+    ) -> None:
+        """
+        Retrieve a library's titles in bulk so that subsequent `library_media()` calls
+        for them are served from memory.
+
+        :param library_key: A unique key that identifies the library
+        :param title_ids:
+        :param batch_size: Max number of titles per request
+        :return:
+        """
+        pending_ids = [
+            t
+            for t in dict.fromkeys(title_ids)
+            if (library_key, t.lower()) not in self._library_media
+        ]
+        for i in range(0, len(pending_ids), batch_size):
+            for media in self.library_media_bulk(
+                library_key, pending_ids[i : i + batch_size]
+            ):
+                if media.get("id"):
+                    self._library_media[(library_key, str(media["id"]).lower())] = media
+
     def library_media_availability(
         self, library_key: str, title_id: str, **kwargs
     ) -> dict:
@@ -16,7 +16,36 @@
 # along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-# flake8: noqa
-from .odm import process_odm, process_odm_return
-from .audiobook import process_audiobook_loan
-from .ebook import process_ebook_loan
+import importlib
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .odm import process_odm, process_odm_return
+    from .audiobook import process_audiobook_loan
+    from .ebook import process_ebook_loan
+
+__all__ = [
+    "process_odm",
+    "process_odm_return",
+    "process_audiobook_loan",
+    "process_ebook_loan",
+]
+
+# The processing modules pull in heavy dependencies (eyed3, bs4, iso639, etc.),
+# so they are only imported when a processing function is first accessed.
+# This keeps the CLI startup fast for commands that do not need them.
+_LAZY_ATTRS = {
+    "process_odm": ".odm",
+    "process_odm_return": ".odm",
+    "process_audiobook_loan": ".audiobook",
+    "process_ebook_loan": ".ebook",
+}
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_ATTRS.get(name)
+    if not module_name:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
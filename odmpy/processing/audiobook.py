@@ -20,8 +20,8 @@ import argparse
 import datetime
 import json
 import logging
-import shutil
-from typing import Optional, Any, Dict, List
+from pathlib import Path
+from typing import Optional, Any, Callable, Dict, List, Tuple
 from typing import OrderedDict as OrderedDictType
 
 import eyed3  # type: ignore[import]
@@ -29,22 +29,34 @@ import requests
 from eyed3.id3 import ID3_DEFAULT_VERSION, ID3_V2_3, ID3_V2_4  # type: ignore[import]
 from requests.exceptions import HTTPError, ConnectionError
 from termcolor import colored
-from tqdm import tqdm
 
 from .shared import (
     generate_names,
     write_tags,
     generate_cover,
     remux_mp3,
+    finalize_mp3,
+    get_header_reserve,
+    ID3TagTemplate,
     merge_into_mp3,
-    convert_to_m4b,
+    TagOnlyFile,
+    Mp3File,
+    estimate_id3_padding,
+    merge_into_m4b,
+    build_m4b_metadata,
     create_opf,
     get_best_cover_url,
     extract_isbn,
+    find_saved_output,
+    PartDownload,
+    download_part_files,
 )
 from ..errors import OdmpyRuntimeError
+from ..http_cache import get_cache
 from ..libby import USER_AGENT, merge_toc, PartMeta, LibbyFormats
+from ..mp3 import Mp3StreamAnalyzer
 from ..overdrive import OverDriveClient
+from ..state import get_state
 from ..utils import slugify, plural_or_singular_noun as ps
 
 
@@ -60,6 +72,8 @@ def process_audiobook_loan(
     session: requests.Session,
     args: argparse.Namespace,
     logger: logging.Logger,
+    od_client: Optional[OverDriveClient] = None,
+    refresh_session: Optional[Callable[[], Any]] = None,
 ) -> None:
     """
     Download the audiobook loan directly via Libby without the use of
@@ -71,6 +85,11 @@ def process_audiobook_loan(
     :param session: From `LibbyClient.libby_session` because it contains a needed auth cookie
     :param args:
     :param logger:
+    :param od_client: Shared client with prefetched media
+    :param refresh_session: Renews the auth cookie in `session` if the part
+                            downloads are rejected, e.g. `LibbyClient.refresh_loan`.
+                            If it returns the refreshed toc, the remaining parts
+                            are downloaded from its urls.
     :return:
     """
 
@@ -158,22 +177,22 @@ def process_audiobook_loan(
         logger=logger,
     )
     book_m4b_filename = book_filename.with_suffix(".m4b")
+    state = get_state(getattr(args, "state_db", ""))
 
     # check early if a merged file is already saved
-    if (
-        args.merge_output
-        and (
-            book_filename if args.merge_format == "mp3" else book_m4b_filename
-        ).exists()
-    ):
-        logger.warning(
-            'Already saved "%s"',
-            colored(
-                str(book_filename if args.merge_format == "mp3" else book_m4b_filename),
-                "magenta",
-            ),
+    if args.merge_output:
+        saved_filename = find_saved_output(
+            state,
+            overdrive_media_id,
+            args.merge_format,
+            book_filename if args.merge_format == "mp3" else book_m4b_filename,
+            title,
         )
-        return
+        if saved_filename:
+            logger.warning(
+                'Already saved "%s"', colored(str(saved_filename), "magenta")
+            )
+            return
 
     if args.is_debug_mode:
         with book_folder.joinpath("loan.json").open("w", encoding="utf-8") as f:
@@ -193,59 +212,244 @@ def process_audiobook_loan(
     keep_cover = args.always_keep_cover
     file_tracks = []
     audio_bitrate = 0
+
+    part_filenames: List[Path] = []
+    pending_parts: List[Tuple[PartMeta, Path]] = []
+    part_downloads: List[PartDownload] = []
+    # text frame values of the tags, to estimate the space that the tags need
+    tag_texts = (
+        [title, sub_title, publisher, description, series, overdrive_media_id]
+        + authors
+        + (narrators or [])
+        + (subjects or [])
+        + (languages or [])
+    )
+    saved_parts = state.get_parts(overdrive_media_id) if state else {}
     for p in download_parts:
         part_number = p["spine-position"] + 1
+        saved_part = saved_parts.get(part_number)
+        if (
+            state
+            and saved_part
+            and state.verify_part(overdrive_media_id, part_number, saved_part)
+        ):
+            # saved in an earlier run, possibly with a different book folder format
+            part_filenames.append(saved_part.path)
+            continue
         part_filename = book_folder.joinpath(
             f"{slugify(f'{title} - Part {part_number:02d}', allow_unicode=True)}.mp3"
         )
-        part_tmp_filename = part_filename.with_suffix(".part")
-        part_file_size = p["file-length"]
-        part_download_url = p["url"]
+        part_filenames.append(part_filename)
+        is_changed = bool(saved_part and saved_part.path == part_filename.absolute())
+        if is_changed:
+            logger.warning(
+                "Saved part %s has changed and will be downloaded again",
+                colored(str(part_filename), "magenta"),
+            )
+        if is_changed or not part_filename.exists():
+            pending_parts.append((p, part_filename))
+            part_downloads.append(
+                PartDownload(
+                    url=p["url"],
+                    tmp_filename=part_filename.with_suffix(".part"),
+                    file_size=p["file-length"],
+                    label=f"Part {part_number:2d}",
+                    analyzer=Mp3StreamAnalyzer(logger),
+                    # so that the part can be tagged in place when finalized
+                    header_reserve=estimate_id3_padding(
+                        cover_bytes=cover_bytes,
+                        texts=tag_texts,
+                        chapter_titles=(
+                            [m.title for m in p["chapters"]]
+                            if args.add_chapters and not args.merge_output
+                            else []
+                        ),
+                    ),
+                )
+            )
 
-        if part_filename.exists():
-            logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
-        else:
-            try:
-                already_downloaded_len = 0
-                if part_tmp_filename.exists():
-                    already_downloaded_len = part_tmp_filename.stat().st_size
-
-                part_download_res = session.get(
-                    part_download_url,
-                    headers={
-                        "User-Agent": USER_AGENT,
-                        "Range": (
-                            f"bytes={already_downloaded_len}-"
-                            if already_downloaded_len
-                            else None
+    # the tag frames common to all parts are only rendered once
+    tag_template = ID3TagTemplate(
+        version=id3v2_version,
+        title=title,
+        sub_title=sub_title,
+        authors=authors,
+        narrators=narrators,
+        publisher=publisher,
+        description=description,
+        cover_bytes=cover_bytes,
+        genres=subjects,
+        languages=languages,
+        published_date=publish_date,
+        series=series,
+        overdrive_id=overdrive_media_id,
+        isbn=extract_isbn(loan.get("formats", []), [LibbyFormats.AudioBookMP3]),
+        always_overwrite=args.overwrite_tags,
+        delimiter=args.tag_delimiter,
+    )
+
+    def post_process_part(
+        index: int, part_tmp_filename: Path
+    ) -> Tuple[Optional[int], bool]:
+        """
+        Remux and tag a downloaded part. This runs in a worker thread
+        while other parts are still downloading.
+
+        :param index: Index of the part in `pending_parts`
+        :param part_tmp_filename:
+        :return: The audio bitrate if available, and if the tags were saved successfully
+        """
+        p, part_filename = pending_parts[index]
+        part_number = p["spine-position"] + 1
+        analyzer = part_downloads[index].analyzer
+        mp3_info = analyzer.info() if analyzer else None
+        if not mp3_info:
+            # try to remux file to remove mp3 lame tag errors
+            remux_mp3(
+                part_tmp_filename=part_tmp_filename,
+                part_filename=part_filename,
+                ffmpeg_loglevel=ffmpeg_loglevel,
+                logger=logger,
+            )
+
+        # Save id3 info only on new download, ref #42
+        # This also makes handling of part files consistent with merged files
+        part_bitrate: Optional[int] = None
+        try:
+            # Fill id3 info for mp3 part
+            # if the audio was already analyzed during the download, only the tag
+            # is parsed, and the tag template is applied when finalizing the part
+            audiofile = (
+                Mp3File(
+                    part_tmp_filename,
+                    info=mp3_info,
+                    offset=get_header_reserve(part_tmp_filename),
+                )
+                if mp3_info
+                else Mp3File(part_filename)
+            )
+            # don't use vbr
+            part_bitrate = 0 if audiofile.info.is_vbr else audiofile.info.bitrate
+            if mp3_info:
+                if not audiofile.tag:
+                    audiofile.initTag()
+            else:
+                tag_template.write_tags(
+                    audiofile, part_number=part_number, total_parts=len(download_parts)
+                )
+                audiofile.tag.save(version=id3v2_version)
+
+            if (
+                args.add_chapters
+                and not args.merge_output
+                and (args.overwrite_tags or not audiofile.tag.table_of_contents)
+            ):
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
+                )
+                chapter_marks = p["chapters"]
+                for i, m in enumerate(chapter_marks):
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
+                    chap = audiofile.tag.chapters.set(
+                        f"ch{i:02d}".encode("ascii"),
+                        times=(
+                            round(m.start_second * 1000),
+                            round(m.end_second * 1000),
                         ),
-                    },
-                    timeout=args.timeout,
-                    stream=True,
+                        sub_frames=title_frameset,
+                    )
+                    toc.child_ids.append(chap.element_id)
+                    start_time = datetime.timedelta(seconds=m.start_second)
+                    end_time = datetime.timedelta(seconds=m.end_second)
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(f"ch{i:02d}", "cyan"),
+                        start_time,
+                        end_time,
+                        colored(m.title, "cyan"),
+                        colored(str(part_filename), "blue"),
+                    )
+                if not mp3_info:
+                    audiofile.tag.save(version=id3v2_version)
+
+            if mp3_info:
+                finalize_mp3(
+                    part_tmp_filename=part_tmp_filename,
+                    part_filename=part_filename,
+                    mp3_info=mp3_info,
+                    tag_data=tag_template.render(
+                        audiofile.tag,
+                        part_number=part_number,
+                        total_parts=len(download_parts),
+                    ),
                 )
-                part_download_res.raise_for_status()
-
-                with tqdm.wrapattr(
-                    part_download_res.raw,
-                    "read",
-                    total=part_file_size,
-                    initial=already_downloaded_len,
-                    desc=f"Part {part_number:2d}",
-                    disable=args.hide_progress,
-                ) as res_raw:
-                    with part_tmp_filename.open(
-                        "ab" if already_downloaded_len else "wb"
-                    ) as outfile:
-                        shutil.copyfileobj(res_raw, outfile)
-
-                # try to remux file to remove mp3 lame tag errors
+
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(
+                "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
+            )
+            if part_tmp_filename.exists():
+                # not finalized, so fall back to remuxing the part as downloaded
                 remux_mp3(
                     part_tmp_filename=part_tmp_filename,
                     part_filename=part_filename,
                     ffmpeg_loglevel=ffmpeg_loglevel,
                     logger=logger,
                 )
+            return part_bitrate, False
+
+        return part_bitrate, True
+
+    def refresh_part_urls() -> Dict[str, str]:
+        # the part urls may change when the loan is opened again
+        refreshed_toc = refresh_session() if refresh_session else None
+        if not isinstance(refreshed_toc, dict):
+            return {}
+        return {
+            parsed_toc[part_name]["url"]: part["url"]
+            for part_name, part in refreshed_toc.items()
+            if part_name in parsed_toc and part.get("url")
+        }
 
+    # parts are downloaded and post-processed concurrently,
+    # but the results are returned in spine order
+    processed_parts = download_part_files(
+        session=session,
+        part_downloads=part_downloads,
+        headers={"User-Agent": USER_AGENT},
+        timeout=args.timeout,
+        parallel=args.parallel_downloads,
+        hide_progress=args.hide_progress,
+        post_process=post_process_part,
+        segments=args.download_segments,
+        resume_retries=args.resume_retries,
+        logger=logger,
+        min_rate=args.min_speed * 1024,
+        rate_window=args.min_speed_window,
+        auth_refresh=refresh_part_urls if refresh_session else None,
+    )
+    pending_part_filenames = [part_filename for _, part_filename in pending_parts]
+    for p, part_filename in zip(download_parts, part_filenames):
+        part_number = p["spine-position"] + 1
+        if part_filename not in pending_part_filenames:
+            logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
+            if state and part_number not in saved_parts:
+                # saved before the state was in use
+                state.set_part(overdrive_media_id, part_number, part_filename)
+        else:
+            try:
+                part_bitrate, is_tagged = next(processed_parts)
             except HTTPError as he:
                 if he.response is not None:
                     logger.error(f"HTTPError: {str(he)}")
@@ -256,91 +460,16 @@ def process_audiobook_loan(
                 logger.error(f"ConnectionError: {str(ce)}")
                 raise OdmpyRuntimeError("Connection Error while downloading part file.")
 
-            # Save id3 info only on new download, ref #42
-            # This also makes handling of part files consistent with merged files
-            try:
-                # Fill id3 info for mp3 part
-                audiofile = eyed3.load(part_filename)
-                variable_bitrate, audio_bitrate = audiofile.info.bit_rate
-                if variable_bitrate:
-                    # don't use vbr
-                    audio_bitrate = 0
-                write_tags(
-                    audiofile=audiofile,
-                    title=title,
-                    sub_title=sub_title,
-                    authors=authors,
-                    narrators=narrators,
-                    publisher=publisher,
-                    description=description,
-                    cover_bytes=cover_bytes,
-                    genres=subjects,
-                    languages=languages,
-                    published_date=publish_date,
-                    series=series,
-                    part_number=part_number,
-                    total_parts=len(download_parts),
-                    overdrive_id=overdrive_media_id,
-                    isbn=extract_isbn(
-                        loan.get("formats", []), [LibbyFormats.AudioBookMP3]
-                    ),
-                    always_overwrite=args.overwrite_tags,
-                    delimiter=args.tag_delimiter,
-                )
-                audiofile.tag.save(version=id3v2_version)
-
-                if (
-                    args.add_chapters
-                    and not args.merge_output
-                    and (args.overwrite_tags or not audiofile.tag.table_of_contents)
-                ):
-                    if args.overwrite_tags and audiofile.tag.table_of_contents:
-                        # Clear existing toc to prevent "There may only be one top-level table of contents.
-                        # Toc 'b'toc'' is current top-level." error
-                        for f in list(audiofile.tag.table_of_contents):
-                            audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-                    toc = audiofile.tag.table_of_contents.set(
-                        "toc".encode("ascii"),
-                        toplevel=True,
-                        ordered=True,
-                        child_ids=[],
-                        description="Table of Contents",
-                    )
-                    chapter_marks = p["chapters"]
-                    for i, m in enumerate(chapter_marks):
-                        title_frameset = eyed3.id3.frames.FrameSet()
-                        title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
-                        chap = audiofile.tag.chapters.set(
-                            f"ch{i:02d}".encode("ascii"),
-                            times=(
-                                round(m.start_second * 1000),
-                                round(m.end_second * 1000),
-                            ),
-                            sub_frames=title_frameset,
-                        )
-                        toc.child_ids.append(chap.element_id)
-                        start_time = datetime.timedelta(seconds=m.start_second)
-                        end_time = datetime.timedelta(seconds=m.end_second)
-                        logger.debug(
-                            'Added chap tag => %s: %s-%s "%s" to "%s"',
-                            colored(f"ch{i:02d}", "cyan"),
-                            start_time,
-                            end_time,
-                            colored(m.title, "cyan"),
-                            colored(str(part_filename), "blue"),
-                        )
-                    audiofile.tag.save(version=id3v2_version)
-
-            except Exception as e:  # pylint: disable=broad-except
-                logger.warning(
-                    "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
-                )
+            if part_bitrate is not None:
+                audio_bitrate = part_bitrate
+            if not is_tagged:
                 keep_cover = True
-
+            if state:
+                state.set_part(overdrive_media_id, part_number, part_filename)
             logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
 
         file_tracks.append({"file": part_filename})
+    processed_parts.close()
 
     debug_meta["file_tracks"] = [{"file": str(ft["file"])} for ft in file_tracks]
     if args.merge_output:
@@ -352,104 +481,141 @@ def process_audiobook_loan(
             ),
         )
 
-        merge_into_mp3(
-            book_filename=book_filename,
-            file_tracks=file_tracks,
-            audio_bitrate=audio_bitrate,
-            ffmpeg_loglevel=ffmpeg_loglevel,
-            hide_progress=args.hide_progress,
-            logger=logger,
-        )
-
-        audiofile = eyed3.load(book_filename)
-        write_tags(
-            audiofile=audiofile,
-            title=title,
-            sub_title=sub_title,
-            authors=authors,
-            narrators=narrators,
-            publisher=publisher,
-            description=description,
-            cover_bytes=cover_bytes,
-            genres=subjects,
-            languages=languages,
-            published_date=publish_date,
-            series=series,
-            part_number=0,
-            total_parts=0,
-            overdrive_id=overdrive_media_id,
-            isbn=extract_isbn(loan.get("formats", []), [LibbyFormats.AudioBookMP3]),
-            always_overwrite=args.overwrite_tags,
-            delimiter=args.tag_delimiter,
-        )
-
-        if args.add_chapters and (
-            args.overwrite_tags or not audiofile.tag.table_of_contents
-        ):
-            if args.overwrite_tags and audiofile.tag.table_of_contents:
-                # Clear existing toc to prevent "There may only be one top-level table of contents.
-                # Toc 'b'toc'' is current top-level." error
-                for f in list(audiofile.tag.table_of_contents):
-                    audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-            toc = audiofile.tag.table_of_contents.set(
-                "toc".encode("ascii"),
-                toplevel=True,
-                ordered=True,
-                child_ids=[],
-                description="Table of Contents",
-            )
-            merged_markers = merge_toc(parsed_toc)
+        merged_markers = merge_toc(parsed_toc) if args.add_chapters else []
+        if args.add_chapters:
             debug_meta["merged_markers"] = [
                 {"title": m.title, "start": m.start_second, "end": m.end_second}
                 for m in merged_markers
             ]
 
-            for i, m in enumerate(merged_markers):
-                title_frameset = eyed3.id3.frames.FrameSet()
-                title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
-                chap = audiofile.tag.chapters.set(
-                    f"ch{i}".encode("ascii"),
-                    times=(round(m.start_second * 1000), round(m.end_second * 1000)),
-                    sub_frames=title_frameset,
-                )
-                toc.child_ids.append(chap.element_id)
-                start_time = datetime.timedelta(seconds=m.start_second)
-                end_time = datetime.timedelta(seconds=m.end_second)
-                logger.debug(
-                    'Added chap tag => %s: %s-%s "%s" to "%s"',
-                    colored(f"ch{i}", "cyan"),
-                    start_time,
-                    end_time,
-                    colored(m.title, "cyan"),
-                    colored(str(book_filename), "blue"),
-                )
-
-        audiofile.tag.save(version=id3v2_version)
-
-        if args.merge_format == "mp3":
-            logger.info(
-                'Merged files into "%s"',
-                colored(
-                    str(
-                        book_filename
-                        if args.merge_format == "mp3"
-                        else book_m4b_filename
-                    ),
-                    "magenta",
-                ),
-            )
-
         if args.merge_format == "m4b":
-            convert_to_m4b(
-                book_filename=book_filename,
+            # generate the m4b directly from the parts in a single pass
+            merge_into_m4b(
                 book_m4b_filename=book_m4b_filename,
+                file_tracks=file_tracks,
                 cover_filename=cover_filename,
+                metadata=build_m4b_metadata(
+                    title=title,
+                    sub_title=sub_title,
+                    authors=authors,
+                    narrators=narrators,
+                    publisher=publisher,
+                    description=description,
+                    genres=subjects,
+                    languages=languages,
+                    published_date=publish_date,
+                    series=series,
+                    overdrive_id=overdrive_media_id,
+                    isbn=extract_isbn(
+                        loan.get("formats", []), [LibbyFormats.AudioBookMP3]
+                    ),
+                    delimiter=args.tag_delimiter,
+                ),
+                chapters=[
+                    (
+                        m.title,
+                        round(m.start_second * 1000),
+                        round(m.end_second * 1000),
+                    )
+                    for m in merged_markers
+                ],
                 merge_codec=args.merge_codec,
                 audio_bitrate=audio_bitrate,
                 ffmpeg_loglevel=ffmpeg_loglevel,
                 hide_progress=args.hide_progress,
                 logger=logger,
+                jobs=args.merge_jobs,
+            )
+        else:
+            merge_into_mp3(
+                book_filename=book_filename,
+                file_tracks=file_tracks,
+                audio_bitrate=audio_bitrate,
+                ffmpeg_loglevel=ffmpeg_loglevel,
+                hide_progress=args.hide_progress,
+                logger=logger,
+                id3_padding=estimate_id3_padding(
+                    cover_bytes=cover_bytes,
+                    texts=tag_texts,
+                    chapter_titles=[m.title for m in merged_markers],
+                ),
+            )
+
+            # only the tag is read and it is written in place within the reserved padding
+            audiofile = TagOnlyFile(book_filename)
+            write_tags(
+                audiofile=audiofile,
+                title=title,
+                sub_title=sub_title,
+                authors=authors,
+                narrators=narrators,
+                publisher=publisher,
+                description=description,
+                cover_bytes=cover_bytes,
+                genres=subjects,
+                languages=languages,
+                published_date=publish_date,
+                series=series,
+                part_number=0,
+                total_parts=0,
+                overdrive_id=overdrive_media_id,
+                isbn=extract_isbn(loan.get("formats", []), [LibbyFormats.AudioBookMP3]),
+                always_overwrite=args.overwrite_tags,
+                delimiter=args.tag_delimiter,
+            )
+
+            if args.add_chapters and (
+                args.overwrite_tags or not audiofile.tag.table_of_contents
+            ):
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
+                )
+
+                for i, m in enumerate(merged_markers):
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
+                    chap = audiofile.tag.chapters.set(
+                        f"ch{i}".encode("ascii"),
+                        times=(
+                            round(m.start_second * 1000),
+                            round(m.end_second * 1000),
+                        ),
+                        sub_frames=title_frameset,
+                    )
+                    toc.child_ids.append(chap.element_id)
+                    start_time = datetime.timedelta(seconds=m.start_second)
+                    end_time = datetime.timedelta(seconds=m.end_second)
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(f"ch{i}", "cyan"),
+                        start_time,
+                        end_time,
+                        colored(m.title, "cyan"),
+                        colored(str(book_filename), "blue"),
+                    )
+
+            audiofile.tag.save(version=id3v2_version)
+
+            logger.info(
+                'Merged files into "%s"', colored(str(book_filename), "magenta")
+            )
+
+        if state:
+            state.set_output(
+                overdrive_media_id,
+                args.merge_format,
+                book_filename if args.merge_format == "mp3" else book_m4b_filename,
+                title,
             )
 
         if not args.keep_mp3:
@@ -458,6 +624,8 @@ def process_audiobook_loan(
                     file_track["file"].unlink()
                 except Exception as e:  # pylint: disable=broad-except
                     logger.warning(f'Error deleting "{file_track["file"]}": {str(e)}')
+            if state:
+                state.clear_parts(overdrive_media_id)
 
     if not keep_cover and cover_filename.exists():
         try:
@@ -473,8 +641,11 @@ def process_audiobook_loan(
                 f"{slugify(title, allow_unicode=True)}.opf"
             )
         if not opf_file_path.exists():
-            od_client = OverDriveClient(
-                user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
+            od_client = od_client or OverDriveClient(
+                user_agent=USER_AGENT,
+                timeout=args.timeout,
+                retry=args.retries,
+                cache=get_cache(args.cache_dir),
             )
             media_info = od_client.media(loan["id"])
             create_opf(
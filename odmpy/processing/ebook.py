@@ -24,11 +24,14 @@ import logging
 import os
 import re
 import shutil
+import threading
 import xml.etree.ElementTree as ET
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from functools import cmp_to_key
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Deque, Dict, List, Optional, Tuple, Set, Union
 from urllib.parse import urlparse, urljoin
 
 import bs4.element
@@ -71,6 +74,136 @@ NAV_XHTMLTEMPLATE = """
 """
 
 
+class EpubStreamWriter:
+    """
+    Writes contents straight into the epub zip as they are fetched, instead of
+    staging them in a folder and zipping them up at the end.
+
+    Entries are recorded in a sidecar manifest only after they are fully written,
+    so that an interrupted download can be resumed from the partial epub.
+    """
+
+    # already compressed formats that are not worth deflating again
+    STORED_MEDIA_TYPE_PREFIXES = ("image/", "font/", "application/font-")
+    DEFLATED_MEDIA_TYPES = ("image/svg+xml",)
+
+    def __init__(self, epub_file_path: Path, logger: logging.Logger):
+        self.epub_file_path = epub_file_path
+        self.part_file_path = epub_file_path.with_name(epub_file_path.name + ".part")
+        self.manifest_file_path = epub_file_path.with_name(
+            epub_file_path.name + ".manifest"
+        )
+        self.logger = logger
+        self._lock = threading.Lock()
+        self.saved: Set[str] = set()
+        self._zip = self._open()
+        self._manifest_file = self.manifest_file_path.open("a", encoding="utf-8")
+        if "mimetype" not in self.saved:
+            # must be the first entry in the zip
+            self.write("mimetype", "application/epub+zip")
+
+    def _open(self) -> zipfile.ZipFile:
+        """
+        Opens the partial epub, resuming from it if possible.
+
+        :return:
+        """
+        if self.part_file_path.exists() and self.manifest_file_path.exists():
+            with self.manifest_file_path.open("r", encoding="utf-8") as f:
+                saved = {line.rstrip("\n") for line in f if line.strip()}
+            temp_file_path = self.part_file_path.with_suffix(".tmp")
+            try:
+                with zipfile.ZipFile(self.part_file_path) as part_zip:
+                    incomplete = set(part_zip.namelist()).difference(saved)
+                    if incomplete:
+                        # drop entries that were interrupted while being written
+                        with zipfile.ZipFile(temp_file_path, mode="w") as temp_zip:
+                            for info in part_zip.infolist():
+                                if info.filename in saved:
+                                    temp_zip.writestr(info, part_zip.read(info))
+                if incomplete:
+                    temp_file_path.replace(self.part_file_path)
+                self.saved = saved
+                self.logger.debug(
+                    'Resuming "%s" with %d saved entries',
+                    self.part_file_path,
+                    len(saved),
+                )
+                return zipfile.ZipFile(
+                    self.part_file_path, mode="a", compression=zipfile.ZIP_DEFLATED
+                )
+            except zipfile.BadZipFile:
+                self.logger.warning(
+                    'Unable to resume from "%s", starting over', self.part_file_path
+                )
+
+        self.manifest_file_path.unlink(missing_ok=True)
+        return zipfile.ZipFile(
+            self.part_file_path, mode="w", compression=zipfile.ZIP_DEFLATED
+        )
+
+    def compress_type(self, arcname: str) -> int:
+        """
+        Images and fonts are stored as-is, everything else is deflated.
+
+        :param arcname:
+        :return:
+        """
+        if arcname == "mimetype":
+            return zipfile.ZIP_STORED
+        media_type = guess_mimetype(arcname) or ""
+        if media_type not in self.DEFLATED_MEDIA_TYPES and media_type.startswith(
+            self.STORED_MEDIA_TYPE_PREFIXES
+        ):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def exists(self, arcname: str) -> bool:
+        return arcname in self.saved
+
+    def read(self, arcname: str) -> bytes:
+        with self._lock:
+            return self._zip.read(arcname)
+
+    def write(self, arcname: str, data: Union[str, bytes]) -> None:
+        """
+        Add an entry to the epub. Thread-safe.
+
+        :param arcname: Path of the entry in the epub, with "/" separators
+        :param data:
+        :return:
+        """
+        with self._lock:
+            if arcname in self.saved:
+                self.logger.debug('epub: Already added "%s"', arcname)
+                return
+            self._zip.writestr(arcname, data, compress_type=self.compress_type(arcname))
+            self._manifest_file.write(arcname + "\n")
+            self._manifest_file.flush()
+            self.saved.add(arcname)
+            self.logger.debug('epub: Added "%s"', arcname)
+
+    def close(self) -> None:
+        """
+        Close the partial epub so that it can be resumed later.
+
+        :return:
+        """
+        with self._lock:
+            self._zip.close()
+            self._manifest_file.close()
+
+    def finalize(self) -> None:
+        """
+        Close the epub and move it into place.
+
+        :return:
+        """
+        self.close()
+        self.part_file_path.replace(self.epub_file_path)
+        self.manifest_file_path.unlink(missing_ok=True)
+
+
 def _sort_toc(toc: Dict) -> List:
     """
     Sorts the ToC dict from openbook into a hierarchical structure
@@ -262,6 +395,36 @@ def _cleanup_soup(soup: BeautifulSoup, version: str = "2.0") -> None:
         html_tag["xmlns"] = "http://www.w3.org/1999/xhtml"
 
 
+def _patch_ncx_identifier(
+    ncx_content: bytes, book_identifier: str, logger: logging.Logger
+) -> Optional[str]:
+    """
+    EPUB3 compliance: Ensure that the identifier in ncx matches the one in the OPF.
+    Mismatch due to the toc.ncx being supplied by publisher.
+
+    :param ncx_content:
+    :param book_identifier:
+    :param logger:
+    :return: The patched ncx contents, or None if unchanged
+    """
+    ncx_soup = BeautifulSoup(ncx_content, features="xml")
+    meta_id = ncx_soup.find("meta", attrs={"name": "dtb:uid"})
+    if (
+        meta_id
+        and isinstance(meta_id, Tag)
+        and meta_id.get("content")
+        and meta_id["content"] != book_identifier
+    ):
+        logger.debug(
+            'Replacing ncx identifier: "%s" -> "%s"',
+            meta_id["content"],
+            book_identifier,
+        )
+        meta_id["content"] = book_identifier
+        return str(ncx_soup)
+    return None
+
+
 def _sort_spine_entries(a: Dict, b: Dict, toc_pages: List[str]):
     """
     Sort spine according to TOC. For magazines, this is sometimes a
@@ -372,6 +535,7 @@ def process_ebook_loan(
     libby_client: LibbyClient,
     args: argparse.Namespace,
     logger: logging.Logger,
+    od_client: Optional[OverDriveClient] = None,
 ) -> None:
     """
     Generates and return an ebook loan directly from Libby.
@@ -382,6 +546,7 @@ def process_ebook_loan(
     :param libby_client:
     :param args:
     :param logger:
+    :param od_client: Shared client with prefetched media
     :return:
     """
     book_folder, book_file_name = generate_names(
@@ -401,12 +566,48 @@ def process_ebook_loan(
     book_content_name = "OEBPS"
     book_meta_folder = book_folder.joinpath(book_meta_name)
     book_content_folder = book_folder.joinpath(book_content_name)
-    for d in (book_meta_folder, book_content_folder):
-        if not d.exists():
-            d.mkdir(parents=True, exist_ok=True)
-
-    od_client = OverDriveClient(
-        user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
+    epub_writer: Optional[EpubStreamWriter] = None
+    if args.stream_epub:
+        epub_writer = EpubStreamWriter(epub_file_path, logger)
+    else:
+        for d in (book_meta_folder, book_content_folder):
+            if not d.exists():
+                d.mkdir(parents=True, exist_ok=True)
+
+    def asset_exists(file_path: Path) -> bool:
+        if epub_writer:
+            return epub_writer.exists(file_path.relative_to(book_folder).as_posix())
+        return file_path.exists()
+
+    def read_asset(file_path: Path) -> bytes:
+        if epub_writer:
+            return epub_writer.read(file_path.relative_to(book_folder).as_posix())
+        return file_path.read_bytes()
+
+    def save_asset(file_path: Path, content: Union[str, bytes]) -> None:
+        """
+        Save a file for the epub, either into the staging folder or
+        straight into the epub if streaming.
+
+        :param file_path: Path in the staging folder
+        :param content:
+        :return:
+        """
+        if epub_writer:
+            epub_writer.write(file_path.relative_to(book_folder).as_posix(), content)
+            return
+        if isinstance(content, str):
+            with file_path.open("w", encoding="utf-8") as f_out:
+                f_out.write(content)
+        else:
+            with file_path.open("wb") as f_out_bin:
+                f_out_bin.write(content)
+
+    od_client = od_client or OverDriveClient(
+        user_agent=USER_AGENT,
+        timeout=args.timeout,
+        retry=args.retries,
+        cache=libby_client.cache,
     )
     media_info = od_client.media(loan["id"])
 
@@ -463,6 +664,20 @@ def process_ebook_loan(
     )
     toc_pages = [item["path"].split("#")[0] for item in openbook_toc]
     manifest_entries: List[Dict] = []
+    # this is the summarised logic from build_opf_package
+    book_identifier = (
+        extract_isbn(
+            media_info["formats"],
+            format_types=[
+                (
+                    LibbyFormats.MagazineOverDrive
+                    if loan["type"]["id"] == LibbyMediaTypes.Magazine
+                    else LibbyFormats.EBookOverdrive
+                )
+            ],
+        )
+        or media_info["id"]
+    )
 
     title_content_entries = list(
         filter(
@@ -498,205 +713,292 @@ def process_ebook_loan(
     # holds the manifest item ID for the image identified as the cover
     cover_img_manifest_id = None
 
-    for entry in progress_bar:
-        entry_url = entry["url"]
-        parsed_entry_url = urlparse(entry_url)
+    def fetch_title_content(
+        entry: Dict,
+    ) -> Tuple[Optional[requests.Response], Optional[BeautifulSoup]]:
+        """
+        Download a title content entry and, for html pages, parse and clean up the soup.
+        Runs in the download pool so that pages are post-processed as soon as they arrive.
+
+        :param entry:
+        :return: The response and soup, or (None, None) if already saved or skipped
+        """
+        parsed_entry_url = urlparse(entry["url"])
         title_content_path = Path(parsed_entry_url.path[1:])
         media_type = guess_mimetype(title_content_path.name)
-        if not media_type:
-            logger.warning("Skipped roster entry: %s", title_content_path.name)
-            continue
-        asset_folder = book_content_folder.joinpath(title_content_path.parent)
-        if media_type == "application/x-dtbncx+xml":
-            has_ncx = True
-        manifest_entry = {
-            "href": parsed_entry_url.path[1:],
-            "id": (
-                "ncx"
-                if media_type == "application/x-dtbncx+xml"
-                else _sanitise_opf_id(parsed_entry_url.path[1:])
-            ),
-            "media-type": media_type,
-        }
-
-        # try to find cover image for magazines
-        if cover_toc_item and manifest_entry["id"] == _sanitise_opf_id(
-            cover_toc_item["featureImage"]
+        asset_file_path = book_content_folder.joinpath(title_content_path)
+        if not media_type or asset_exists(asset_file_path):
+            return None, None
+        asset_folder = asset_file_path.parent
+
+        # use the libby client session because the required
+        # auth cookies are set there
+        res: requests.Response = libby_client.make_request(
+            entry["url"], headers=headers, authenticated=False, return_res=True
+        )
+        if media_type not in ("application/xhtml+xml", "text/html"):
+            return res, None
+
+        soup = BeautifulSoup(res.text, features="html.parser")
+        script_ele = soup.find("script", attrs={"type": "text/javascript"})
+        if script_ele and hasattr(script_ele, "string"):
+            mobj = contents_re.search(script_ele.string or "")
+            if not mobj:
+                logger.warning(
+                    "Unable to extract content string for %s",
+                    parsed_entry_url.path,
+                )
+            else:
+                new_soup = BeautifulSoup(
+                    base64.b64decode(mobj.group("base64_text")),
+                    features="html.parser",
+                )
+                soup.body.replace_with(new_soup.body)  # type: ignore[arg-type,union-attr]
+        _cleanup_soup(soup, version=epub_version)
+        if (
+            cover_toc_item
+            and cover_toc_item.get("featureImage")
+            and _sanitise_opf_id(parsed_entry_url.path[1:])
+            == _sanitise_opf_id(cover_toc_item["path"])
         ):
-            # we assign it here to ensure that the image referenced in the
-            # toc actually exists
-            cover_img_manifest_id = manifest_entry["id"]
-
-        if not asset_folder.exists():
-            asset_folder.mkdir(parents=True, exist_ok=True)
-        asset_file_path = asset_folder.joinpath(Path(parsed_entry_url.path).name)
-
-        soup = None
-        if asset_file_path.exists():
-            progress_bar.set_description(f"Already saved {asset_file_path.name}")
-            if media_type in ("application/xhtml+xml", "text/html"):
-                with asset_file_path.open("r", encoding="utf-8") as f_asset:
-                    soup = BeautifulSoup(f_asset, features="html.parser")
-        else:
-            progress_bar.set_description(f"Downloading {asset_file_path.name}")
-            # use the libby client session because the required
-            # auth cookies are set there
-            res: requests.Response = libby_client.make_request(
-                entry_url, headers=headers, authenticated=False, return_res=True
+            img_src = os.path.relpath(
+                book_content_folder.joinpath(cover_toc_item["featureImage"]),
+                start=asset_folder,
+            )
+            if is_windows():
+                img_src = Path(img_src).as_posix()
+            # patch the svg based cover for magazines
+            cover_svg = soup.find("svg")
+            if cover_svg:
+                # replace the svg ele with a simple image tag
+                cover_svg.decompose()  # type: ignore[union-attr]
+                for c in soup.body.find_all(recursive=False):  # type: ignore[union-attr]
+                    c.decompose()
+                soup.body.append(  # type: ignore[union-attr]
+                    soup.new_tag("img", attrs={"src": img_src, "alt": "Cover"})
+                )
+                style_ele = soup.new_tag("style")
+                style_ele.append(
+                    "img { max-width: 100%; margin-left: auto; margin-right: auto; }"
+                )
+                soup.head.append(style_ele)  # type: ignore[union-attr]
+
+        return res, soup
+
+    def download_asset(download_url: str, file_path: Path) -> None:
+        """
+        Download an asset referenced in a page
+
+        :param download_url:
+        :param file_path:
+        :return:
+        """
+        res = libby_client.make_request(download_url, return_res=True)
+        save_asset(file_path, res.content)
+
+    # Contents are fetched concurrently but written out in the sorted roster order,
+    # so fonts are still saved before the css that is patched based on them.
+    # Only a window of entries ahead of the one being written out is fetched,
+    # so that fetched responses do not pile up in memory for large rosters.
+    title_content_paths = {
+        book_content_folder.joinpath(urlparse(e["url"]).path[1:])
+        for e in title_content_entries
+    }
+    download_executor = ThreadPoolExecutor(max_workers=args.parallel_downloads)
+    fetch_window = max(1, args.parallel_downloads) * 2
+    pending_entries = iter(title_content_entries)
+    fetch_futures: Deque[Future] = deque()
+    asset_futures: Dict[Path, Future] = {}
+
+    def submit_fetches() -> None:
+        while len(fetch_futures) < fetch_window:
+            pending_entry = next(pending_entries, None)
+            if pending_entry is None:
+                break
+            fetch_futures.append(
+                download_executor.submit(fetch_title_content, pending_entry)
             )
 
-            # patch magazine css to fix various rendering problems
-            if (
-                media_info["type"]["id"] == LibbyMediaTypes.Magazine
-                and media_type == "text/css"
+    def cancel_downloads() -> None:
+        for future in list(fetch_futures) + list(asset_futures.values()):
+            future.cancel()
+        download_executor.shutdown()
+
+    try:
+        for entry in progress_bar:
+            submit_fetches()
+            fetch_future = fetch_futures.popleft()
+            entry_url = entry["url"]
+            parsed_entry_url = urlparse(entry_url)
+            title_content_path = Path(parsed_entry_url.path[1:])
+            media_type = guess_mimetype(title_content_path.name)
+            if not media_type:
+                logger.warning("Skipped roster entry: %s", title_content_path.name)
+                continue
+            asset_folder = book_content_folder.joinpath(title_content_path.parent)
+            if media_type == "application/x-dtbncx+xml":
+                has_ncx = True
+            manifest_entry = {
+                "href": parsed_entry_url.path[1:],
+                "id": (
+                    "ncx"
+                    if media_type == "application/x-dtbncx+xml"
+                    else _sanitise_opf_id(parsed_entry_url.path[1:])
+                ),
+                "media-type": media_type,
+            }
+
+            # try to find cover image for magazines
+            if cover_toc_item and manifest_entry["id"] == _sanitise_opf_id(
+                cover_toc_item["featureImage"]
             ):
-                css_content = patch_magazine_css_overflow_re.sub(r"\1\2", res.text)
-                css_content = patch_magazine_css_padding_re.sub(r"\1\2", css_content)
-                if "#article-body" in css_content:
-                    # patch font-family declarations
-                    # libby declares these font-faces but does not supply them in the roster
-                    # nor are they actually available when viewed online (http 403)
-                    font_families = list(
-                        set(patch_magazine_css_font_re.findall(css_content))
+                # we assign it here to ensure that the image referenced in the
+                # toc actually exists
+                cover_img_manifest_id = manifest_entry["id"]
+
+            if not (epub_writer or asset_folder.exists()):
+                asset_folder.mkdir(parents=True, exist_ok=True)
+            asset_file_path = asset_folder.joinpath(Path(parsed_entry_url.path).name)
+
+            res, soup = fetch_future.result()
+            if res is None:
+                progress_bar.set_description(f"Already saved {asset_file_path.name}")
+                if media_type in ("application/xhtml+xml", "text/html"):
+                    soup = BeautifulSoup(
+                        read_asset(asset_file_path).decode("utf-8"),
+                        features="html.parser",
                     )
-                    for font_family, _ in font_families:
-                        new_font_css = font_family[:-1]
-                        if "Serif" in font_family:
-                            new_font_css += ',Charter,"Bitstream Charter","Sitka Text",Cambria,serif'
-                        elif "Sans" in font_family:
-                            new_font_css += ",system-ui,sans-serif"
-                        new_font_css += ";"
-                        if "-Bold" in font_family:
-                            new_font_css += " font-weight: 700;"
-                        elif "-SemiBold" in font_family:
-                            new_font_css += " font-weight: 600;"
-                        elif "-Light" in font_family:
-                            new_font_css += " font-weight: 300;"
-                        css_content = css_content.replace(font_family, new_font_css)
-                else:
-                    # patch font url declarations
-                    # since ttf/otf files are downloaded ahead of css, we can verify
-                    # if the font files are actually available
-                    try:
-                        font_sources = patch_magazine_css_font_src_re.findall(
-                            css_content
-                        )
-                        for src_match, font_src in font_sources:
-                            asset_font_path = Path(
-                                urljoin(str(asset_file_path), font_src)
-                            )
-                            if not asset_font_path.exists():
-                                css_content = css_content.replace(src_match, "")
-                    except (
-                        Exception  # noqa, pylint: disable=broad-exception-caught
-                    ) as patch_err:
-                        logger.warning(
-                            "Error while patching font sources: %s", patch_err
-                        )
-                with open(asset_file_path, "w", encoding="utf-8") as f_out:
-                    f_out.write(css_content)
-            elif media_type in ("application/xhtml+xml", "text/html"):
-                soup = BeautifulSoup(res.text, features="html.parser")
-                script_ele = soup.find("script", attrs={"type": "text/javascript"})
-                if script_ele and hasattr(script_ele, "string"):
-                    mobj = contents_re.search(script_ele.string or "")
-                    if not mobj:
-                        logger.warning(
-                            "Unable to extract content string for %s",
-                            parsed_entry_url.path,
-                        )
-                    else:
-                        new_soup = BeautifulSoup(
-                            base64.b64decode(mobj.group("base64_text")),
-                            features="html.parser",
-                        )
-                        soup.body.replace_with(new_soup.body)  # type: ignore[arg-type,union-attr]
-                _cleanup_soup(soup, version=epub_version)
+            else:
+                progress_bar.set_description(f"Downloaded {asset_file_path.name}")
+
+                # patch magazine css to fix various rendering problems
                 if (
-                    cover_toc_item
-                    and cover_toc_item.get("featureImage")
-                    and manifest_entry["id"] == _sanitise_opf_id(cover_toc_item["path"])
+                    media_info["type"]["id"] == LibbyMediaTypes.Magazine
+                    and media_type == "text/css"
                 ):
-                    img_src = os.path.relpath(
-                        book_content_folder.joinpath(cover_toc_item["featureImage"]),
-                        start=asset_folder,
+                    css_content = patch_magazine_css_overflow_re.sub(r"\1\2", res.text)
+                    css_content = patch_magazine_css_padding_re.sub(
+                        r"\1\2", css_content
                     )
-                    if is_windows():
-                        img_src = Path(img_src).as_posix()
-                    # patch the svg based cover for magazines
-                    cover_svg = soup.find("svg")
-                    if cover_svg:
-                        # replace the svg ele with a simple image tag
-                        cover_svg.decompose()  # type: ignore[union-attr]
-                        for c in soup.body.find_all(recursive=False):  # type: ignore[union-attr]
-                            c.decompose()
-                        soup.body.append(  # type: ignore[union-attr]
-                            soup.new_tag("img", attrs={"src": img_src, "alt": "Cover"})
+                    if "#article-body" in css_content:
+                        # patch font-family declarations
+                        # libby declares these font-faces but does not supply them in the roster
+                        # nor are they actually available when viewed online (http 403)
+                        font_families = list(
+                            set(patch_magazine_css_font_re.findall(css_content))
                         )
-                        style_ele = soup.new_tag("style")
-                        style_ele.append(
-                            "img { max-width: 100%; margin-left: auto; margin-right: auto; }"
+                        for font_family, _ in font_families:
+                            new_font_css = font_family[:-1]
+                            if "Serif" in font_family:
+                                new_font_css += ',Charter,"Bitstream Charter","Sitka Text",Cambria,serif'
+                            elif "Sans" in font_family:
+                                new_font_css += ",system-ui,sans-serif"
+                            new_font_css += ";"
+                            if "-Bold" in font_family:
+                                new_font_css += " font-weight: 700;"
+                            elif "-SemiBold" in font_family:
+                                new_font_css += " font-weight: 600;"
+                            elif "-Light" in font_family:
+                                new_font_css += " font-weight: 300;"
+                            css_content = css_content.replace(font_family, new_font_css)
+                    else:
+                        # patch font url declarations
+                        # since ttf/otf files are downloaded ahead of css, we can verify
+                        # if the font files are actually available
+                        try:
+                            font_sources = patch_magazine_css_font_src_re.findall(
+                                css_content
+                            )
+                            for src_match, font_src in font_sources:
+                                asset_font_path = Path(
+                                    urljoin(str(asset_file_path), font_src)
+                                )
+                                if not asset_exists(asset_font_path):
+                                    css_content = css_content.replace(src_match, "")
+                        except (
+                            Exception  # noqa, pylint: disable=broad-exception-caught
+                        ) as patch_err:
+                            logger.warning(
+                                "Error while patching font sources: %s", patch_err
+                            )
+                    save_asset(asset_file_path, css_content)
+                elif media_type == "application/x-dtbncx+xml":
+                    save_asset(
+                        asset_file_path,
+                        _patch_ncx_identifier(res.content, book_identifier, logger)
+                        or res.content,
+                    )
+                elif media_type not in ("application/xhtml+xml", "text/html"):
+                    # html pages are saved below after their assets are resolved
+                    save_asset(asset_file_path, res.content)
+
+            # HACK: download css and images to the same asset dir, fix soup
+            # e.g. '<img src="../Image/***_003_r1.jpg" alt="003" class="imgepub" data-loc="60">'
+            # download into "Text/***_003_r1.jpg" and point to filename "***_003_r1.jpg"
+            if soup and media_type in ("application/xhtml+xml", "text/html"):
+                for tag, attrs, tag_target in [
+                    ("img", {"src": True}, "src"),
+                    ("link", {"rel": "stylesheet"}, "href"),
+                ]:
+                    for ele in soup.find_all(tag, attrs=attrs):  # type: ignore[arg-type]
+                        download_url = urlparse(
+                            urljoin(parsed_entry_url.geturl(), ele[tag_target])
+                        ).geturl()
+                        filename = os.path.basename(download_url)
+                        ele[tag_target] = filename
+
+                        file_path = asset_folder.joinpath(filename)
+                        if (
+                            file_path in asset_futures
+                            or file_path in title_content_paths
+                            or asset_exists(file_path)
+                        ):
+                            continue
+                        logger.info(f"Downloading {download_url} to {file_path}")
+                        asset_futures[file_path] = download_executor.submit(
+                            download_asset, download_url, file_path
                         )
-                        soup.head.append(style_ele)  # type: ignore[union-attr]
+                if res is not None:
+                    # save the page with the updated soup
+                    save_asset(asset_file_path, str(soup))
 
-                with open(asset_file_path, "w", encoding="utf-8") as f_out:
-                    f_out.write(str(soup))
-            else:
-                with open(asset_file_path, "wb") as f_out:
-                    f_out.write(res.content)
-
-        # HACK: download css and images to the same asset dir, fix soup
-        # e.g. '<img src="../Image/***_003_r1.jpg" alt="003" class="imgepub" data-loc="60">'
-        # download into "Text/***_003_r1.jpg" and point to filename "***_003_r1.jpg"
-        if soup and media_type in ("application/xhtml+xml", "text/html"):
-            for tag, attrs, tag_target in [
-                ("img", {"src": True}, "src"),
-                ("link", {"rel": "stylesheet"}, "href"),
-            ]:
-                for ele in soup.find_all(tag, attrs=attrs):  # type: ignore[arg-type]
-                    download_url = urlparse(
-                        urljoin(parsed_entry_url.geturl(), ele[tag_target])
-                    ).geturl()
-                    filename = os.path.basename(download_url)
-                    ele[tag_target] = filename
-
-                    file_path = asset_folder.joinpath(filename)
-                    if not file_path.exists():
-                        logger.info(f"Downloading {download_url} to {file_path}")
-                        res = libby_client.make_request(download_url, return_res=True)
-                        with open(file_path, "wb") as f_out:
-                            f_out.write(res.content)
-            # overwrite the file with the updated soup
-            with open(asset_file_path, "w", encoding="utf-8") as f_out:
-                f_out.write(str(soup))
-
-        if soup:
-            # try to min. soup searches where possible
-            if (
-                (not cover_img_manifest_id)
-                and cover_page_landmark
-                and cover_page_landmark["path"] == parsed_entry_url.path[1:]
-            ):
-                # try to find cover image for the book from the cover html content
-                cover_image = soup.find("img", attrs={"src": True})
-                if cover_image:
-                    cover_img_manifest_id = _sanitise_opf_id(
-                        urljoin(cover_page_landmark["path"], cover_image["src"])  # type: ignore[index]
-                    )
-            elif (not has_nav) and soup.find(attrs={"epub:type": "toc"}):
-                # identify nav page
-                manifest_entry["properties"] = "nav"
-                has_nav = True
-            elif soup.find("svg"):
-                # page has svg
-                manifest_entry["properties"] = "svg"
-
-        if cover_img_manifest_id == manifest_entry["id"]:
-            manifest_entry["properties"] = "cover-image"
-        manifest_entries.append(manifest_entry)
-        if manifest_entry.get("properties") == "cover-image" and cover_path:
-            # replace the cover image already downloaded via the OD api, in case it is to be kept
-            shutil.copyfile(asset_file_path, cover_path)
+            if soup:
+                # try to min. soup searches where possible
+                if (
+                    (not cover_img_manifest_id)
+                    and cover_page_landmark
+                    and cover_page_landmark["path"] == parsed_entry_url.path[1:]
+                ):
+                    # try to find cover image for the book from the cover html content
+                    cover_image = soup.find("img", attrs={"src": True})
+                    if cover_image:
+                        cover_img_manifest_id = _sanitise_opf_id(
+                            urljoin(cover_page_landmark["path"], cover_image["src"])  # type: ignore[index]
+                        )
+                elif (not has_nav) and soup.find(attrs={"epub:type": "toc"}):
+                    # identify nav page
+                    manifest_entry["properties"] = "nav"
+                    has_nav = True
+                elif soup.find("svg"):
+                    # page has svg
+                    manifest_entry["properties"] = "svg"
+
+            if cover_img_manifest_id == manifest_entry["id"]:
+                manifest_entry["properties"] = "cover-image"
+            manifest_entries.append(manifest_entry)
+            if manifest_entry.get("properties") == "cover-image" and cover_path:
+                # replace the cover image already downloaded via the OD api, in case it is to be kept
+                cover_path.write_bytes(read_asset(asset_file_path))
+        for asset_future in asset_futures.values():
+            asset_future.result()
+    except BaseException:
+        cancel_downloads()
+        if epub_writer:
+            # keep the partial epub readable so that it can be resumed
+            epub_writer.close()
+        raise
+    finally:
+        cancel_downloads()
 
     if not has_nav:
         # Generate nav - needed for magazines
@@ -737,10 +1039,7 @@ def process_ebook_loan(
             li_ele.append(ol_ele)
             toc_ele.append(li_ele)  # type: ignore[union-attr]
 
-        with book_content_folder.joinpath(nav_file_name).open(
-            "w", encoding="utf-8"
-        ) as f_nav:
-            f_nav.write(str(nav_soup).strip())
+        save_asset(book_content_folder.joinpath(nav_file_name), str(nav_soup).strip())
         manifest_entries.append(
             {
                 "href": nav_file_name,
@@ -756,11 +1055,9 @@ def process_ebook_loan(
         # we give the ncx an id-stamped file name to avoid accidentally overwriting
         # an existing file name
         toc_ncx_name = f'toc_{loan["id"]}.ncx'
-        tree = ET.ElementTree(ncx)
-        tree.write(
+        save_asset(
             book_content_folder.joinpath(toc_ncx_name),
-            xml_declaration=True,
-            encoding="utf-8",
+            ET.tostring(ncx, encoding="utf-8", xml_declaration=True),
         )
         manifest_entries.append(
             {
@@ -770,48 +1067,6 @@ def process_ebook_loan(
             }
         )
         has_ncx = True
-    else:
-        # EPUB3 compliance: Ensure that the identifier in ncx matches the one in the OPF
-        # Mismatch due to the toc.ncx being supplied by publisher
-        ncx_manifest_entry = next(
-            iter([m for m in manifest_entries if m["id"] == "ncx"]), None
-        )
-        if ncx_manifest_entry:
-            expected_book_identifier = (
-                extract_isbn(
-                    media_info["formats"],
-                    format_types=[
-                        (
-                            LibbyFormats.MagazineOverDrive
-                            if loan["type"]["id"] == LibbyMediaTypes.Magazine
-                            else LibbyFormats.EBookOverdrive
-                        )
-                    ],
-                )
-                or media_info["id"]
-            )  # this is the summarised logic from build_opf_package
-            ncx_path = book_content_folder.joinpath(ncx_manifest_entry["href"])
-            new_ncx_contents = None
-            with ncx_path.open("r", encoding="utf-8") as ncx_f:
-                ncx_soup = BeautifulSoup(ncx_f, features="xml")
-                meta_id = ncx_soup.find("meta", attrs={"name": "dtb:uid"})
-                if (
-                    meta_id
-                    and isinstance(meta_id, Tag)
-                    and meta_id.get("content")
-                    and meta_id["content"] != expected_book_identifier
-                ):
-                    logger.debug(
-                        'Replacing identifier in %s: "%s" -> "%s"',
-                        ncx_path.name,
-                        meta_id["content"],
-                        expected_book_identifier,
-                    )
-                    meta_id["content"] = expected_book_identifier
-                    new_ncx_contents = str(ncx_soup)
-            if new_ncx_contents:
-                with ncx_path.open("w", encoding="utf-8") as ncx_f:
-                    ncx_f.write(new_ncx_contents)
 
     # create epub OPF
     opf_file_name = "package.opf"
@@ -856,7 +1111,9 @@ def process_ebook_loan(
         # we give the cover a timestamped file name to avoid accidentally overwriting
         # an existing file name
         cover_image_name = f"cover_{int(datetime.datetime.now().timestamp())}.jpg"
-        shutil.copyfile(cover_path, book_content_folder.joinpath(cover_image_name))
+        save_asset(
+            book_content_folder.joinpath(cover_image_name), cover_path.read_bytes()
+        )
         cover_img_manifest_id = "coverimage"
         ET.SubElement(
             manifest,
@@ -925,15 +1182,15 @@ def process_ebook_loan(
     if args.is_debug_mode:
         from xml.dom import minidom
 
-        with opf_file_path.open("w", encoding="utf-8") as f:
-            f.write(
-                minidom.parseString(ET.tostring(package, "utf-8")).toprettyxml(
-                    indent="\t"
-                )
-            )
+        save_asset(
+            opf_file_path,
+            minidom.parseString(ET.tostring(package, "utf-8")).toprettyxml(indent="\t"),
+        )
     else:
-        tree = ET.ElementTree(package)
-        tree.write(opf_file_path, xml_declaration=True, encoding="utf-8")
+        save_asset(
+            opf_file_path,
+            ET.tostring(package, encoding="utf-8", xml_declaration=True),
+        )
     logger.debug('Saved "%s"', opf_file_path)
 
     # create container.xml
@@ -955,30 +1212,35 @@ def process_ebook_loan(
             "media-type": "application/oebps-package+xml",
         },
     )
-    tree = ET.ElementTree(container)
-    tree.write(container_file_path, xml_declaration=True, encoding="utf-8")
+    save_asset(
+        container_file_path,
+        ET.tostring(container, encoding="utf-8", xml_declaration=True),
+    )
     logger.debug('Saved "%s"', container_file_path)
 
-    # create epub zip
-    with zipfile.ZipFile(
-        epub_file_path, mode="w", compression=zipfile.ZIP_DEFLATED
-    ) as epub_zip:
-        epub_zip.writestr(
-            "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
-        )
-        for root_start in (book_meta_folder, book_content_folder):
-            for p in root_start.glob("**/*"):
-                if p.is_dir():
-                    continue
-                zip_archive_file = p.relative_to(book_folder)
-                # using posix path because zipfile requires "/" separators
-                # and may break on Windows otherwise
-                zip_archive_name = zip_archive_file.as_posix()
-                zip_target_file = book_folder.joinpath(zip_archive_file)
-                epub_zip.write(zip_target_file, zip_archive_name)
-                logger.debug(
-                    'epub: Added "%s" as "%s"', zip_target_file, zip_archive_name
-                )
+    if epub_writer:
+        epub_writer.finalize()
+    else:
+        # create epub zip
+        with zipfile.ZipFile(
+            epub_file_path, mode="w", compression=zipfile.ZIP_DEFLATED
+        ) as epub_zip:
+            epub_zip.writestr(
+                "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
+            )
+            for root_start in (book_meta_folder, book_content_folder):
+                for p in root_start.glob("**/*"):
+                    if p.is_dir():
+                        continue
+                    zip_archive_file = p.relative_to(book_folder)
+                    # using posix path because zipfile requires "/" separators
+                    # and may break on Windows otherwise
+                    zip_archive_name = zip_archive_file.as_posix()
+                    zip_target_file = book_folder.joinpath(zip_archive_file)
+                    epub_zip.write(zip_target_file, zip_archive_name)
+                    logger.debug(
+                        'epub: Added "%s" as "%s"', zip_target_file, zip_archive_name
+                    )
     logger.info('Saved "%s"', colored(str(epub_file_path), "magenta", attrs=["bold"]))
 
     # clean up
@@ -24,39 +24,28 @@ import json
 import logging
 import math
 import re
-import shutil
 import uuid
 import xml.etree.ElementTree as ET
 from collections import OrderedDict
 from functools import reduce
 from html import unescape as unescape_html
 from pathlib import Path
-from typing import Any, Union, Dict, List, Optional
+from typing import Any, Union, Dict, List, Optional, NamedTuple, Tuple
 
-import eyed3  # type: ignore[import]
-from eyed3.id3 import ID3_DEFAULT_VERSION, ID3_V2_3, ID3_V2_4  # type: ignore[import]
 from requests.exceptions import HTTPError, ConnectionError
 from termcolor import colored
-from tqdm import tqdm
-
-from .shared import (
-    generate_names,
-    write_tags,
-    generate_cover,
-    remux_mp3,
-    merge_into_mp3,
-    convert_to_m4b,
-    create_opf,
-    init_session,
-)
+
 from ..cli_utils import OdmpyCommands
 from ..constants import OMC, OS, UA, UNSUPPORTED_PARSER_ENTITIES, UA_LONG
 from ..errors import OdmpyRuntimeError
+from ..http_cache import get_cache
 from ..libby import USER_AGENT
+from ..mp3 import Mp3StreamAnalyzer
 from ..overdrive import OverDriveClient
+from ..sessions import get_session
+from ..state import get_state
 from ..utils import (
     slugify,
-    mp3_duration_ms,
     parse_duration_to_seconds,
     parse_duration_to_milliseconds,
     get_element_text,
@@ -72,6 +61,46 @@ RESERVE_ID_RE = re.compile(
 #
 
 
+class _ProcessedPart(NamedTuple):
+    """
+    Information collected from a downloaded part by the post-processing workers
+    """
+
+    # (marker name, timestamp in ms)
+    markers: List[Tuple[str, int]]
+    audio_bitrate: Optional[int] = None
+    time_secs: Optional[float] = None
+    audio_length_ms: Optional[int] = None
+    is_tagged: bool = True
+
+
+def _parse_media_markers(frame_text: str) -> List[Tuple[str, int]]:
+    """
+    Parse the OverDrive MediaMarkers ID3 user text.
+
+    :param frame_text:
+    :return: List of (marker name, timestamp in ms)
+    """
+    markers: List[Tuple[str, int]] = []
+    if not frame_text:
+        return markers
+    frame_text = re.sub(r"\s&\s", " &amp; ", frame_text)
+    try:
+        tree = ET.fromstring(frame_text)
+    except UnicodeEncodeError:
+        tree = ET.fromstring(frame_text.encode("ascii", "ignore").decode("ascii"))
+    except ET.ParseError:
+        tree = ET.fromstring(_patch_for_parse_error(frame_text))
+
+    for marker in tree.iter("Marker"):  # type: ET.Element
+        marker_name = get_element_text(marker.find("Name")).strip()
+        marker_timestamp = get_element_text(marker.find("Time"))
+
+        # 2 timestamp formats found ("%M:%S.%f", "%H:%M:%S.%f")
+        markers.append((marker_name, parse_duration_to_milliseconds(marker_timestamp)))
+    return markers
+
+
 def _patch_for_parse_error(text: str) -> str:
     # [TODO]: Find a more generic solution instead of patching entities, maybe lxml?
     # Ref: https://github.com/ping/odmpy/issues/19
@@ -92,6 +121,7 @@ def process_odm(
     args: argparse.Namespace,
     logger: logging.Logger,
     cleanup_odm_license: bool = False,
+    od_client: Optional[OverDriveClient] = None,
 ) -> Dict:
     """
     Download the audiobook loan using the specified odm file
@@ -101,8 +131,34 @@ def process_odm(
     :param args:
     :param logger:
     :param cleanup_odm_license:
+    :param od_client: Shared client with prefetched media
     :return:
     """
+    # eyed3, tqdm, etc. are only needed to download, so `odmpy ret` does not load them
+    import eyed3  # type: ignore[import]
+    from eyed3.id3 import ID3_DEFAULT_VERSION, ID3_V2_3, ID3_V2_4  # type: ignore[import]
+
+    from .shared import (
+        generate_names,
+        write_tags,
+        generate_cover,
+        remux_mp3,
+        finalize_mp3,
+        get_header_reserve,
+        ID3TagTemplate,
+        merge_into_mp3,
+        TagOnlyFile,
+        Mp3File,
+        estimate_id3_padding,
+        merge_into_m4b,
+        build_m4b_metadata,
+        create_opf,
+        init_session,
+        find_saved_output,
+        PartDownload,
+        download_part_files,
+    )
+
     if not odm_file:
         logger.warning("No odm file specified.")
         return
@@ -260,7 +316,10 @@ def process_odm(
 
         return json.dumps(result)
 
-    session = init_session(max_retries=args.retries)
+    session = init_session(
+        max_retries=args.retries,
+        pool_maxsize=args.parallel_downloads * args.download_segments,
+    )
 
     # Download Book
     download_baseurl = ""
@@ -295,21 +354,23 @@ def process_odm(
         logger=logger,
     )
     book_m4b_filename = book_filename.with_suffix(".m4b")
+    loan_id = loan.get("id") or overdrive_media_id
+    state = get_state(getattr(args, "state_db", ""))
 
     # check early if a merged file is already saved
-    if (
-        args.merge_output
-        and (
-            book_filename if args.merge_format == "mp3" else book_m4b_filename
-        ).exists()
-    ):
-        logger.warning(
-            'Already saved "%s"',
-            colored(
-                str(book_filename if args.merge_format == "mp3" else book_m4b_filename),
-                "magenta",
-            ),
+    saved_filename = (
+        find_saved_output(
+            state,
+            loan_id,
+            args.merge_format,
+            book_filename if args.merge_format == "mp3" else book_m4b_filename,
+            title,
         )
+        if args.merge_output
+        else None
+    )
+    if saved_filename:
+        logger.warning('Already saved "%s"', colored(str(saved_filename), "magenta"))
         if cleanup_odm_license and odm_file.exists():
             try:
                 odm_file.unlink()
@@ -369,9 +430,9 @@ def process_odm(
         )
         try:
             license_res.raise_for_status()
-            with license_file.open("wb") as outfile:
+            with license_file.open("wb") as license_outfile:
                 for chunk in license_res.iter_content(1024):
-                    outfile.write(chunk)
+                    license_outfile.write(chunk)
             logger.debug(f"Saved license file {license_file}")
 
         except HTTPError as he:
@@ -409,63 +470,214 @@ def process_odm(
     keep_cover = args.always_keep_cover
     audio_lengths_ms = []
     audio_bitrate = 0
+
+    part_filenames: List[Path] = []
+    pending_part_filenames: List[Path] = []
+    part_downloads: List[PartDownload] = []
+    # text frame values of the tags, to estimate the space that the tags need
+    tag_texts = (
+        [title, sub_title, publisher, description, series, overdrive_media_id]
+        + authors
+        + (narrators or [])
+        + (subjects or [])
+        + (languages or [])
+    )
+    saved_parts = state.get_parts(loan_id) if state else {}
     for p in download_parts:
         part_number = int(p["number"])
+        saved_part = saved_parts.get(part_number)
+        if state and saved_part and state.verify_part(loan_id, part_number, saved_part):
+            # saved in an earlier run, possibly with a different book folder format
+            part_filenames.append(saved_part.path)
+            continue
         part_filename = book_folder.joinpath(
             f"{slugify(f'{title} - Part {part_number:02d}', allow_unicode=True)}.mp3"
         )
-        part_tmp_filename = part_filename.with_suffix(".part")
-        part_file_size = int(p["filesize"])
-        part_url_filename = p["filename"]
-        part_download_url = f"{download_baseurl}/{part_url_filename}"
-        part_markers = []
+        part_filenames.append(part_filename)
+        is_changed = bool(saved_part and saved_part.path == part_filename.absolute())
+        if is_changed:
+            logger.warning(
+                "Saved part %s has changed and will be downloaded again",
+                colored(str(part_filename), "magenta"),
+            )
+        if is_changed or not part_filename.exists():
+            pending_part_filenames.append(part_filename)
+            part_downloads.append(
+                PartDownload(
+                    url=f"{download_baseurl}/{p['filename']}",
+                    tmp_filename=part_filename.with_suffix(".part"),
+                    file_size=int(p["filesize"]),
+                    label=f"Part {part_number:2d}",
+                    analyzer=Mp3StreamAnalyzer(logger),
+                    # so that the part can be tagged in place when finalized
+                    header_reserve=estimate_id3_padding(
+                        cover_bytes=cover_bytes,
+                        texts=tag_texts,
+                        chapter_titles=[],
+                    ),
+                )
+            )
 
-        if part_filename.exists():
-            logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
-        else:
-            try:
-                already_downloaded_len = 0
-                if part_tmp_filename.exists():
-                    already_downloaded_len = part_tmp_filename.stat().st_size
-
-                part_download_res = session.get(
-                    part_download_url,
-                    headers={
-                        "User-Agent": UA,
-                        "ClientID": license_client_id,
-                        "License": lic_file_contents,
-                        "Range": (
-                            f"bytes={already_downloaded_len}-"
-                            if already_downloaded_len
-                            else None
-                        ),
-                    },
-                    timeout=args.timeout,
-                    stream=True,
+    # the tag frames common to all parts are only rendered once
+    tag_template = ID3TagTemplate(
+        version=id3v2_version,
+        title=title,
+        sub_title=sub_title,
+        authors=authors,
+        narrators=narrators,
+        publisher=publisher,
+        description=description,
+        cover_bytes=cover_bytes,
+        genres=subjects,
+        languages=languages,
+        published_date=None,  # odm does not contain date info
+        series=series,
+        overdrive_id=overdrive_media_id,
+        always_overwrite=args.overwrite_tags,
+        delimiter=args.tag_delimiter,
+    )
+
+    def post_process_part(index: int, part_tmp_filename: Path) -> _ProcessedPart:
+        """
+        Remux, tag and extract the OverDrive markers from a downloaded part.
+        This runs in a worker thread while other parts are still downloading.
+        Chapters are not added here because the chapter IDs depend on
+        the number of markers in the preceding parts.
+
+        :param index: Index of the part in `pending_part_filenames`
+        :param part_tmp_filename:
+        :return:
+        """
+        part_filename = pending_part_filenames[index]
+        part_number = part_filenames.index(part_filename) + 1
+        analyzer = part_downloads[index].analyzer
+        mp3_info = analyzer.info() if analyzer else None
+        if not mp3_info:
+            # try to remux file to remove mp3 lame tag errors
+            remux_mp3(
+                part_tmp_filename=part_tmp_filename,
+                part_filename=part_filename,
+                ffmpeg_loglevel=ffmpeg_loglevel,
+                logger=logger,
+            )
+
+        processed_part = _ProcessedPart(markers=[])
+        # Save id3 info only on new download, ref #42
+        # This also makes handling of part files consistent with merged files
+        try:
+            # Fill id3 info for mp3 part
+            # if the audio was already analyzed during the download, only the tag
+            # is parsed, and the tag template is applied when finalizing the part
+            audiofile = (
+                Mp3File(
+                    part_tmp_filename,
+                    info=mp3_info,
+                    offset=get_header_reserve(part_tmp_filename),
+                )
+                if mp3_info
+                else Mp3File(part_filename)
+            )
+            # Notes: Can't use eyed3 (audiofile.info.time_secs) for the length
+            # because it is completely off by about 10-20 seconds.
+            # Also, can't rely on `p["duration"]` because it is also often off
+            # by about 1 second.
+            processed_part = processed_part._replace(
+                audio_bitrate=audiofile.info.bitrate,
+                time_secs=audiofile.info.duration_ms / 1000,
+                audio_length_ms=audiofile.info.duration_ms,
+            )
+
+            if not mp3_info:
+                tag_template.write_tags(
+                    audiofile, part_number=part_number, total_parts=len(download_parts)
+                )
+                audiofile.tag.save(version=id3v2_version)
+
+            # Extract OD chapter info from mp3s for use in merged file
+            if audiofile.info.user_texts is not None:
+                processed_part.markers.extend(
+                    _parse_media_markers(
+                        audiofile.info.user_texts.get("OverDrive MediaMarkers", "")
+                    )
+                )
+            elif audiofile.tag:
+                for frame in audiofile.tag.frame_set.get(
+                    eyed3.id3.frames.USERTEXT_FID, []
+                ):
+                    if frame.description != "OverDrive MediaMarkers":
+                        continue
+                    processed_part.markers.extend(_parse_media_markers(frame.text))
+                    break
+
+            if mp3_info:
+                id3_padding = 0
+                if args.add_chapters and not args.merge_output:
+                    # leave room for the chapters that are added later
+                    id3_padding = estimate_id3_padding(
+                        None, [], [name for name, _ in processed_part.markers]
+                    )
+                finalize_mp3(
+                    part_tmp_filename=part_tmp_filename,
+                    part_filename=part_filename,
+                    mp3_info=mp3_info,
+                    tag_data=tag_template.render(
+                        audiofile.tag,
+                        part_number=part_number,
+                        total_parts=len(download_parts),
+                        padding=id3_padding,
+                    ),
                 )
-                part_download_res.raise_for_status()
-
-                with tqdm.wrapattr(
-                    part_download_res.raw,
-                    "read",
-                    total=part_file_size,
-                    initial=already_downloaded_len,
-                    desc=f"Part {part_number:2d}",
-                    disable=args.hide_progress,
-                ) as res_raw:
-                    with part_tmp_filename.open(
-                        "ab" if already_downloaded_len else "wb"
-                    ) as outfile:
-                        shutil.copyfileobj(res_raw, outfile)
-
-                # try to remux file to remove mp3 lame tag errors
+
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(
+                "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
+            )
+            if part_tmp_filename.exists():
+                # not finalized, so fall back to remuxing the part as downloaded
                 remux_mp3(
                     part_tmp_filename=part_tmp_filename,
                     part_filename=part_filename,
                     ffmpeg_loglevel=ffmpeg_loglevel,
                     logger=logger,
                 )
+            return processed_part._replace(is_tagged=False)
+
+        return processed_part
+
+    # parts are downloaded and post-processed concurrently, but the results
+    # are returned in order so that chapter numbering (track_count)
+    # and audio_lengths_ms stay in sequence
+    processed_parts = download_part_files(
+        session=session,
+        part_downloads=part_downloads,
+        headers={
+            "User-Agent": UA,
+            "ClientID": license_client_id,
+            "License": lic_file_contents,
+        },
+        timeout=args.timeout,
+        parallel=args.parallel_downloads,
+        hide_progress=args.hide_progress,
+        post_process=post_process_part,
+        segments=args.download_segments,
+        resume_retries=args.resume_retries,
+        logger=logger,
+        min_rate=args.min_speed * 1024,
+        rate_window=args.min_speed_window,
+    )
+
+    for p, part_filename in zip(download_parts, part_filenames):
+        part_number = int(p["number"])
+        part_markers = []
 
+        if part_filename not in pending_part_filenames:
+            logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
+            if state and part_number not in saved_parts:
+                # saved before the state was in use
+                state.set_part(loan_id, part_number, part_filename)
+        else:
+            try:
+                processed_part: _ProcessedPart = next(processed_parts)
             except HTTPError as he:
                 if he.response is not None:
                     logger.error(f"HTTPError: {str(he)}")
@@ -476,73 +688,24 @@ def process_odm(
                 logger.error(f"ConnectionError: {str(ce)}")
                 raise OdmpyRuntimeError("Connection Error while downloading part file.")
 
-            # Save id3 info only on new download, ref #42
-            # This also makes handling of part files consistent with merged files
-            try:
-                # Fill id3 info for mp3 part
-                audiofile: eyed3.core.AudioFile = eyed3.load(part_filename)
-                _, audio_bitrate = audiofile.info.bit_rate
-
-                write_tags(
-                    audiofile=audiofile,
-                    title=title,
-                    sub_title=sub_title,
-                    authors=authors,
-                    narrators=narrators,
-                    publisher=publisher,
-                    description=description,
-                    cover_bytes=cover_bytes,
-                    genres=subjects,
-                    languages=languages,
-                    published_date=None,  # odm does not contain date info
-                    series=series,
-                    part_number=part_number,
-                    total_parts=len(download_parts),
-                    overdrive_id=overdrive_media_id,
-                    always_overwrite=args.overwrite_tags,
-                    delimiter=args.tag_delimiter,
-                )
-                audiofile.tag.save(version=id3v2_version)
-
-                # Notes: Can't switch over to using eyed3 (audiofile.info.time_secs)
-                # because it is completely off by about 10-20 seconds.
-                # Also, can't rely on `p["duration"]` because it is also often off
-                # by about 1 second.
-                audio_lengths_ms.append(mp3_duration_ms(part_filename))
-
-                # Extract OD chapter info from mp3s for use in merged file
-                for frame in audiofile.tag.frame_set.get(
-                    eyed3.id3.frames.USERTEXT_FID, []
-                ):
-                    if frame.description != "OverDrive MediaMarkers":
-                        continue
-                    if frame.text:
-                        frame_text = re.sub(r"\s&\s", " &amp; ", frame.text)
-                        try:
-                            tree = ET.fromstring(frame_text)
-                        except UnicodeEncodeError:
-                            tree = ET.fromstring(
-                                frame_text.encode("ascii", "ignore").decode("ascii")
-                            )
-                        except ET.ParseError:
-                            tree = ET.fromstring(_patch_for_parse_error(frame_text))
-
-                        for marker in tree.iter("Marker"):  # type: ET.Element
-                            marker_name = get_element_text(marker.find("Name")).strip()
-                            marker_timestamp = get_element_text(marker.find("Time"))
-
-                            # 2 timestamp formats found ("%M:%S.%f", "%H:%M:%S.%f")
-                            ts_mark = parse_duration_to_milliseconds(marker_timestamp)
-                            track_count += 1
-                            part_markers.append(
-                                (f"ch{track_count:02d}", marker_name, ts_mark)
-                            )
-                    break
+            if processed_part.audio_bitrate is not None:
+                audio_bitrate = processed_part.audio_bitrate
+            if processed_part.audio_length_ms is not None:
+                audio_lengths_ms.append(processed_part.audio_length_ms)
+            for marker_name, ts_mark in processed_part.markers:
+                track_count += 1
+                part_markers.append((f"ch{track_count:02d}", marker_name, ts_mark))
+            if not processed_part.is_tagged:
+                keep_cover = True
 
+            try:
+                part_tag = eyed3.id3.Tag()
                 if (
-                    args.add_chapters
+                    processed_part.is_tagged
+                    and args.add_chapters
                     and not args.merge_output
-                    and (args.overwrite_tags or not audiofile.tag.table_of_contents)
+                    and part_tag.parse(str(part_filename))
+                    and (args.overwrite_tags or not part_tag.table_of_contents)
                 ):
                     # set the chapter marks
                     generated_markers: List[Dict[str, Union[str, int]]] = []
@@ -553,20 +716,20 @@ def process_odm(
                                 "text": file_marker[1],
                                 "start_time": int(file_marker[2]),
                                 "end_time": int(
-                                    round(audiofile.info.time_secs * 1000)
+                                    round((processed_part.time_secs or 0) * 1000)
                                     if j == (len(part_markers) - 1)
                                     else part_markers[j + 1][2]
                                 ),
                             }
                         )
 
-                    if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    if args.overwrite_tags and part_tag.table_of_contents:
                         # Clear existing toc to prevent "There may only be one top-level table of contents.
                         # Toc 'b'toc'' is current top-level." error
-                        for f in list(audiofile.tag.table_of_contents):
-                            audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+                        for f in list(part_tag.table_of_contents):
+                            part_tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
 
-                    toc = audiofile.tag.table_of_contents.set(
+                    toc = part_tag.table_of_contents.set(
                         "toc".encode("ascii"),
                         toplevel=True,
                         ordered=True,
@@ -580,7 +743,7 @@ def process_odm(
                             eyed3.id3.frames.TITLE_FID, str(gm["text"])
                         )
 
-                        chap = audiofile.tag.chapters.set(
+                        chap = part_tag.chapters.set(
                             str(gm["id"]).encode("ascii"),
                             times=(gm["start_time"], gm["end_time"]),
                             sub_frames=title_frameset,
@@ -601,7 +764,7 @@ def process_odm(
                             colored(str(part_filename), "blue"),
                         )
 
-                    audiofile.tag.save(version=id3v2_version)
+                    part_tag.save(version=id3v2_version)
 
             except Exception as e:  # pylint: disable=broad-except
                 logger.warning(
@@ -609,6 +772,8 @@ def process_odm(
                 )
                 keep_cover = True
 
+            if state:
+                state.set_part(loan_id, part_number, part_filename)
             logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
 
         file_tracks.append(
@@ -617,7 +782,8 @@ def process_odm(
                 "markers": part_markers,
             }
         )
-    # end loop: for p in download_parts:
+    # end loop: for part_filename in part_filenames:
+    processed_parts.close()
 
     debug_meta["audio_lengths_ms"] = audio_lengths_ms
     debug_meta["file_tracks"] = [
@@ -633,41 +799,8 @@ def process_odm(
             ),
         )
 
-        merge_into_mp3(
-            book_filename=book_filename,
-            file_tracks=file_tracks,
-            audio_bitrate=audio_bitrate,
-            ffmpeg_loglevel=ffmpeg_loglevel,
-            hide_progress=args.hide_progress,
-            logger=logger,
-        )
-
-        audiofile = eyed3.load(book_filename)
-        write_tags(
-            audiofile=audiofile,
-            title=title,
-            sub_title=sub_title,
-            authors=authors,
-            narrators=narrators,
-            publisher=publisher,
-            description=description,
-            cover_bytes=cover_bytes,
-            genres=subjects,
-            languages=languages,
-            published_date=None,  # odm does not contain date info
-            series=series,
-            part_number=0,
-            total_parts=0,
-            overdrive_id=overdrive_media_id,
-            overwrite_title=True,
-            always_overwrite=args.overwrite_tags,
-            delimiter=args.tag_delimiter,
-        )
-
-        if args.add_chapters and (
-            args.overwrite_tags or not audiofile.tag.table_of_contents
-        ):
-            merged_markers: List[Dict[str, Union[str, int]]] = []
+        merged_markers: List[Dict[str, Union[str, int]]] = []
+        if args.add_chapters:
             for i, f in enumerate(file_tracks):
                 prev_tracks_len_ms = (
                     0 if i == 0 else reduce(lambda x, y: x + y, audio_lengths_ms[0:i])
@@ -691,65 +824,126 @@ def process_odm(
                     )
             debug_meta["merged_markers"] = merged_markers
 
-            if args.overwrite_tags and audiofile.tag.table_of_contents:
-                # Clear existing toc to prevent "There may only be one top-level table of contents.
-                # Toc 'b'toc'' is current top-level." error
-                for f in list(audiofile.tag.table_of_contents):
-                    audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-            toc = audiofile.tag.table_of_contents.set(
-                "toc".encode("ascii"),
-                toplevel=True,
-                ordered=True,
-                child_ids=[],
-                description="Table of Contents",
-            )
-
-            for mm in merged_markers:  # type: Dict[str, Union[str, int]]
-                title_frameset = eyed3.id3.frames.FrameSet()
-                title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, mm["text"])
-                chap = audiofile.tag.chapters.set(
-                    str(mm["id"]).encode("ascii"),
-                    times=(mm["start_time"], mm["end_time"]),
-                    sub_frames=title_frameset,
-                )
-                toc.child_ids.append(chap.element_id)
-                start_time = datetime.timedelta(milliseconds=float(mm["start_time"]))
-                end_time = datetime.timedelta(milliseconds=float(mm["end_time"]))
-                logger.debug(
-                    'Added chap tag => %s: %s-%s "%s" to "%s"',
-                    colored(str(mm["id"]), "cyan"),
-                    start_time,
-                    end_time,
-                    colored(str(mm["text"]), "cyan"),
-                    colored(str(book_filename), "blue"),
-                )
-
-        audiofile.tag.save(version=id3v2_version)
-
-        if args.merge_format == "mp3":
-            logger.info(
-                'Merged files into "%s"',
-                colored(
-                    str(
-                        book_filename
-                        if args.merge_format == "mp3"
-                        else book_m4b_filename
-                    ),
-                    "magenta",
-                ),
-            )
-
         if args.merge_format == "m4b":
-            convert_to_m4b(
-                book_filename=book_filename,
+            # generate the m4b directly from the parts in a single pass
+            merge_into_m4b(
                 book_m4b_filename=book_m4b_filename,
+                file_tracks=file_tracks,
                 cover_filename=cover_filename,
+                metadata=build_m4b_metadata(
+                    title=title,
+                    sub_title=sub_title,
+                    authors=authors,
+                    narrators=narrators,
+                    publisher=publisher,
+                    description=description,
+                    genres=subjects,
+                    languages=languages,
+                    published_date=None,  # odm does not contain date info
+                    series=series,
+                    overdrive_id=overdrive_media_id,
+                    delimiter=args.tag_delimiter,
+                ),
+                chapters=[
+                    (str(mm["text"]), int(mm["start_time"]), int(mm["end_time"]))
+                    for mm in merged_markers
+                ],
                 merge_codec=args.merge_codec,
                 audio_bitrate=audio_bitrate,
                 ffmpeg_loglevel=ffmpeg_loglevel,
                 hide_progress=args.hide_progress,
                 logger=logger,
+                jobs=args.merge_jobs,
+            )
+        else:
+            merge_into_mp3(
+                book_filename=book_filename,
+                file_tracks=file_tracks,
+                audio_bitrate=audio_bitrate,
+                ffmpeg_loglevel=ffmpeg_loglevel,
+                hide_progress=args.hide_progress,
+                logger=logger,
+                id3_padding=estimate_id3_padding(
+                    cover_bytes=cover_bytes,
+                    texts=tag_texts,
+                    chapter_titles=[str(mm["text"]) for mm in merged_markers],
+                ),
+            )
+
+            # only the tag is read and it is written in place within the reserved padding
+            audiofile = TagOnlyFile(book_filename)
+            write_tags(
+                audiofile=audiofile,
+                title=title,
+                sub_title=sub_title,
+                authors=authors,
+                narrators=narrators,
+                publisher=publisher,
+                description=description,
+                cover_bytes=cover_bytes,
+                genres=subjects,
+                languages=languages,
+                published_date=None,  # odm does not contain date info
+                series=series,
+                part_number=0,
+                total_parts=0,
+                overdrive_id=overdrive_media_id,
+                overwrite_title=True,
+                always_overwrite=args.overwrite_tags,
+                delimiter=args.tag_delimiter,
+            )
+
+            if args.add_chapters and (
+                args.overwrite_tags or not audiofile.tag.table_of_contents
+            ):
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
+                )
+
+                for mm in merged_markers:  # type: Dict[str, Union[str, int]]
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, mm["text"])
+                    chap = audiofile.tag.chapters.set(
+                        str(mm["id"]).encode("ascii"),
+                        times=(mm["start_time"], mm["end_time"]),
+                        sub_frames=title_frameset,
+                    )
+                    toc.child_ids.append(chap.element_id)
+                    start_time = datetime.timedelta(
+                        milliseconds=float(mm["start_time"])
+                    )
+                    end_time = datetime.timedelta(milliseconds=float(mm["end_time"]))
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(str(mm["id"]), "cyan"),
+                        start_time,
+                        end_time,
+                        colored(str(mm["text"]), "cyan"),
+                        colored(str(book_filename), "blue"),
+                    )
+
+            audiofile.tag.save(version=id3v2_version)
+
+            logger.info(
+                'Merged files into "%s"', colored(str(book_filename), "magenta")
+            )
+
+        if state:
+            state.set_output(
+                loan_id,
+                args.merge_format,
+                book_filename if args.merge_format == "mp3" else book_m4b_filename,
+                title,
             )
 
         if not args.keep_mp3:
@@ -758,6 +952,8 @@ def process_odm(
                     f["file"].unlink()
                 except Exception as e:  # pylint: disable=broad-except
                     logger.warning(f'Error deleting "{f["file"]}": {str(e)}')
+            if state:
+                state.clear_parts(loan_id)
 
     if cleanup_odm_license:
         for target_file in [odm_file, license_file]:
@@ -789,8 +985,11 @@ def process_odm(
                 )
             else:
                 reserve_id = mobj.group("reserve_id")
-                od_client = OverDriveClient(
-                    user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
+                od_client = od_client or OverDriveClient(
+                    user_agent=USER_AGENT,
+                    timeout=args.timeout,
+                    retry=args.retries,
+                    cache=get_cache(args.cache_dir),
                 )
                 media_info = od_client.media(reserve_id)
                 create_opf(
@@ -835,7 +1034,7 @@ def process_odm_return(args: argparse.Namespace, logger: logging.Logger) -> None
     early_return_url = get_element_text(root.find("EarlyReturnURL"))
     if not early_return_url:
         raise OdmpyRuntimeError("Unable to get EarlyReturnURL")
-    sess = init_session(args.retries)
+    sess = get_session(max_retries=args.retries)
     try:
         early_return_res = sess.get(
             early_return_url, headers={"User-Agent": UA_LONG}, timeout=args.timeout
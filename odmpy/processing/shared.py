@@ -17,25 +17,60 @@
 #
 
 import argparse
+import bisect
+import functools
+import io
+import json
 import logging
+import math
+import os
+import shutil
 import subprocess
 import xml.etree.ElementTree as ET
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, as_completed
 from pathlib import Path
-from typing import Optional, Dict, List, Tuple
+from typing import (
+    Optional,
+    Dict,
+    List,
+    Tuple,
+    NamedTuple,
+    Generator,
+    Callable,
+    Any,
+    Sequence,
+    Deque,
+)
 from urllib.parse import urlparse
 
 import eyed3  # type: ignore[import]
 import requests
+import urllib3
 from eyed3.utils import art  # type: ignore[import]
-from iso639 import Lang  # type: ignore[import]
-from requests.adapters import HTTPAdapter, Retry
 from termcolor import colored
+from tqdm import tqdm
 
 from ..constants import PERFORMER_FID, LANGUAGE_FID
-from ..errors import OdmpyRuntimeError
+from ..errors import (
+    OdmpyRuntimeError,
+    DownloadIncompleteError,
+    DownloadStalledError,
+)
 from ..libby import USER_AGENT, LibbyFormats, LibbyClient
-from ..utils import slugify, sanitize_path, is_windows
+from ..mp3 import Mp3StreamAnalyzer, Mp3Info, analyze_file, repair_info_frame
+from ..sessions import get_session
+from ..state import DownloadState
+from ..utils import (
+    slugify,
+    sanitize_path,
+    is_windows,
+    mp3_duration_ms,
+    plural_or_singular_noun as ps,
+)
 
 
 #
@@ -43,14 +78,758 @@ from ..utils import slugify, sanitize_path, is_windows
 #
 
 
-def init_session(max_retries: int = 0) -> requests.Session:
-    session = requests.Session()
-    custom_adapter = HTTPAdapter(
-        max_retries=Retry(total=max_retries, backoff_factor=0.1)
+def init_session(max_retries: int = 0, pool_maxsize: int = 0) -> requests.Session:
+    """
+    Get the shared session for downloads.
+
+    :param max_retries:
+    :param pool_maxsize: Minimum number of connections to keep per host
+    :return:
+    """
+    return get_session(max_retries=max_retries, pool_maxsize=pool_maxsize)
+
+
+# parts smaller than this are not split into segments
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024  # bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 64  # bytes
+# initial and max delay before resuming an interrupted download
+RESUME_BACKOFF = 1.0  # seconds
+RESUME_MAX_BACKOFF = 60.0  # seconds
+# a stream slower than the min rate over the window is reconnected,
+# off by default since a slow but steady stream is not stalled
+DEFAULT_MIN_RATE = 0  # bytes per second
+DEFAULT_RATE_WINDOW = 60.0  # seconds
+# owner of the ID3 PRIV frame that marks the space reserved at the start of
+# a part download for its final tag
+HEADER_RESERVE_OWNER = b"odmpy-header-reserve"
+
+
+class ThroughputWatchdog(object):
+    """
+    Detects a download stream that is still receiving data, so it does not
+    time out, but is trickling in below a minimum transfer rate.
+    """
+
+    def __init__(self, min_rate: int, window: float = DEFAULT_RATE_WINDOW) -> None:
+        """
+        Constructor.
+
+        :param min_rate: Minimum transfer rate in bytes per second. 0 to disable.
+        :param window: Period in seconds over which the transfer rate is measured
+        """
+        self.min_rate = min_rate
+        self.window = window
+        self.started = time.monotonic()
+        self._samples: Deque[Tuple[float, int]] = deque()
+        self._window_len = 0
+
+    def update(self, n: int) -> None:
+        """
+        Record received bytes.
+
+        :param n: Number of bytes received
+        :raises DownloadStalledError: If the rate over the last window is below the min rate
+        :return:
+        """
+        if self.min_rate <= 0 or self.window <= 0:
+            return
+        now = time.monotonic()
+        self._samples.append((now, n))
+        self._window_len += n
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._window_len -= self._samples.popleft()[1]
+        if (
+            now - self.started >= self.window
+            and self._window_len / self.window < self.min_rate
+        ):
+            raise DownloadStalledError(
+                f"Transfer rate below {self.min_rate / 1024:,.1f}KB/s "
+                f"for {self.window:,.0f}s"
+            )
+
+
+class DownloadStats(object):
+    """
+    Counters for a batch of part downloads, shared across worker threads.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reconnects = 0
+        self.stalls = 0
+
+    def record_reconnect(self, err: Exception) -> None:
+        """
+        Record that a download was reconnected after an error.
+
+        :param err:
+        :return:
+        """
+        with self._lock:
+            self.reconnects += 1
+            if isinstance(err, DownloadStalledError):
+                self.stalls += 1
+
+
+class PartDownload(NamedTuple):
+    url: str
+    tmp_filename: Path
+    file_size: Optional[int]
+    label: str
+    # analyzes the part while it is downloaded
+    analyzer: Optional[Mp3StreamAnalyzer] = None
+    # bytes to reserve at the start of the file for the final ID3 tag,
+    # see `finalize_mp3()`
+    header_reserve: int = 0
+
+
+def _segments_filename(part_tmp_filename: Path) -> Path:
+    return part_tmp_filename.with_name(f"{part_tmp_filename.name}.segments")
+
+
+def _syncsafe_bytes(value: int) -> bytes:
+    return bytes((value >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+
+def _header_reserve_tag(size: int) -> bytes:
+    """
+    Render the space reserved at the start of a part download as a valid
+    ID3v2.4 tag that holds only a marker PRIV frame and padding.
+
+    :param size: Size of the reserved space, including the tag header
+    :return:
+    """
+    frame_data = HEADER_RESERVE_OWNER + b"\x00"
+    frames = b"PRIV" + _syncsafe_bytes(len(frame_data)) + b"\x00\x00" + frame_data
+    size = max(size, 10 + len(frames))
+    return (
+        b"ID3\x04\x00\x00"
+        + _syncsafe_bytes(size - 10)
+        + frames
+        + b"\x00" * (size - 10 - len(frames))
     )
-    for prefix in ("http://", "https://"):
-        session.mount(prefix, custom_adapter)
-    return session
+
+
+def get_header_reserve(part_tmp_filename: Path) -> int:
+    """
+    Get the size of the space reserved at the start of a part download.
+
+    :param part_tmp_filename:
+    :return: 0 if no space is reserved
+    """
+    try:
+        with part_tmp_filename.open("rb") as f:
+            header = f.read(20 + len(HEADER_RESERVE_OWNER) + 1)
+    except FileNotFoundError:
+        return 0
+    if (
+        header[:3] != b"ID3"
+        or header[10:14] != b"PRIV"
+        or header[20:] != HEADER_RESERVE_OWNER + b"\x00"
+    ):
+        return 0
+    size = 0
+    for b in header[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    return 10 + size
+
+
+def strip_header_reserve(part_tmp_filename: Path) -> None:
+    """
+    Remove the space reserved at the start of a part download, e.g. when it
+    cannot be finalized in place.
+
+    :param part_tmp_filename:
+    :return:
+    """
+    header_reserve = get_header_reserve(part_tmp_filename)
+    if not header_reserve:
+        return
+    temp_filename = part_tmp_filename.with_name(f"{part_tmp_filename.name}.tmp")
+    try:
+        with part_tmp_filename.open("rb") as infile, temp_filename.open(
+            "wb"
+        ) as outfile:
+            infile.seek(header_reserve)
+            shutil.copyfileobj(infile, outfile, 1024 * 1024)
+        temp_filename.replace(part_tmp_filename)
+    finally:
+        if temp_filename.exists():
+            temp_filename.unlink()
+
+
+def get_downloaded_size(part_tmp_filename: Path) -> int:
+    """
+    Get the number of bytes already downloaded for a (possibly segmented) partial download.
+
+    :param part_tmp_filename:
+    :return:
+    """
+    if not part_tmp_filename.exists():
+        return 0
+    segments_file = _segments_filename(part_tmp_filename)
+    if segments_file.exists():
+        try:
+            with segments_file.open("r", encoding="utf-8") as f:
+                return sum(written for _, _, written in json.load(f))
+        except (OSError, ValueError):
+            return 0
+    return part_tmp_filename.stat().st_size - get_header_reserve(part_tmp_filename)
+
+
+def _download_part_segmented(
+    session: requests.Session,
+    url: str,
+    part_tmp_filename: Path,
+    headers: Dict,
+    timeout: int,
+    file_size: int,
+    segments: int,
+    progress_callback: Optional[Callable[[int], Any]] = None,
+    min_rate: int = DEFAULT_MIN_RATE,
+    rate_window: float = DEFAULT_RATE_WINDOW,
+) -> bool:
+    """
+    Download a part file with concurrent Range requests written at offsets into
+    a preallocated file. Progress is tracked in a sidecar `.segments` file so that
+    an interrupted download can be resumed.
+
+    :param session:
+    :param url:
+    :param part_tmp_filename:
+    :param headers:
+    :param timeout:
+    :param file_size:
+    :param segments: Number of concurrent Range requests
+    :param progress_callback:
+    :param min_rate: Minimum transfer rate (bytes/s) of each segment
+    :param rate_window: Period (seconds) over which the transfer rate is measured
+    :return: False if the server does not support Range requests
+    """
+    segments_file = _segments_filename(part_tmp_filename)
+    already_downloaded_len = get_downloaded_size(part_tmp_filename)
+    # list of [start, end (inclusive), bytes written]
+    plan: List[List[int]] = []
+    if segments_file.exists() and part_tmp_filename.exists():
+        try:
+            with segments_file.open("r", encoding="utf-8") as plan_f:
+                plan = json.load(plan_f)
+        except (OSError, ValueError):
+            plan = []
+    if not plan or plan[-1][1] != file_size - 1:
+        if already_downloaded_len and progress_callback:
+            progress_callback(-already_downloaded_len)
+        segment_size = math.ceil(file_size / segments)
+        plan = [
+            [start, min(start + segment_size, file_size) - 1, 0]
+            for start in range(0, file_size, segment_size)
+        ]
+        with part_tmp_filename.open("wb") as outfile:
+            outfile.truncate(file_size)
+
+    lock = threading.Lock()
+
+    def save_plan() -> None:
+        with segments_file.open("w", encoding="utf-8") as plan_f:
+            json.dump(plan, plan_f)
+
+    def request_segment(segment: List[int]) -> requests.Response:
+        seg_start, seg_end, written = segment
+        request_headers = dict(headers)
+        request_headers["Range"] = f"bytes={seg_start + written}-{seg_end}"
+        seg_res = session.get(
+            url, headers=request_headers, timeout=timeout, stream=True
+        )
+        seg_res.raise_for_status()
+        return seg_res
+
+    def is_ranged(seg_res: requests.Response, segment: List[int]) -> bool:
+        return seg_res.status_code == 206 and seg_res.headers.get(
+            "Content-Range", ""
+        ).startswith(f"bytes {segment[0] + segment[2]}-")
+
+    def write_segment(
+        segment: List[int], seg_res: Optional[requests.Response] = None
+    ) -> None:
+        if seg_res is None:
+            seg_res = request_segment(segment)
+        with seg_res:
+            if not is_ranged(seg_res, segment):
+                raise OdmpyRuntimeError(f"Range request not supported for {url}")
+            seg_start, seg_end, _ = segment
+            unsaved_len = 0
+            watchdog = ThroughputWatchdog(min_rate, rate_window)
+            # unbuffered so that the saved progress never runs ahead of the file contents
+            with part_tmp_filename.open("r+b", buffering=0) as outfile:
+                outfile.seek(seg_start + segment[2])
+                while seg_start + segment[2] <= seg_end:
+                    chunk = seg_res.raw.read(
+                        min(DOWNLOAD_CHUNK_SIZE, seg_end + 1 - seg_start - segment[2])
+                    )
+                    if not chunk:
+                        break
+                    outfile.write(chunk)
+                    unsaved_len += len(chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+                        if progress_callback:
+                            progress_callback(len(chunk))
+                        if unsaved_len >= MIN_SEGMENT_SIZE:
+                            save_plan()
+                            unsaved_len = 0
+                    watchdog.update(len(chunk))
+        if seg_start + segment[2] <= seg_end:
+            raise DownloadIncompleteError(
+                f"Incomplete download for {url} at bytes {seg_start + segment[2]}-{seg_end}"
+            )
+
+    pending_segments = [seg for seg in plan if seg[0] + seg[2] <= seg[1]]
+    if pending_segments:
+        # check that the server supports Range requests before splitting up the download
+        first_res = request_segment(pending_segments[0])
+        if not is_ranged(first_res, pending_segments[0]):
+            first_res.close()
+            for stale_file in (segments_file, part_tmp_filename):
+                if stale_file.exists():
+                    stale_file.unlink()
+            if progress_callback:
+                progress_callback(-sum(seg[2] for seg in plan))
+            return False
+
+        save_plan()
+        try:
+            with ThreadPoolExecutor(
+                max_workers=min(segments, len(pending_segments))
+            ) as executor:
+                futures = [
+                    executor.submit(write_segment, pending_segments[0], first_res)
+                ]
+                futures.extend(
+                    executor.submit(write_segment, seg) for seg in pending_segments[1:]
+                )
+                try:
+                    for future in futures:
+                        future.result()
+                finally:
+                    for future in futures:
+                        future.cancel()
+        finally:
+            # saved after the running segments have stopped so that a resume
+            # picks up from where each segment left off
+            save_plan()
+
+    if segments_file.exists():
+        segments_file.unlink()
+    return True
+
+
+def _download_part(
+    session: requests.Session,
+    url: str,
+    part_tmp_filename: Path,
+    headers: Dict,
+    timeout: int,
+    progress_callback: Optional[Callable[[int], Any]] = None,
+    file_size: Optional[int] = None,
+    segments: int = 1,
+    min_segment_size: int = MIN_SEGMENT_SIZE,
+    min_rate: int = DEFAULT_MIN_RATE,
+    rate_window: float = DEFAULT_RATE_WINDOW,
+    data_callback: Optional[Callable[[bytes, int], Any]] = None,
+    header_reserve: int = 0,
+) -> Path:
+    """
+    Make one attempt at downloading a part file. See `download_part()`.
+    """
+    if file_size and (
+        _segments_filename(part_tmp_filename).exists()
+        or (
+            segments > 1
+            and file_size >= 2 * min_segment_size
+            and not part_tmp_filename.exists()
+        )
+    ):
+        if _download_part_segmented(
+            session=session,
+            url=url,
+            part_tmp_filename=part_tmp_filename,
+            headers=headers,
+            timeout=timeout,
+            file_size=file_size,
+            segments=max(1, min(segments, file_size // min_segment_size)),
+            progress_callback=progress_callback,
+            min_rate=min_rate,
+            rate_window=rate_window,
+        ):
+            return part_tmp_filename
+        # server ignored the Range request, so download in a single stream
+
+    already_downloaded_len = get_downloaded_size(part_tmp_filename)
+    if file_size and already_downloaded_len > file_size:
+        # not a partial download of this part, e.g. already finalized in place
+        already_downloaded_len = 0
+
+    request_headers = dict(headers)
+    if already_downloaded_len:
+        request_headers["Range"] = f"bytes={already_downloaded_len}-"
+
+    with session.get(
+        url, headers=request_headers, timeout=timeout, stream=True
+    ) as part_download_res:
+        part_download_res.raise_for_status()
+        if already_downloaded_len and part_download_res.status_code != 206:
+            # server ignored the Range request, so start over
+            if progress_callback:
+                progress_callback(-already_downloaded_len)
+            already_downloaded_len = 0
+
+        content_length = part_download_res.headers.get("Content-Length", "")
+        received_len = 0
+        watchdog = ThroughputWatchdog(min_rate, rate_window)
+        with part_tmp_filename.open(
+            "ab" if already_downloaded_len else "wb"
+        ) as outfile:
+            if not already_downloaded_len and header_reserve:
+                outfile.write(_header_reserve_tag(header_reserve))
+            while True:
+                chunk = part_download_res.raw.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                outfile.write(chunk)
+                if data_callback:
+                    data_callback(chunk, already_downloaded_len + received_len)
+                received_len += len(chunk)
+                if progress_callback:
+                    progress_callback(len(chunk))
+                watchdog.update(len(chunk))
+        if content_length.isdigit() and received_len < int(content_length):
+            raise DownloadIncompleteError(
+                f"Incomplete download for {url}: "
+                f"{received_len} of {content_length} bytes received"
+            )
+    return part_tmp_filename
+
+
+def _is_transient_download_error(err: Exception) -> bool:
+    """
+    Check if a download error is worth resuming from.
+
+    :param err:
+    :return:
+    """
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and (
+            err.response.status_code == 429 or err.response.status_code >= 500
+        )
+    return isinstance(
+        err,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            urllib3.exceptions.HTTPError,
+            DownloadIncompleteError,
+        ),
+    )
+
+
+def download_part(
+    session: requests.Session,
+    url: str,
+    part_tmp_filename: Path,
+    headers: Dict,
+    timeout: int,
+    progress_callback: Optional[Callable[[int], Any]] = None,
+    file_size: Optional[int] = None,
+    segments: int = 1,
+    min_segment_size: int = MIN_SEGMENT_SIZE,
+    resume_retries: int = 0,
+    logger: Optional[logging.Logger] = None,
+    min_rate: int = DEFAULT_MIN_RATE,
+    rate_window: float = DEFAULT_RATE_WINDOW,
+    stats: Optional[DownloadStats] = None,
+    data_callback: Optional[Callable[[bytes, int], Any]] = None,
+    auth_refresh: Optional[Callable[[], Any]] = None,
+    header_reserve: int = 0,
+) -> Path:
+    """
+    Download a part file, resuming from an existing partial download if available.
+    If the download is interrupted by a transient error, it is resumed in-process
+    with exponential backoff, up to `resume_retries` times.
+    A stream that trickles in below `min_rate` over `rate_window` is also reconnected,
+    in the hope of being served by a different edge server.
+    If the request is rejected with a 401/403, `auth_refresh` is called once
+    and the download is retried, with the new url if it returns one.
+
+    :param session:
+    :param url:
+    :param part_tmp_filename: Partial download file path
+    :param headers:
+    :param timeout:
+    :param progress_callback: Called with the number of bytes written
+    :param file_size: Expected size of the part, required for segmented downloads
+    :param segments: Number of concurrent Range requests to split the download into
+    :param min_segment_size: Parts are not split into segments smaller than this
+    :param resume_retries: Max number of times to resume the download after an error
+    :param logger:
+    :param min_rate: Minimum transfer rate in bytes per second. 0 to disable.
+    :param rate_window: Period in seconds over which the transfer rate is measured
+    :param stats: Records the number of reconnects
+    :param data_callback: Called with each chunk written and its offset in the download.
+                          Not called for segmented downloads.
+    :param auth_refresh: Called to renew the session auth, e.g. cookies.
+                         May return a new url for the part.
+    :param header_reserve: Bytes to reserve at the start of the file, before the
+                           downloaded data, if the part is downloaded in a single stream.
+                           See `finalize_mp3()`.
+    :return:
+    """
+    if not logger:
+        logger = logging.getLogger(__name__)
+    attempt = 0
+    auth_refreshed = False
+    while True:
+        try:
+            return _download_part(
+                session=session,
+                url=url,
+                part_tmp_filename=part_tmp_filename,
+                headers=headers,
+                timeout=timeout,
+                progress_callback=progress_callback,
+                file_size=file_size,
+                segments=segments,
+                min_segment_size=min_segment_size,
+                min_rate=min_rate,
+                rate_window=rate_window,
+                data_callback=data_callback,
+                header_reserve=header_reserve,
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            err_response: Optional[requests.Response] = (
+                err.response if isinstance(err, requests.HTTPError) else None
+            )
+            if (
+                auth_refresh
+                and not auth_refreshed
+                and err_response is not None
+                and err_response.status_code in (401, 403)
+            ):
+                auth_refreshed = True
+                logger.debug(
+                    'Refreshing auth for "%s" after error: %s',
+                    part_tmp_filename.name,
+                    err,
+                )
+                refreshed_url = auth_refresh()
+                if isinstance(refreshed_url, str) and refreshed_url:
+                    url = refreshed_url
+                continue
+            if not _is_transient_download_error(err):
+                raise
+            if attempt >= resume_retries:
+                if isinstance(
+                    err,
+                    (
+                        urllib3.exceptions.HTTPError,
+                        requests.exceptions.ChunkedEncodingError,
+                    ),
+                ):
+                    raise DownloadIncompleteError(
+                        f"Download interrupted for {url}: {err}"
+                    ) from err
+                raise
+            # a stalled stream is reconnected straight away
+            backoff = (
+                0
+                if isinstance(err, DownloadStalledError)
+                else min(RESUME_BACKOFF * 2**attempt, RESUME_MAX_BACKOFF)
+            )
+            attempt += 1
+            if stats:
+                stats.record_reconnect(err)
+            logger.warning(
+                'Resuming "%s" in %.1fs (%d/%d) after error: %s',
+                part_tmp_filename.name,
+                backoff,
+                attempt,
+                resume_retries,
+                err,
+            )
+            time.sleep(backoff)
+
+
+def download_part_files(
+    session: requests.Session,
+    part_downloads: List[PartDownload],
+    headers: Dict,
+    timeout: int,
+    parallel: int,
+    hide_progress: bool,
+    post_process: Optional[Callable[[int, Path], Any]] = None,
+    segments: int = 1,
+    resume_retries: int = 0,
+    logger: Optional[logging.Logger] = None,
+    min_rate: int = DEFAULT_MIN_RATE,
+    rate_window: float = DEFAULT_RATE_WINDOW,
+    auth_refresh: Optional[Callable[[], Any]] = None,
+) -> Generator[Any, None, None]:
+    """
+    Download part files concurrently. Each completed download is handed to
+    `post_process` in a separate worker pool so that post-processing, e.g. remuxing
+    and tagging, overlaps with the remaining downloads.
+    Results are yielded in the same order as `part_downloads`.
+
+    :param session:
+    :param part_downloads:
+    :param headers:
+    :param timeout:
+    :param parallel: Maximum number of concurrent downloads and post-processing workers
+    :param hide_progress:
+    :param post_process: Called with the part index and the downloaded file path.
+                         If not specified, the downloaded file path is yielded.
+    :param segments: Number of concurrent Range requests per part
+    :param resume_retries: Max number of times to resume each part after an error
+    :param logger:
+    :param min_rate: Minimum transfer rate in bytes per second. 0 to disable.
+    :param rate_window: Period in seconds over which the transfer rate is measured
+    :param auth_refresh: Called to renew the session auth if a part download
+                         is rejected with a 401/403. Called at most once.
+                         May return the new urls of the parts, keyed by the old url,
+                         which are then used for the parts not yet downloaded.
+    :return:
+    """
+    if not logger:
+        logger = logging.getLogger(__name__)
+    stats = DownloadStats()
+    auth_lock = threading.Lock()
+    auth_refreshed = threading.Event()
+    refreshed_urls: Dict[str, str] = {}
+
+    def part_url(pd: PartDownload) -> str:
+        with auth_lock:
+            return refreshed_urls.get(pd.url, pd.url)
+
+    def refresh_auth(pd: PartDownload) -> str:
+        # parts that are rejected at the same time share a single refresh
+        with auth_lock:
+            if auth_refresh and not auth_refreshed.is_set():
+                refreshed_urls.update(auth_refresh() or {})
+                auth_refreshed.set()
+            return refreshed_urls.get(pd.url, pd.url)
+
+    already_downloaded_lens = [
+        get_downloaded_size(pd.tmp_filename) for pd in part_downloads
+    ]
+    # show one progress bar per part if downloading one at a time
+    show_aggregate_progress = parallel > 1 and len(part_downloads) > 1
+    lock = threading.Lock()
+    with tqdm(
+        total=sum([pd.file_size or 0 for pd in part_downloads]) or None,
+        initial=sum(already_downloaded_lens),
+        desc=f"{len(part_downloads)} parts",
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        disable=hide_progress or not show_aggregate_progress,
+    ) as progress_bar:
+
+        def update_progress(n: int) -> None:
+            with lock:
+                progress_bar.update(n)
+
+        def fetch(index: int) -> Path:
+            pd = part_downloads[index]
+            if show_aggregate_progress:
+                return download_part(
+                    session=session,
+                    url=part_url(pd),
+                    part_tmp_filename=pd.tmp_filename,
+                    headers=headers,
+                    timeout=timeout,
+                    progress_callback=update_progress,
+                    file_size=pd.file_size,
+                    segments=segments,
+                    resume_retries=resume_retries,
+                    logger=logger,
+                    min_rate=min_rate,
+                    rate_window=rate_window,
+                    stats=stats,
+                    data_callback=pd.analyzer.feed if pd.analyzer else None,
+                    auth_refresh=(
+                        functools.partial(refresh_auth, pd) if auth_refresh else None
+                    ),
+                    header_reserve=pd.header_reserve,
+                )
+            with tqdm(
+                total=pd.file_size,
+                initial=already_downloaded_lens[index],
+                desc=pd.label,
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024,
+                disable=hide_progress,
+            ) as part_progress_bar:
+                return download_part(
+                    session=session,
+                    url=part_url(pd),
+                    part_tmp_filename=pd.tmp_filename,
+                    headers=headers,
+                    timeout=timeout,
+                    progress_callback=part_progress_bar.update,
+                    file_size=pd.file_size,
+                    segments=segments,
+                    resume_retries=resume_retries,
+                    logger=logger,
+                    min_rate=min_rate,
+                    rate_window=rate_window,
+                    stats=stats,
+                    data_callback=pd.analyzer.feed if pd.analyzer else None,
+                    auth_refresh=(
+                        functools.partial(refresh_auth, pd) if auth_refresh else None
+                    ),
+                    header_reserve=pd.header_reserve,
+                )
+
+        with ThreadPoolExecutor(max_workers=parallel) as post_process_executor:
+
+            def fetch_and_post_process(index: int) -> "Future[Any]":
+                part_tmp_filename = fetch(index)
+                analyzer = part_downloads[index].analyzer
+                if analyzer:
+                    if analyzer.position != get_downloaded_size(part_tmp_filename):
+                        # e.g. resumed from a previous run or a segmented download
+                        analyzer.abort("Part was not downloaded in a single stream")
+                    analyzer.close()
+                if not post_process:
+                    future: "Future[Any]" = Future()
+                    future.set_result(part_tmp_filename)
+                    return future
+                return post_process_executor.submit(
+                    post_process, index, part_tmp_filename
+                )
+
+            # the download executor is shut down first so that no new
+            # post-processing is queued after the post-process executor is closed
+            with ThreadPoolExecutor(max_workers=parallel) as download_executor:
+                futures = [
+                    download_executor.submit(fetch_and_post_process, i)
+                    for i in range(len(part_downloads))
+                ]
+                try:
+                    for future in futures:
+                        yield future.result().result()
+                finally:
+                    # stop queued downloads if we bail out early
+                    for future in futures:
+                        future.cancel()
+                    if stats.reconnects:
+                        logger.info(
+                            "Reconnected part downloads %d %s (%d after a stalled transfer).",
+                            stats.reconnects,
+                            ps(stats.reconnects, "time"),
+                            stats.stalls,
+                        )
 
 
 def generate_names(
@@ -164,6 +943,197 @@ def generate_names(
     return book_folder, book_filename
 
 
+def _to_iso639_2b(languages: List[str]) -> List[str]:
+    """
+    Convert language codes to ISO 639-2/B codes.
+    iso639 is only imported here because it is slow to load.
+
+    :param languages:
+    :return:
+    """
+    from iso639 import Lang  # type: ignore[import]
+
+    return [Lang(lang).pt2b for lang in languages]
+
+
+class _TagField(NamedTuple):
+    # checks if the field should be written to an existing tag
+    is_required: Callable[[eyed3.id3.Tag], Any]
+    apply: Callable[[eyed3.id3.Tag], Any]
+
+
+def _track_tag_field(
+    part_number: int, total_parts: int, always_overwrite: bool
+) -> _TagField:
+    return _TagField(
+        lambda tag: always_overwrite or not tag.track_num,
+        lambda tag: setattr(tag, "track_num", (part_number, total_parts)),
+    )
+
+
+def _tag_fields(
+    title: str,
+    sub_title: Optional[str],
+    authors: List[str],
+    narrators: Optional[List[str]],
+    publisher: str,
+    description: str,
+    cover_bytes: Optional[bytes],
+    genres: Optional[List[str]],
+    languages: Optional[List[str]],
+    published_date: Optional[str],
+    series: Optional[str],
+    part_number: int,
+    total_parts: int,
+    overdrive_id: str,
+    isbn: Optional[str] = None,
+    overwrite_title: bool = False,
+    always_overwrite: bool = False,
+    delimiter: str = ";",
+) -> List[_TagField]:
+    """
+    The ID3 tag fields for a book. See `write_tags()`.
+    """
+    if not delimiter:
+        delimiter = ";"
+
+    fields = [
+        _TagField(
+            lambda tag: always_overwrite or overwrite_title or not tag.title,
+            lambda tag: setattr(tag, "title", str(title)),
+        )
+    ]
+    if sub_title:
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite
+                or not tag.getTextFrame(eyed3.id3.frames.SUBTITLE_FID),
+                lambda tag: tag.setTextFrame(eyed3.id3.frames.SUBTITLE_FID, sub_title),
+            )
+        )
+    fields.append(
+        _TagField(
+            lambda tag: always_overwrite or not tag.album,
+            lambda tag: setattr(tag, "album", str(title)),
+        )
+    )
+    if authors:
+        authors_text = delimiter.join([str(a) for a in authors])
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite or not tag.artist,
+                lambda tag: setattr(tag, "artist", authors_text),
+            )
+        )
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite or not tag.album_artist,
+                lambda tag: setattr(tag, "album_artist", authors_text),
+            )
+        )
+    if part_number:
+        fields.append(_track_tag_field(part_number, total_parts, always_overwrite))
+    if narrators:
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite or not tag.getTextFrame(PERFORMER_FID),
+                lambda tag: tag.setTextFrame(
+                    PERFORMER_FID, delimiter.join([str(n) for n in narrators])
+                ),
+            )
+        )
+    if publisher:
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite or not tag.publisher,
+                lambda tag: setattr(tag, "publisher", str(publisher)),
+            )
+        )
+    if description:
+        pattern = re.compile("<.*?>")
+        description = re.sub(pattern, "", description)
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite
+                or eyed3.id3.frames.COMMENT_FID not in tag.frame_set,
+                lambda tag: tag.comments.set(
+                    str(description), description="Description"
+                ),
+            )
+        )
+    if genres:
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite or not tag.genre,
+                lambda tag: setattr(tag, "genre", delimiter.join(genres)),
+            )
+        )
+    if languages:
+        try:
+            tag_langs = _to_iso639_2b(languages)
+        except:  # noqa: E722, pylint: disable=bare-except
+            tag_langs = languages
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite or not tag.getTextFrame(LANGUAGE_FID),
+                lambda tag: tag.setTextFrame(LANGUAGE_FID, delimiter.join(tag_langs)),
+            )
+        )
+    if published_date:
+        fields.append(
+            _TagField(
+                lambda tag: always_overwrite or not tag.release_date,
+                lambda tag: setattr(
+                    tag,
+                    "release_date",
+                    LibbyClient.parse_datetime(published_date).strftime("%Y-%m-%d"),
+                ),
+            )
+        )
+    if cover_bytes:
+        fields.append(
+            _TagField(
+                lambda tag: True,
+                lambda tag: tag.images.set(
+                    art.TO_ID3_ART_TYPES[art.FRONT_COVER][0],
+                    cover_bytes,
+                    "image/jpeg",
+                    description="Cover",
+                ),
+            )
+        )
+    if series:
+        fields.append(
+            _TagField(
+                lambda tag: True,
+                lambda tag: tag.user_text_frames.set(series, "Series"),
+            )
+        )
+    # Output some OD identifiers in the mp3
+    if overdrive_id:
+        fields.append(
+            _TagField(
+                lambda tag: True,
+                lambda tag: tag.user_text_frames.set(
+                    overdrive_id,
+                    (
+                        "OverDrive Media ID"
+                        if overdrive_id.isdigit()
+                        else "OverDrive Reserve ID"
+                    ),
+                ),
+            )
+        )
+    if isbn:
+        fields.append(
+            _TagField(
+                lambda tag: True,
+                lambda tag: tag.user_text_frames.set(isbn, "ISBN"),
+            )
+        )
+    return fields
+
+
 def write_tags(
     audiofile: eyed3.core.AudioFile,
     title: str,
@@ -209,69 +1179,195 @@ def write_tags(
     :param delimiter:
     :return:
     """
-    if not delimiter:
-        delimiter = ";"
-
     if not audiofile.tag:
         audiofile.initTag()
-    if always_overwrite or overwrite_title or not audiofile.tag.title:
-        audiofile.tag.title = str(title)
-    if sub_title and (
-        always_overwrite
-        or not audiofile.tag.getTextFrame(eyed3.id3.frames.SUBTITLE_FID)
-    ):
-        audiofile.tag.setTextFrame(eyed3.id3.frames.SUBTITLE_FID, sub_title)
-    if always_overwrite or not audiofile.tag.album:
-        audiofile.tag.album = str(title)
-    if authors and (always_overwrite or not audiofile.tag.artist):
-        audiofile.tag.artist = delimiter.join([str(a) for a in authors])
-    if authors and (always_overwrite or not audiofile.tag.album_artist):
-        audiofile.tag.album_artist = delimiter.join([str(a) for a in authors])
-    if part_number and (always_overwrite or not audiofile.tag.track_num):
-        audiofile.tag.track_num = (part_number, total_parts)
-    if narrators and (
-        always_overwrite or not audiofile.tag.getTextFrame(PERFORMER_FID)
+    for field in _tag_fields(
+        title=title,
+        sub_title=sub_title,
+        authors=authors,
+        narrators=narrators,
+        publisher=publisher,
+        description=description,
+        cover_bytes=cover_bytes,
+        genres=genres,
+        languages=languages,
+        published_date=published_date,
+        series=series,
+        part_number=part_number,
+        total_parts=total_parts,
+        overdrive_id=overdrive_id,
+        isbn=isbn,
+        overwrite_title=overwrite_title,
+        always_overwrite=always_overwrite,
+        delimiter=delimiter,
     ):
-        audiofile.tag.setTextFrame(
-            PERFORMER_FID, delimiter.join([str(n) for n in narrators])
-        )
-    if publisher and (always_overwrite or not audiofile.tag.publisher):
-        audiofile.tag.publisher = str(publisher)
-    if description and (
-        always_overwrite or eyed3.id3.frames.COMMENT_FID not in audiofile.tag.frame_set
+        if field.is_required(audiofile.tag):
+            field.apply(audiofile.tag)
+
+
+class _RenderedTagField(NamedTuple):
+    field: _TagField
+    # (frame id, description) of the frames set by the field
+    frame_keys: List[Tuple[bytes, Optional[str]]]
+    data: bytes
+
+
+class ID3TagTemplate:
+    """
+    The ID3 tag frames common to all the parts of a book, e.g. title, authors
+    and cover, rendered only once. The per-part frames (track number, chapters and
+    the frames from the downloaded tag) are then stamped into the template to
+    render each part's tag.
+    """
+
+    def __init__(
+        self,
+        version: Tuple[int, int, int],
+        title: str,
+        sub_title: Optional[str],
+        authors: List[str],
+        narrators: Optional[List[str]],
+        publisher: str,
+        description: str,
+        cover_bytes: Optional[bytes],
+        genres: Optional[List[str]],
+        languages: Optional[List[str]],
+        published_date: Optional[str],
+        series: Optional[str],
+        overdrive_id: str,
+        isbn: Optional[str] = None,
+        overwrite_title: bool = False,
+        always_overwrite: bool = False,
+        delimiter: str = ";",
     ):
-        pattern = re.compile("<.*?>")
-        description = re.sub(pattern, "", description)
-        audiofile.tag.comments.set(str(description), description="Description")
-    if genres and (always_overwrite or not audiofile.tag.genre):
-        audiofile.tag.genre = delimiter.join(genres)
-    if languages and (always_overwrite or not audiofile.tag.getTextFrame(LANGUAGE_FID)):
-        try:
-            tag_langs = [Lang(lang).pt2b for lang in languages]
-        except:  # noqa: E722, pylint: disable=bare-except
-            tag_langs = languages
-        audiofile.tag.setTextFrame(LANGUAGE_FID, delimiter.join(tag_langs))
-    if published_date and (always_overwrite or not audiofile.tag.release_date):
-        audiofile.tag.release_date = LibbyClient.parse_datetime(
-            published_date
-        ).strftime("%Y-%m-%d")
-    if cover_bytes:
-        audiofile.tag.images.set(
-            art.TO_ID3_ART_TYPES[art.FRONT_COVER][0],
-            cover_bytes,
-            "image/jpeg",
-            description="Cover",
+        """
+        Constructor. See `write_tags()` for the parameters.
+
+        :param version: ID3v2 version of the rendered tags
+        """
+        self.version = version
+        self._tag_args: Dict[str, Any] = {
+            "title": title,
+            "sub_title": sub_title,
+            "authors": authors,
+            "narrators": narrators,
+            "publisher": publisher,
+            "description": description,
+            "cover_bytes": cover_bytes,
+            "genres": genres,
+            "languages": languages,
+            "published_date": published_date,
+            "series": series,
+            "overdrive_id": overdrive_id,
+            "isbn": isbn,
+            "overwrite_title": overwrite_title,
+            "always_overwrite": always_overwrite,
+            "delimiter": delimiter,
+        }
+        self._fields = _tag_fields(part_number=0, total_parts=0, **self._tag_args)
+        # rendered fields by the version of the tag they are added to, since
+        # the frames that eyed3 creates depend on it, e.g. for dates
+        self._rendered_fields: Dict[Tuple[int, int, int], List[_RenderedTagField]] = {}
+        self._lock = threading.Lock()
+
+    def _render_frames(self, tag: eyed3.id3.Tag) -> bytes:
+        tag.version = self.version
+        tag.header.extended = False
+        # pylint: disable-next=protected-access
+        _, tag_data, _ = tag._render(self.version, 0, None)
+        return tag_data[eyed3.id3.tag.TagHeader.SIZE :]
+
+    def _get_rendered_fields(
+        self, tag_version: Tuple[int, int, int]
+    ) -> List[_RenderedTagField]:
+        with self._lock:
+            rendered_fields = self._rendered_fields.get(tag_version)
+            if rendered_fields is None:
+                rendered_fields = []
+                for field in self._fields:
+                    field_tag = eyed3.id3.Tag(version=tag_version)
+                    field.apply(field_tag)
+                    rendered_fields.append(
+                        _RenderedTagField(
+                            field=field,
+                            frame_keys=[
+                                (frame.id, getattr(frame, "description", None))
+                                for frame in field_tag.frame_set.getAllFrames()
+                            ],
+                            data=self._render_frames(field_tag),
+                        )
+                    )
+                self._rendered_fields[tag_version] = rendered_fields
+            return rendered_fields
+
+    def write_tags(
+        self, audiofile: eyed3.core.AudioFile, part_number: int, total_parts: int
+    ) -> None:
+        """
+        Write the tags to an audiofile the same way as `write_tags()`.
+
+        :param audiofile:
+        :param part_number:
+        :param total_parts:
+        :return:
+        """
+        write_tags(
+            audiofile=audiofile,
+            part_number=part_number,
+            total_parts=total_parts,
+            **self._tag_args,
         )
-    if series:
-        audiofile.tag.user_text_frames.set(series, "Series")
-    # Output some OD identifiers in the mp3
-    if overdrive_id:
-        audiofile.tag.user_text_frames.set(
-            overdrive_id,
-            "OverDrive Media ID" if overdrive_id.isdigit() else "OverDrive Reserve ID",
+
+    def render(
+        self,
+        tag: Optional[eyed3.id3.Tag],
+        part_number: int,
+        total_parts: int,
+        padding: int = 0,
+    ) -> bytes:
+        """
+        Render the complete ID3v2 tag for a part, with the same frames
+        that `write_tags()` and saving the tag would produce.
+
+        :param tag: The part's existing tag, e.g. from the downloaded file, which
+                    may also have been updated with chapters
+        :param part_number:
+        :param total_parts:
+        :param padding: Bytes of padding to reserve in the tag so that it can
+                        be updated later without rewriting the file
+        :return:
+        """
+        if not tag:
+            tag = eyed3.id3.Tag()
+        template_data = []
+        for rendered_field in self._get_rendered_fields(tag.version):
+            if not rendered_field.field.is_required(tag):
+                continue
+            if any(
+                getattr(f, "description", None) == description
+                for frame_id, description in rendered_field.frame_keys
+                for f in tag.frame_set.get(frame_id, [])
+            ):
+                # eyed3 updates an existing frame in place, e.g. keeping its encoding
+                rendered_field.field.apply(tag)
+            else:
+                template_data.append(rendered_field.data)
+        if part_number:
+            track_field = _track_tag_field(
+                part_number, total_parts, self._tag_args["always_overwrite"]
+            )
+            if track_field.is_required(tag):
+                track_field.apply(tag)
+
+        frames_data = self._render_frames(tag) + b"".join(template_data)
+        tag_size = len(frames_data) + padding
+        return (
+            b"ID3"
+            + bytes([self.version[1], 0, 0])
+            + _syncsafe_bytes(tag_size)
+            + frames_data
+            + b"\x00" * padding
         )
-    if isbn:
-        audiofile.tag.user_text_frames.set(isbn, "ISBN")
 
 
 def get_best_cover_url(loan: Dict) -> Optional[str]:
@@ -371,6 +1467,37 @@ def generate_cover(
     return cover_filename, cover_bytes
 
 
+def find_saved_output(
+    state: Optional[DownloadState],
+    loan_id: str,
+    output_format: str,
+    output_filename: Path,
+    title: str,
+) -> Optional[Path]:
+    """
+    Check if the merged output of a loan is already saved.
+    The state is queried first so that outputs saved under a different
+    book folder/file format are found. Outputs saved before the state
+    was in use are recorded when found.
+
+    :param state:
+    :param loan_id:
+    :param output_format: mp3 or m4b
+    :param output_filename: The output path for the current run
+    :param title:
+    :return: The saved output path, if any
+    """
+    if state:
+        saved_filename = state.get_output(loan_id, output_format)
+        if saved_filename and saved_filename.exists():
+            return saved_filename
+    if not output_filename.exists():
+        return None
+    if state:
+        state.set_output(loan_id, output_format, output_filename, title)
+    return output_filename
+
+
 def merge_into_mp3(
     book_filename: Path,
     file_tracks: List[Dict],
@@ -378,6 +1505,7 @@ def merge_into_mp3(
     ffmpeg_loglevel: str,
     hide_progress: bool,
     logger: logging.Logger,
+    id3_padding: int = 0,
 ) -> None:
     """
     Merge the files into a single mp3
@@ -388,6 +1516,8 @@ def merge_into_mp3(
     :param ffmpeg_loglevel:
     :param hide_progress:
     :param logger:
+    :param id3_padding: Bytes of padding to reserve in the ID3v2 tag so that
+        tags can later be written in place without rewriting the audio
     :return:
     """
 
@@ -415,11 +1545,11 @@ def merge_into_mp3(
             (
                 f"{audio_bitrate}k" if audio_bitrate else "64k"
             ),  # explicitly set audio bitrate
-            "-f",
-            "mp3",
-            str(temp_book_filename),
         ]
     )
+    if id3_padding:
+        cmd.extend(["-metadata_header_padding", str(id3_padding)])
+    cmd.extend(["-f", "mp3", str(temp_book_filename)])
     exit_code = subprocess.call(cmd)
     if exit_code:
         logger.error(f"ffmpeg exited with the code: {exit_code!s}")
@@ -429,30 +1559,421 @@ def merge_into_mp3(
     temp_book_filename.replace(book_filename)
 
 
-def convert_to_m4b(
-    book_filename: Path,
+class TagOnlyFile:
+    """
+    Minimal stand-in for an eyed3 AudioFile that only parses the ID3 tag.
+    Used for large merged files where we do not need the audio info.
+    """
+
+    def __init__(self, path: Path, offset: int = 0):
+        """
+
+        :param path:
+        :param offset: File offset of the tag, e.g. after the space reserved
+                       at the start of a part download
+        """
+        self.path = str(path)
+        self.tag = eyed3.id3.Tag()
+        if not offset:
+            if not self.tag.parse(self.path):
+                self.tag = None
+            return
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            tag_data = f.read(10)
+            if tag_data[:3] == b"ID3":
+                tag_size = sum(b << (7 * (3 - i)) for i, b in enumerate(tag_data[6:10]))
+                tag_data += f.read(tag_size + (10 if tag_data[5] & 0x10 else 0))
+        # eyed3 only parses a tag at the start of a named file
+        tag_file = io.BytesIO(tag_data)
+        tag_file.name = self.path
+        if not self.tag.parse(tag_file):
+            self.tag = None
+
+    def initTag(self, version=eyed3.id3.ID3_DEFAULT_VERSION) -> eyed3.id3.Tag:
+        # pylint: disable=invalid-name
+        self.tag = eyed3.id3.Tag()
+        self.tag.version = version
+        self.tag.file_info = eyed3.id3.FileInfo(self.path)
+        return self.tag
+
+
+class Mp3File(TagOnlyFile):
+    """
+    Stand-in for an eyed3 AudioFile for downloaded parts.
+    The ID3 tag is parsed by eyed3 and the audio info comes from
+    :func:`odmpy.mp3.analyze_file` (or the download stream analysis)
+    so that each part is parsed only once.
+    """
+
+    def __init__(self, path: Path, info: Optional[Mp3Info] = None, offset: int = 0):
+        """
+
+        :param path:
+        :param info: Audio info from the download stream, if available
+        :param offset: File offset of the downloaded data, see `TagOnlyFile`
+        """
+        super().__init__(path, offset=offset)
+        info = info or analyze_file(path)
+        if not info:
+            raise ValueError(f"Unable to parse MP3 info from: {path}")
+        self.info: Mp3Info = info
+
+
+def estimate_id3_padding(
+    cover_bytes: Optional[bytes],
+    texts: Sequence[Optional[str]],
+    chapter_titles: Sequence[str],
+) -> int:
+    """
+    Estimate the ID3v2 padding needed to hold the tag frames that will be written
+    to a merged file, so that the tag can be saved without rewriting the audio.
+    Errs on the generous side since unused padding is only a few zero bytes.
+
+    :param cover_bytes:
+    :param texts: Text frame values, e.g. title, authors, description
+    :param chapter_titles:
+    :return:
+    """
+    # frame header + encoding byte + BOM + a bit extra for frames like TXXX/COMM descriptions
+    frame_overhead = 32
+    # text may be encoded as utf-16 which is at most 2x the utf-8 length
+    size = sum(2 * len(t.encode("utf-8")) + frame_overhead for t in texts if t)
+    if cover_bytes:
+        size += len(cover_bytes) + 64
+    # CHAP: frame header, element id, times/offsets, TIT2 sub-frame, + CTOC entry
+    size += sum(
+        2 * len(t.encode("utf-8")) + 2 * frame_overhead + 16 for t in chapter_titles
+    )
+    if chapter_titles:
+        size += 64  # CTOC frame
+    return size + 4096
+
+
+def _escape_ffmetadata(value: str) -> str:
+    """
+    Escape special characters in a ffmetadata value
+
+    :param value:
+    :return:
+    """
+    for c in ("\\", "=", ";", "#", "\n"):
+        value = value.replace(c, f"\\{c}")
+    return value
+
+
+def build_ffmetadata(
+    metadata: Dict[str, str], chapters: List[Tuple[str, int, int]]
+) -> str:
+    """
+    Generate the contents of a ffmetadata file.
+    Ref: https://ffmpeg.org/ffmpeg-formats.html#Metadata-1
+
+    :param metadata: Global tags
+    :param chapters: List of (title, start_ms, end_ms)
+    :return:
+    """
+    lines = [";FFMETADATA1"]
+    for k, v in metadata.items():
+        if v:
+            lines.append(f"{k}={_escape_ffmetadata(v)}")
+    for chapter_title, start_ms, end_ms in chapters:
+        lines.extend(
+            [
+                "[CHAPTER]",
+                "TIMEBASE=1/1000",
+                f"START={start_ms}",
+                f"END={end_ms}",
+                f"title={_escape_ffmetadata(chapter_title)}",
+            ]
+        )
+    return "\n".join(lines) + "\n"
+
+
+def build_m4b_metadata(
+    title: str,
+    sub_title: Optional[str],
+    authors: List[str],
+    narrators: Optional[List[str]],
+    publisher: str,
+    description: str,
+    genres: Optional[List[str]],
+    languages: Optional[List[str]],
+    published_date: Optional[str],
+    series: Optional[str] = None,
+    overdrive_id: str = "",
+    isbn: Optional[str] = None,
+    delimiter: str = ";",
+) -> Dict[str, str]:
+    """
+    Generate the global tags for a merged m4b, equivalent to the ID3 tags
+    that are carried over when converting a merged mp3, with the same keys that
+    ffmpeg reads the ID3 frames as. For example, the "Description" comment is
+    read as "description", and TXXX frames are read by their description.
+
+    :param title:
+    :param sub_title:
+    :param authors:
+    :param narrators:
+    :param publisher:
+    :param description:
+    :param genres:
+    :param languages:
+    :param published_date:
+    :param series:
+    :param overdrive_id:
+    :param isbn:
+    :param delimiter:
+    :return:
+    """
+    if not delimiter:
+        delimiter = ";"
+    metadata = {
+        "title": title,
+        "album": title,
+        "subtitle": sub_title or "",
+        "artist": delimiter.join(authors),
+        "album_artist": delimiter.join(authors),
+        "performer": delimiter.join(narrators or []),
+        "publisher": publisher,
+        "description": re.sub(re.compile("<.*?>"), "", description),
+        "genre": delimiter.join(genres or []),
+        "Series": series or "",
+        "ISBN": isbn or "",
+    }
+    if overdrive_id:
+        metadata[
+            "OverDrive Media ID" if overdrive_id.isdigit() else "OverDrive Reserve ID"
+        ] = overdrive_id
+    if languages:
+        try:
+            metadata["language"] = delimiter.join(_to_iso639_2b(languages))
+        except:  # noqa: E722, pylint: disable=bare-except
+            metadata["language"] = delimiter.join(languages)
+    if published_date:
+        metadata["date"] = LibbyClient.parse_datetime(published_date).strftime(
+            "%Y-%m-%d"
+        )
+    return metadata
+
+
+class AacSegment(NamedTuple):
+    path: Path
+    source_duration_ms: int
+    duration_ms: int
+
+
+def probe_duration_ms(file_path: Path) -> int:
+    """
+    Get the duration of a media file as ffmpeg sees it, e.g. when joining files.
+
+    :param file_path:
+    :return:
+    """
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "default=noprint_wrappers=1:nokey=1",
+        str(file_path),
+    ]
+    try:
+        return round(float(subprocess.check_output(cmd, text=True).strip()) * 1000)
+    except (OSError, subprocess.CalledProcessError, ValueError) as err:
+        raise OdmpyRuntimeError(f'Unable to get the duration of "{file_path}"') from err
+
+
+def align_chapters(
+    chapters: List[Tuple[str, int, int]], segments: List[AacSegment]
+) -> List[Tuple[str, int, int]]:
+    """
+    Shift the chapter times, which are based on the lengths of the source files,
+    to where the source files start in the joined segments. Each encoded segment
+    can be slightly longer or shorter than its source because of the AAC
+    priming and padding.
+
+    :param chapters: List of (title, start_ms, end_ms)
+    :param segments:
+    :return: List of (title, start_ms, end_ms)
+    """
+    source_starts = [0]
+    segment_starts = [0]
+    for segment in segments:
+        source_starts.append(source_starts[-1] + segment.source_duration_ms)
+        segment_starts.append(segment_starts[-1] + segment.duration_ms)
+
+    def align(time_ms: int) -> int:
+        i = max(bisect.bisect_right(source_starts, time_ms) - 1, 0)
+        if i >= len(segments):
+            return segment_starts[-1]
+        return min(
+            segment_starts[i] + time_ms - source_starts[i], segment_starts[i + 1]
+        )
+
+    return [
+        (chapter_title, align(start_ms), align(end_ms))
+        for chapter_title, start_ms, end_ms in chapters
+    ]
+
+
+def encode_aac_segments(
+    file_tracks: List[Dict],
+    merge_codec: str,
+    audio_bitrate: int,
+    jobs: int,
+    ffmpeg_loglevel: str,
+    logger: logging.Logger,
+) -> List[AacSegment]:
+    """
+    Encode each file into an AAC (mp4) segment, running up to `jobs` ffmpeg processes
+    concurrently. The segments can then be joined losslessly.
+
+    :param file_tracks:
+    :param merge_codec:
+    :param audio_bitrate:
+    :param jobs: Maximum number of concurrent ffmpeg processes
+    :param ffmpeg_loglevel:
+    :param logger:
+    :return: The segments, in the same order as `file_tracks`
+    """
+    segment_filenames = [Path(ft["file"]).with_suffix(".m4a") for ft in file_tracks]
+    encode_failed = threading.Event()
+
+    def encode_segment(source_filename: Path, segment_filename: Path) -> AacSegment:
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-nostdin",
+            "-hide_banner",
+            "-loglevel",
+            ffmpeg_loglevel,
+            "-i",
+            str(source_filename),
+            "-map",
+            "0:a",
+            "-map_metadata",
+            "-1",
+            "-c:a",
+            merge_codec,
+            "-b:a",
+            (
+                f"{audio_bitrate}k" if audio_bitrate else "64k"
+            ),  # explicitly set audio bitrate
+            "-f",
+            "mp4",
+            str(segment_filename),
+        ]
+        exit_code = subprocess.call(cmd)
+        if exit_code:
+            logger.error(f"ffmpeg exited with the code: {exit_code!s}")
+            logger.error(f"Command: {' '.join(cmd)!s}")
+            raise OdmpyRuntimeError("ffmpeg exited with a non-zero code")
+        return AacSegment(
+            path=segment_filename,
+            source_duration_ms=mp3_duration_ms(source_filename),
+            duration_ms=probe_duration_ms(segment_filename),
+        )
+
+    def encode(source_filename: Path, segment_filename: Path) -> AacSegment:
+        if encode_failed.is_set():
+            # a worker can take the next queued encode before the pending
+            # futures are cancelled, so don't start it
+            raise CancelledError()
+        try:
+            return encode_segment(source_filename, segment_filename)
+        except Exception:
+            encode_failed.set()
+            raise
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # subprocesses do the actual work, so threads are sufficient here
+            futures = [
+                executor.submit(encode, Path(ft["file"]), segment_filename)
+                for ft, segment_filename in zip(file_tracks, segment_filenames)
+            ]
+            try:
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except CancelledError:
+                        # skipped because another encode failed
+                        continue
+            except Exception:
+                # don't start the remaining encodes
+                for future in futures:
+                    future.cancel()
+                raise
+            return [future.result() for future in futures]
+    except Exception:
+        for segment_filename in segment_filenames:
+            if segment_filename.exists():
+                segment_filename.unlink()
+        raise
+
+
+def merge_into_m4b(
     book_m4b_filename: Path,
+    file_tracks: List[Dict],
     cover_filename: Path,
+    metadata: Dict[str, str],
+    chapters: List[Tuple[str, int, int]],
     merge_codec: str,
     audio_bitrate: int,
     ffmpeg_loglevel: str,
-    hide_progress: str,
+    hide_progress: bool,
     logger: logging.Logger,
+    jobs: int = 1,
 ) -> None:
     """
-    Converts the merged mp3 into a m4b
+    Merge the files directly into a m4b without generating an intermediate merged mp3.
+
+    If `jobs` is more than 1, each file is first encoded separately in parallel and
+    the encoded segments are then joined without re-encoding, with the chapters
+    aligned to the segments. Otherwise, the files are encoded in a single ffmpeg pass.
 
-    :param book_filename: mp3 file name
     :param book_m4b_filename:
+    :param file_tracks:
     :param cover_filename:
+    :param metadata: Global tags
+    :param chapters: List of (title, start_ms, end_ms)
     :param merge_codec:
     :param audio_bitrate:
     :param ffmpeg_loglevel:
     :param hide_progress:
     :param logger:
+    :param jobs: Maximum number of concurrent encoding processes
     :return:
     """
     temp_book_m4b_filename = book_m4b_filename.with_suffix(".part")
+    concat_list_filename = book_m4b_filename.with_suffix(".concat.txt")
+    ffmetadata_filename = book_m4b_filename.with_suffix(".ffmetadata.txt")
+
+    segment_filenames: List[Path] = []
+    if jobs > 1 and len(file_tracks) > 1:
+        segments = encode_aac_segments(
+            file_tracks=file_tracks,
+            merge_codec=merge_codec,
+            audio_bitrate=audio_bitrate,
+            jobs=jobs,
+            ffmpeg_loglevel=ffmpeg_loglevel,
+            logger=logger,
+        )
+        segment_filenames = [segment.path for segment in segments]
+        chapters = align_chapters(chapters, segments)
+    source_filenames = segment_filenames or [Path(ft["file"]) for ft in file_tracks]
+
+    with concat_list_filename.open("w", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for source_filename in source_filenames:
+            escaped_file_path = str(source_filename.absolute()).replace("'", "'\\''")
+            f.write(f"file '{escaped_file_path}'\n")
+    with ffmetadata_filename.open("w", encoding="utf-8") as f:
+        f.write(build_ffmetadata(metadata, chapters))
+
     cmd = [
         "ffmpeg",
         "-y",
@@ -465,30 +1986,39 @@ def convert_to_m4b(
         cmd.append("-stats")
     cmd.extend(
         [
+            "-f",
+            "concat",
+            "-safe",
+            "0",
             "-i",
-            str(book_filename),
+            str(concat_list_filename),
+            "-i",
+            str(ffmetadata_filename),
         ]
     )
     if cover_filename.exists():
         cmd.extend(["-i", str(cover_filename)])
 
-    cmd.extend(
-        [
-            "-map",
-            "0:a",
-            "-c:a",
-            merge_codec,
-            "-b:a",
-            (
-                f"{audio_bitrate}k" if audio_bitrate else "64k"
-            ),  # explicitly set audio bitrate
-        ]
-    )
+    cmd.extend(["-map", "0:a", "-map_metadata", "1", "-map_chapters", "1"])
+    if segment_filenames:
+        # segments are already encoded
+        cmd.extend(["-c:a", "copy"])
+    else:
+        cmd.extend(
+            [
+                "-c:a",
+                merge_codec,
+                "-b:a",
+                (
+                    f"{audio_bitrate}k" if audio_bitrate else "64k"
+                ),  # explicitly set audio bitrate
+            ]
+        )
     if cover_filename.exists():
         cmd.extend(
             [
                 "-map",
-                "1:v",
+                "2:v",
                 "-c:v",
                 "copy",
                 "-disposition:v:0",
@@ -497,18 +2027,108 @@ def convert_to_m4b(
         )
 
     cmd.extend(["-f", "mp4", str(temp_book_m4b_filename)])
-    exit_code = subprocess.call(cmd)
+    try:
+        exit_code = subprocess.call(cmd)
+    finally:
+        for temp_file in [
+            concat_list_filename,
+            ffmetadata_filename,
+        ] + segment_filenames:
+            try:
+                temp_file.unlink()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning(f'Error deleting "{temp_file}": {str(e)}')
     if exit_code:
         logger.error(f"ffmpeg exited with the code: {exit_code!s}")
         logger.error(f"Command: {' '.join(cmd)!s}")
         raise OdmpyRuntimeError("ffmpeg exited with a non-zero code")
 
-    temp_book_m4b_filename.rename(book_m4b_filename)
+    temp_book_m4b_filename.replace(book_m4b_filename)
     logger.info('Merged files into "%s"', colored(str(book_m4b_filename), "magenta"))
+
+
+def finalize_mp3(
+    part_tmp_filename: Path,
+    part_filename: Path,
+    mp3_info: Mp3Info,
+    tag_data: Optional[bytes],
+) -> None:
+    """
+    Write the ID3 tag and the repaired Xing/LAME header frame of a downloaded part.
+    This does the same job as `remux_mp3()` without rewriting the file again
+    when the tag is saved.
+
+    If the tag fits in the space before the audio, i.e. the downloaded tag and
+    any space reserved with `PartDownload.header_reserve`, the tag is padded
+    to fill it and the file is updated in place. Otherwise, the final file is
+    written in a single pass: the tag, the repaired header frame and then the audio.
+
+    :param part_tmp_filename: Downloaded file
+    :param part_filename: Final file
+    :param mp3_info: The analysis of the downloaded file
+    :param tag_data: The rendered ID3v2 tag. If None, the downloaded tag is kept as is.
+    :return:
+    """
+    info_frame = b""
+    if mp3_info.info_frame:
+        # check that the header can be repaired before writing anything
+        info_frame = repair_info_frame(
+            mp3_info.info_frame,
+            mp3_info.frame_count,
+            len(mp3_info.info_frame) + mp3_info.audio_size,
+        )
+
+    header_reserve = get_header_reserve(part_tmp_filename)
+    # file offset of the first MPEG frame
+    audio_offset = header_reserve + mp3_info.audio_offset
+    if (tag_data is None and not header_reserve) or (
+        tag_data is not None and len(tag_data) <= audio_offset
+    ):
+        with part_tmp_filename.open("r+b") as outfile:
+            if tag_data is not None:
+                outfile.write(_pad_id3_tag(tag_data, audio_offset))
+            if info_frame:
+                outfile.seek(audio_offset)
+                outfile.write(info_frame)
+        part_tmp_filename.replace(part_filename)
+        return
+
+    temp_filename = part_filename.with_name(f"{part_filename.name}.tmp")
     try:
-        book_filename.unlink()
-    except Exception as e:  # pylint: disable=broad-except
-        logger.warning(f'Error deleting "{book_filename}": {str(e)}')
+        with part_tmp_filename.open("rb") as infile, temp_filename.open(
+            "wb"
+        ) as outfile:
+            if tag_data is not None:
+                outfile.write(tag_data)
+                infile.seek(audio_offset)
+            else:
+                infile.seek(header_reserve)
+                outfile.write(infile.read(mp3_info.audio_offset))
+            if info_frame:
+                outfile.write(info_frame)
+                infile.seek(len(info_frame), os.SEEK_CUR)
+            shutil.copyfileobj(infile, outfile, 1024 * 1024)
+        temp_filename.replace(part_filename)
+    finally:
+        if temp_filename.exists():
+            temp_filename.unlink()
+    part_tmp_filename.unlink()
+
+
+def _pad_id3_tag(tag_data: bytes, size: int) -> bytes:
+    """
+    Pad a rendered ID3v2 tag (without a footer) to `size` bytes.
+
+    :param tag_data:
+    :param size:
+    :return:
+    """
+    return (
+        tag_data[:6]
+        + _syncsafe_bytes(size - 10)
+        + tag_data[10:]
+        + b"\x00" * (size - len(tag_data))
+    )
 
 
 def remux_mp3(
@@ -526,6 +2146,7 @@ def remux_mp3(
     :param logger:
     :return:
     """
+    strip_header_reserve(part_tmp_filename)
     cmd = [
         "ffmpeg",
         "-y",
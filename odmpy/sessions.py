@@ -0,0 +1,145 @@
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of odmpy.
+#
+# odmpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# odmpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import weakref
+from typing import Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter, Retry, DEFAULT_POOLSIZE
+
+#
+# Process-wide registry of requests sessions and connection pools so that
+# connections are kept alive and reused across clients, processors and hosts
+#
+
+_pool_settings = {
+    "pool_connections": DEFAULT_POOLSIZE,
+    "pool_maxsize": DEFAULT_POOLSIZE,
+}
+_sessions: Dict[Tuple[str, int], requests.Session] = {}
+# pooled adapter for each max_retries value, with its configured pool_maxsize
+_adapters: Dict[int, Tuple[HTTPAdapter, int]] = {}
+# every session the pooled adapters are mounted on, with its max_retries
+_mounted_sessions: "weakref.WeakKeyDictionary[requests.Session, int]" = (
+    weakref.WeakKeyDictionary()
+)
+_sessions_lock = threading.Lock()
+
+
+def configure_sessions(
+    pool_connections: int = DEFAULT_POOLSIZE, pool_maxsize: int = DEFAULT_POOLSIZE
+) -> None:
+    """
+    Set the connection pool sizes for sessions created by the registry.
+    Existing sessions are remounted with the new sizes.
+
+    :param pool_connections: Number of host connection pools to keep
+    :param pool_maxsize: Max number of connections to keep per host
+    :return:
+    """
+    with _sessions_lock:
+        _pool_settings["pool_connections"] = max(pool_connections, 1)
+        _pool_settings["pool_maxsize"] = max(pool_maxsize, 1)
+        for max_retries in list(_adapters):
+            _replace_adapter(max_retries, _pool_settings["pool_maxsize"])
+
+
+def _replace_adapter(max_retries: int, pool_maxsize: int) -> HTTPAdapter:
+    adapter = HTTPAdapter(
+        pool_connections=_pool_settings["pool_connections"],
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=max_retries, backoff_factor=0.1),
+    )
+    _adapters[max_retries] = (adapter, pool_maxsize)
+    for session, session_max_retries in list(_mounted_sessions.items()):
+        if session_max_retries == max_retries:
+            _mount_adapter(session, adapter)
+    return adapter
+
+
+def _mount_adapter(session: requests.Session, adapter: HTTPAdapter) -> None:
+    # noinspection HttpUrlsUsage
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, adapter)
+
+
+def _get_adapter(max_retries: int, pool_maxsize: int) -> HTTPAdapter:
+    adapter, adapter_pool_maxsize = _adapters.get(max_retries, (None, 0))
+    if adapter is None or pool_maxsize > adapter_pool_maxsize:
+        adapter = _replace_adapter(
+            max_retries, max(pool_maxsize, _pool_settings["pool_maxsize"])
+        )
+    return adapter
+
+
+def new_session(max_retries: int = 0, pool_maxsize: int = 0) -> requests.Session:
+    """
+    Create a session with its own state (e.g. cookies) that still shares the
+    connection pools of the other sessions.
+
+    :param max_retries:
+    :param pool_maxsize: Minimum number of connections to keep per host
+    :return:
+    """
+    with _sessions_lock:
+        session = requests.Session()
+        _mount_adapter(session, _get_adapter(max_retries, pool_maxsize))
+        _mounted_sessions[session] = max_retries
+        return session
+
+
+def get_session(
+    name: str = "default", max_retries: int = 0, pool_maxsize: int = 0
+) -> requests.Session:
+    """
+    Get a shared session. Sessions with state (e.g. cookies) that should not leak
+    to other clients should use `new_session()` instead.
+
+    :param name:
+    :param max_retries:
+    :param pool_maxsize: Minimum number of connections to keep per host,
+                         e.g. the number of concurrent downloads
+    :return:
+    """
+    key = (name, max_retries)
+    with _sessions_lock:
+        adapter = _get_adapter(max_retries, pool_maxsize)
+        session = _sessions.get(key)
+        if not session:
+            session = requests.Session()
+            _mount_adapter(session, adapter)
+            _mounted_sessions[session] = max_retries
+            _sessions[key] = session
+        return session
+
+
+def close_sessions() -> None:
+    """
+    Close and discard all shared sessions and connection pools.
+
+    :return:
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        for adapter, _ in _adapters.values():
+            adapter.close()
+        _sessions.clear()
+        _adapters.clear()
+        _mounted_sessions.clear()
@@ -0,0 +1,312 @@
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of odmpy.
+#
+# odmpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# odmpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, NamedTuple
+
+#
+# Local SQLite index of the loans and parts that have been downloaded
+#
+
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS loans (
+    loan_id TEXT NOT NULL,
+    output_format TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    output_path TEXT NOT NULL,
+    saved_at REAL NOT NULL,
+    PRIMARY KEY (loan_id, output_format)
+);
+CREATE TABLE IF NOT EXISTS parts (
+    loan_id TEXT NOT NULL,
+    part_number INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    saved_at REAL NOT NULL,
+    mtime_ns INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (loan_id, part_number)
+);
+"""
+
+# coarsest modification time resolution of the common file systems (FAT)
+MTIME_RESOLUTION = 2.0
+
+_states: Dict[Path, "DownloadState"] = {}
+_states_lock = threading.Lock()
+
+
+class SavedPart(NamedTuple):
+    path: Path
+    size: int
+    sha256: str
+    mtime_ns: int = 0
+    saved_at: float = 0.0
+
+    def is_unmodified(self, stat: os.stat_result) -> bool:
+        """
+        Check the part file size and modification time against the saved values.
+        The modification time is only trusted if the part was saved well after it was
+        last modified, otherwise a change right after it was saved can keep the same time.
+
+        :param stat: Current stat of the part file
+        :return:
+        """
+        return bool(
+            stat.st_size == self.size
+            and self.mtime_ns
+            and stat.st_mtime_ns == self.mtime_ns
+            and self.saved_at - self.mtime_ns / 1e9 >= MTIME_RESOLUTION
+        )
+
+    def is_intact(self) -> bool:
+        """
+        Check that the part file is still as it was saved, e.g. not truncated or replaced.
+        The checksum is only computed if the size matches and the modification time
+        cannot be trusted.
+
+        :return:
+        """
+        try:
+            stat = self.path.stat()
+            if stat.st_size != self.size:
+                return False
+            if self.is_unmodified(stat):
+                return True
+            return file_sha256(self.path) == self.sha256
+        except OSError:
+            return False
+
+
+def file_sha256(file_path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Get the SHA-256 hex digest of a file.
+
+    :param file_path:
+    :param chunk_size:
+    :return:
+    """
+    digest = hashlib.sha256()
+    with file_path.open("rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadState(object):
+    """
+    Records the saved output of each loan and its parts so that skip/resume
+    decisions do not depend on the output names generated for the current run,
+    e.g. after the book folder format is changed.
+    """
+
+    def __init__(self, db_path: Path):
+        """
+        Constructor.
+
+        :param db_path: SQLite database file
+        """
+        self.db_path = db_path
+        if not self.db_path.parent.exists():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # parts are recorded from the download worker threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            part_columns = [
+                row[1] for row in self._conn.execute("PRAGMA table_info(parts)")
+            ]
+            if "mtime_ns" not in part_columns:
+                # added in schema version 2
+                self._conn.execute(
+                    "ALTER TABLE parts ADD COLUMN mtime_ns INTEGER NOT NULL DEFAULT 0"
+                )
+            self._conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def get_output(self, loan_id: str, output_format: str) -> Optional[Path]:
+        """
+        Get the saved output of a loan.
+
+        :param loan_id:
+        :param output_format: e.g. mp3, m4b
+        :return: None if the loan has not been saved in this format
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output_path FROM loans WHERE loan_id = ? AND output_format = ?",
+                (loan_id, output_format),
+            ).fetchone()
+        return Path(row[0]) if row else None
+
+    def set_output(
+        self, loan_id: str, output_format: str, output_path: Path, title: str = ""
+    ) -> None:
+        """
+        Record the saved output of a loan.
+
+        :param loan_id:
+        :param output_format:
+        :param output_path:
+        :param title:
+        :return:
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO loans "
+                "(loan_id, output_format, title, output_path, saved_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    loan_id,
+                    output_format,
+                    title,
+                    str(output_path.absolute()),
+                    time.time(),
+                ),
+            )
+
+    def get_parts(self, loan_id: str) -> Dict[int, SavedPart]:
+        """
+        Get the saved parts of a loan.
+
+        :param loan_id:
+        :return: Saved parts by part number
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT part_number, path, size, sha256, mtime_ns, saved_at "
+                "FROM parts WHERE loan_id = ?",
+                (loan_id,),
+            ).fetchall()
+        return {
+            part_number: SavedPart(
+                path=Path(path),
+                size=size,
+                sha256=sha256,
+                mtime_ns=mtime_ns,
+                saved_at=saved_at,
+            )
+            for part_number, path, size, sha256, mtime_ns, saved_at in rows
+        }
+
+    def set_part(self, loan_id: str, part_number: int, part_path: Path) -> SavedPart:
+        """
+        Record a saved part.
+
+        :param loan_id:
+        :param part_number:
+        :param part_path:
+        :return:
+        """
+        stat = part_path.stat()
+        saved_part = SavedPart(
+            path=part_path.absolute(),
+            size=stat.st_size,
+            sha256=file_sha256(part_path),
+            mtime_ns=stat.st_mtime_ns,
+            saved_at=time.time(),
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parts "
+                "(loan_id, part_number, path, size, sha256, saved_at, mtime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    loan_id,
+                    part_number,
+                    str(saved_part.path),
+                    saved_part.size,
+                    saved_part.sha256,
+                    saved_part.saved_at,
+                    saved_part.mtime_ns,
+                ),
+            )
+        return saved_part
+
+    def verify_part(
+        self, loan_id: str, part_number: int, saved_part: SavedPart
+    ) -> bool:
+        """
+        Check that a saved part is intact. If the checksum had to be computed,
+        the current modification time is recorded so that it is not computed again.
+
+        :param loan_id:
+        :param part_number:
+        :param saved_part:
+        :return:
+        """
+        try:
+            stat = saved_part.path.stat()
+            if stat.st_size != saved_part.size:
+                return False
+            if saved_part.is_unmodified(stat):
+                return True
+            if file_sha256(saved_part.path) != saved_part.sha256:
+                return False
+        except OSError:
+            return False
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE parts SET mtime_ns = ?, saved_at = ? "
+                "WHERE loan_id = ? AND part_number = ?",
+                (stat.st_mtime_ns, time.time(), loan_id, part_number),
+            )
+        return True
+
+    def clear_parts(self, loan_id: str) -> None:
+        """
+        Remove the saved parts of a loan, e.g. after they are merged and deleted.
+
+        :param loan_id:
+        :return:
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM parts WHERE loan_id = ?", (loan_id,))
+
+
+def get_state(state_db: Optional[str]) -> Optional[DownloadState]:
+    """
+    Get the shared state instance for a database file.
+
+    :param state_db:
+    :return: None if state_db is not set
+    """
+    if not state_db:
+        return None
+    db_path = Path(state_db).expanduser().absolute()
+    with _states_lock:
+        if db_path in _states and not db_path.exists():
+            # the database was removed, so start over with a new one
+            _states.pop(db_path).close()
+        if db_path not in _states:
+            _states[db_path] = DownloadState(db_path)
+        return _states[db_path]
@@ -25,7 +25,7 @@ from mimetypes import guess_type
 from pathlib import Path
 from typing import Optional
 
-from mutagen.mp3 import MP3  # type: ignore[import]
+from .mp3 import analyze_file, read_header_duration_ms
 
 #
 # Small utility type functions used across the board
@@ -165,11 +165,16 @@ def mp3_duration_ms(filename: Path) -> int:
     # eyeD3's audio length function:
     # audiofile.info.time_secs
     # returns incorrect times due to its header computation
-    # mutagen does not have this issue
-    audio = MP3(filename)
-    if not audio.info:
+    # mutagen does not have this issue. Like mutagen, the Xing/Info frame count
+    # is used if the file has one, and the frames are only counted if it does not
+    # or the file is shorter than the header says
+    duration_ms = read_header_duration_ms(filename)
+    if duration_ms is not None:
+        return duration_ms
+    info = analyze_file(filename)
+    if not info:
         raise ValueError(f"Unable to parse MP3 info from: {filename}")
-    return int(round(audio.info.length * 1000))
+    return info.duration_ms
 
 
 # From django
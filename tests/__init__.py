@@ -8,3 +8,8 @@ from .odmpy_libby_tests import OdmpyLibbyTests
 from .odmpy_dl_tests import OdmpyDlTests
 from .odmpy_shared_tests import ProcessingSharedTests
 from .overdrive_tests import OverDriveClientTests
+from .http_cache_tests import HttpCacheTests
+from .sessions_tests import SessionsTests
+from .mp3_tests import Mp3Tests
+from .import_tests import ImportTests
+from .state_tests import StateTests
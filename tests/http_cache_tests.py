@@ -0,0 +1,88 @@
+import os
+
+import requests
+import responses
+
+from odmpy.http_cache import HttpCache, get_cache
+from odmpy.overdrive import OverDriveClient, THUNDER_API_URL
+from tests.base import BaseTestCase
+
+
+class HttpCacheTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = self.test_downloads_dir.joinpath("cache")
+        self.cache = HttpCache(self.cache_dir)
+
+    @responses.activate
+    def test_revalidate(self):
+        media_url = f"{THUNDER_API_URL}media/123?x-client-id=dewey"
+        media = {"id": "123", "title": "Test"}
+        responses.get(media_url, json=media, headers={"ETag": '"v1"'})
+        responses.get(media_url, status=304, headers={"ETag": '"v1"'})
+
+        client = OverDriveClient(cache=self.cache)
+        self.assertEqual(client.media("123"), media)
+        self.assertNotIn("If-None-Match", responses.calls[0].request.headers)
+        # served from the cache after a 304
+        self.assertEqual(client.media("123"), media)
+        self.assertEqual(responses.calls[1].request.headers["If-None-Match"], '"v1"')
+
+    @responses.activate
+    def test_no_validator(self):
+        url = "https://example.com/nocache.css"
+        responses.get(url, body="body {}")
+        responses.get(url, body="body { margin: 0; }")
+
+        session = requests.Session()
+        for expected in ("body {}", "body { margin: 0; }"):
+            res = self.cache.send(
+                session, session.prepare_request(requests.Request("GET", url))
+            )
+            self.assertEqual(res.text, expected)
+        self.assertNotIn("If-None-Match", responses.calls[1].request.headers)
+        self.assertEqual(list(self.cache_dir.glob("*/*.body")), [])
+
+    @responses.activate
+    def test_vary_headers(self):
+        url = "https://example.com/vary"
+        session = requests.Session()
+        responses.get(
+            url, body="a", headers={"Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        )
+        responses.get(
+            url, body="b", headers={"Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        )
+        for accept, expected in (("text/html", "a"), ("text/plain", "b")):
+            res = self.cache.send(
+                session,
+                session.prepare_request(
+                    requests.Request("GET", url, headers={"Accept": accept})
+                ),
+            )
+            self.assertEqual(res.text, expected)
+        # different Accept header so the request is not conditional
+        self.assertNotIn("If-Modified-Since", responses.calls[1].request.headers)
+
+    @responses.activate
+    def test_evict(self):
+        cache = HttpCache(self.cache_dir, max_size=2500)
+        session = requests.Session()
+        for i in range(3):
+            url = f"https://example.com/{i}.jpg"
+            responses.get(url, body=b"0" * 1000, headers={"ETag": f'"{i}"'})
+            cache.send(session, session.prepare_request(requests.Request("GET", url)))
+            # make sure mtimes are distinct
+            for body_file in self.cache_dir.glob("*/*.body"):
+                stat = body_file.stat()
+                os.utime(body_file, (stat.st_atime, stat.st_mtime - 10))
+
+        body_files = list(self.cache_dir.glob("*/*.body"))
+        self.assertEqual(len(body_files), 2)
+        self.assertFalse(
+            cache.get(HttpCache.cache_key("https://example.com/0.jpg", {}))
+        )
+
+    def test_get_cache(self):
+        self.assertIsNone(get_cache(""))
+        self.assertIs(get_cache(str(self.cache_dir)), get_cache(str(self.cache_dir)))
@@ -0,0 +1,116 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+from tests.base import test_logger
+
+# modules that the cli should only load when a command needs them
+HEAVY_MODULES = (
+    "eyed3",
+    "bs4",
+    "iso639",
+    "mutagen",
+    "tqdm",
+    "odmpy.processing.odm",
+    "odmpy.processing.audiobook",
+    "odmpy.processing.ebook",
+    "odmpy.processing.shared",
+)
+
+
+class ImportTests(unittest.TestCase):
+    @staticmethod
+    def _run_python(code: str) -> subprocess.CompletedProcess:
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [str(Path(__file__).absolute().parent.parent)]
+            + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+        )
+        return subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    def _loaded_modules(self, code: str) -> list:
+        # the loaded modules are dumped as the last line of stdout
+        res = self._run_python(
+            code + "\nimport sys, json\nprint(json.dumps(sorted(sys.modules)))"
+        )
+        return json.loads(res.stdout.strip().splitlines()[-1])
+
+    def assertNotLoaded(self, modules: list, names: tuple) -> None:
+        loaded = [
+            m for m in modules if any(m == n or m.startswith(n + ".") for n in names)
+        ]
+        self.assertEqual(loaded, [], "Unexpected modules imported")
+
+    def test_cli_import_time(self):
+        res = self._run_python("import odmpy.odm")
+        # -X importtime lines: "import time: self [us] | cumulative | imported package"
+        mobj = re.search(
+            r"^import time:\s+\d+\s+\|\s+(?P<cumulative>\d+)\s+\|\s*odmpy\.odm$",
+            res.stderr,
+            re.MULTILINE,
+        )
+        self.assertIsNotNone(mobj)
+        imported = re.findall(r"\|\s*(\S+)$", res.stderr, re.MULTILINE)
+        test_logger.info(
+            "odmpy.odm import time: %.1fms", int(mobj.group("cumulative")) / 1000
+        )
+        self.assertNotLoaded(imported, HEAVY_MODULES)
+
+    def test_cli_help(self):
+        modules = self._loaded_modules(
+            "from odmpy.odm import run\n"
+            "try:\n"
+            "    run(['--help'], be_quiet=True)\n"
+            "except SystemExit:\n"
+            "    pass"
+        )
+        self.assertIn("odmpy.odm", modules)
+        self.assertNotIn("eyed3", modules)
+        self.assertNotLoaded(modules, HEAVY_MODULES)
+
+    def test_cli_return(self):
+        odm_file = Path(__file__).absolute().parent.joinpath("data", "test1.odm")
+        modules = self._loaded_modules(
+            "import responses\n"
+            "from odmpy.odm import run\n"
+            "with responses.RequestsMock() as rsps:\n"
+            "    rsps.get('https://ping.github.io/odmpy/test_data')\n"
+            f"    run(['--noversioncheck', 'ret', {str(odm_file)!r}], be_quiet=True)"
+        )
+        self.assertIn("odmpy.processing.odm", modules)
+        self.assertNotIn("eyed3", modules)
+        self.assertNotLoaded(
+            modules,
+            tuple(m for m in HEAVY_MODULES if m != "odmpy.processing.odm"),
+        )
+
+    def test_processing_lazy_imports(self):
+        modules = self._loaded_modules(
+            "from odmpy import processing\n"
+            "assert callable(processing.process_odm_return)"
+        )
+        self.assertIn("odmpy.processing.odm", modules)
+        self.assertNotLoaded(
+            modules,
+            tuple(m for m in HEAVY_MODULES if m != "odmpy.processing.odm"),
+        )
+
+        modules = self._loaded_modules(
+            "from odmpy.processing import process_ebook_loan, process_audiobook_loan"
+        )
+        self.assertIn("odmpy.processing.ebook", modules)
+        self.assertIn("odmpy.processing.audiobook", modules)
+        self.assertNotLoaded(modules, ("iso639",))
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run_python("from odmpy import processing; processing.process_x")
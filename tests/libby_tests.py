@@ -1,9 +1,15 @@
+import base64
+import io
+import json
 import logging
 import os
 import unittest
 from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+from email.message import Message
 from http import HTTPStatus
+from unittest.mock import patch, MagicMock
+from urllib.error import HTTPError
 
 import responses
 from responses import matchers
@@ -17,6 +23,7 @@ from odmpy.libby import (
     LibbyFormats,
 )
 from odmpy.libby_errors import ClientBadRequestError, ClientError
+from odmpy.utils import is_windows
 from tests.base import BaseTestCase, is_on_ci
 
 test_logger = logging.getLogger(__name__)
@@ -521,6 +528,163 @@ class LibbyClientTests(BaseTestCase):
                             self.assertTrue(form_variables.get(k))
                             self.assertIn("enabled", form_variables[k])
 
+    @responses.activate
+    def test_sync_snapshot(self):
+        client = LibbyClient(logger=self.logger, identity_token=".")
+        sync_url = f"{client.api_base}chip/sync"
+        responses.get(sync_url, json={"result": "synchronized", "cards": [{}]})
+        self.assertTrue(client.is_logged_in())
+        client.get_loans()
+        client.get_holds()
+        self.assertEqual(len(responses.calls), 1)
+
+        loan = {"id": "123456", "cardId": "99999"}
+        responses.delete(
+            f'{client.api_base}card/{loan["cardId"]}/loan/{loan["id"]}', body=""
+        )
+        client.return_loan(loan)
+        client.sync()
+        self.assertEqual(
+            len([c for c in responses.calls if c.request.url == sync_url]), 2
+        )
+
+        client.sync_ttl = 0
+        client.sync()
+        self.assertEqual(
+            len([c for c in responses.calls if c.request.url == sync_url]), 3
+        )
+
+    def test_chip_needs_renewal(self):
+        def make_token(expiry: datetime) -> str:
+            claims = json.dumps({"exp": int(expiry.timestamp())}).encode("utf-8")
+            return ".".join(
+                [
+                    "header",
+                    base64.urlsafe_b64encode(claims).decode("ascii").rstrip("="),
+                    "signature",
+                ]
+            )
+
+        settings_folder = self._generate_fake_settings()
+        client = LibbyClient(settings_folder=str(settings_folder))
+        # expiry unknown and never renewed
+        self.assertTrue(client.chip_needs_renewal())
+
+        now = datetime.now(tz=timezone.utc)
+        client.save_settings({"identity": make_token(now + timedelta(days=7))})
+        self.assertEqual(
+            int(client.identity_expiry().timestamp()),
+            int((now + timedelta(days=7)).timestamp()),
+        )
+        self.assertFalse(client.chip_needs_renewal())
+        client.save_settings({"identity": make_token(now + timedelta(hours=1))})
+        self.assertTrue(client.chip_needs_renewal())
+
+        # fallback to the last renewal time
+        client.save_settings(
+            {"identity": "abcdefgh", "__odmpy_chip_renewed": now.timestamp()}
+        )
+        self.assertIsNone(client.identity_expiry())
+        self.assertFalse(client.chip_needs_renewal())
+        self.assertFalse(client.renew_chip_if_needed())
+
+    @responses.activate
+    @patch("urllib.request.OpenerDirector.open")
+    def test_download_loan_file(self, mock_opener):
+        client = LibbyClient(logger=self.logger, identity_token=".")
+        responses.get(
+            f"{client.api_base}card/99999/loan/123456/fulfill/ebook-pdf-open",
+            status=302,
+            headers={"Location": "https://openepub-gk.cdn.overdrive.com/123456"},
+        )
+        body = b"%PDF-1.4" + b"0" * 200000
+        file_path = self.test_downloads_dir.joinpath("test.pdf")
+        part_file_path = self.test_downloads_dir.joinpath("test.pdf.part")
+        part_file_path.write_bytes(body[:1000])
+
+        opener_open = MagicMock()
+        opener_open.status = 206
+        opener_open.headers = {
+            "Content-Range": f"bytes 1000-{len(body) - 1}/{len(body)}"
+        }
+        opener_open.read.side_effect = io.BytesIO(body[1000:]).read
+        mock_opener.return_value = opener_open
+        progress = []
+        client.download_loan_file(
+            "123456",
+            "99999",
+            LibbyFormats.EBookPDFOpen,
+            file_path,
+            progress_callback=progress.append,
+        )
+        self.assertEqual(mock_opener.call_args[0][0].get_header("Range"), "bytes=1000-")
+        self.assertEqual(file_path.read_bytes(), body)
+        self.assertFalse(part_file_path.exists())
+        self.assertEqual(sum(progress), len(body) - 1000)
+        # streamed in chunks
+        self.assertGreater(len(progress), 1)
+
+        # part file is already complete
+        part_file_path.write_bytes(body)
+        part_file_path.with_name(f"{part_file_path.name}.validator").write_text(
+            '"abc"', encoding="utf-8"
+        )
+        mock_opener.reset_mock()
+        mock_opener.return_value = None
+        mock_opener.side_effect = HTTPError(
+            "https://openepub-gk.cdn.overdrive.com/123456",
+            416,
+            "Range Not Satisfiable",
+            Message(),
+            None,
+        )
+        mock_opener.side_effect.headers["Content-Range"] = f"bytes */{len(body)}"
+        progress = []
+        client.download_loan_file(
+            "123456",
+            "99999",
+            LibbyFormats.EBookPDFOpen,
+            file_path,
+            progress_callback=progress.append,
+        )
+        req = mock_opener.call_args[0][0]
+        self.assertEqual(req.get_header("Range"), f"bytes={len(body)}-")
+        self.assertEqual(req.get_header("If-range"), '"abc"')
+        self.assertEqual(file_path.read_bytes(), body)
+        self.assertFalse(part_file_path.exists())
+        self.assertFalse(
+            part_file_path.with_name(f"{part_file_path.name}.validator").exists()
+        )
+        self.assertEqual(sum(progress), 0)
+
+        # range does not match the part file, so start over
+        part_file_path.write_bytes(b"x" * 1000)
+        mismatched_res = MagicMock()
+        mismatched_res.status = 206
+        mismatched_res.headers = {
+            "Content-Range": f"bytes 0-{len(body) - 1}/{len(body)}"
+        }
+        full_res = MagicMock()
+        full_res.status = 200
+        full_res.headers = {"ETag": '"def"'}
+        full_res.read.side_effect = io.BytesIO(body).read
+        mock_opener.reset_mock()
+        mock_opener.side_effect = [mismatched_res, full_res]
+        progress = []
+        client.download_loan_file(
+            "123456",
+            "99999",
+            LibbyFormats.EBookPDFOpen,
+            file_path,
+            progress_callback=progress.append,
+        )
+        self.assertEqual(mock_opener.call_count, 2)
+        self.assertIsNone(mock_opener.call_args[0][0].get_header("Range"))
+        mismatched_res.read.assert_not_called()
+        self.assertEqual(file_path.read_bytes(), body)
+        self.assertFalse(part_file_path.exists())
+        self.assertEqual(sum(progress), len(body) - 1000)
+
     def test_has_chip(self):
         client = LibbyClient(logger=self.logger, identity_token=".")
         self.assertFalse(client.has_chip())
@@ -683,3 +847,75 @@ class LibbyClientTests(BaseTestCase):
 
         with self.assertRaises(ValueError):
             LibbyClient.parse_datetime("2023/05/30 23:01:14")
+
+    def test_loan_cache(self):
+        settings_folder = self.test_downloads_dir.joinpath("settings")
+        loan = {
+            "id": "9999999",
+            "cardId": "123456789",
+            "checkoutDate": "2023-05-30T08:00:01Z",
+            "type": {"id": "audiobook"},
+        }
+        with self.test_data_dir.joinpath("audiobook", "openbook.json").open(
+            "r", encoding="utf-8"
+        ) as o:
+            openbook = json.load(o)
+        prepared_loans = []
+
+        def prepare_loan(client, prepared_loan):
+            # opening a loan sets the content cookie
+            prepared_loans.append(prepared_loan)
+            client.libby_session.cookies.set("_sscl_d", "abc", domain="localhost")
+            return "http://localhost/mock/", dict(openbook)
+
+        with patch.object(LibbyClient, "prepare_loan", new=prepare_loan):
+            client = LibbyClient(
+                settings_folder=str(settings_folder),
+                logger=self.logger,
+                identity_token=".",
+            )
+            expected_openbook, expected_toc = client.process_audiobook(
+                loan, use_cache=True
+            )
+            self.assertEqual(len(prepared_loans), 1)
+            cache_files = list(settings_folder.joinpath("loans").glob("*.json"))
+            self.assertEqual(len(cache_files), 1)
+            cache_file = cache_files[0]
+            if not is_windows():
+                self.assertEqual(cache_file.stat().st_mode & 0o777, 0o600)
+            client.libby_session.cookies.clear()
+
+            # new run, e.g. resuming a download
+            client = LibbyClient(
+                settings_folder=str(settings_folder),
+                logger=self.logger,
+                identity_token=".",
+            )
+            openbook, toc = client.process_audiobook(loan, use_cache=True)
+            self.assertEqual(len(prepared_loans), 1)
+            self.assertEqual(openbook, expected_openbook)
+            self.assertEqual(toc, expected_toc)
+            self.assertIsInstance(list(toc.values())[0]["chapters"][0], ChapterMarker)
+            self.assertEqual(client.libby_session.cookies.get("_sscl_d"), "abc")
+
+            # a new checkout is not served from the cache
+            client.process_audiobook(
+                dict(loan, checkoutDate="2023-06-30T08:00:01Z"), use_cache=True
+            )
+            self.assertEqual(len(prepared_loans), 2)
+
+            # only the content cookies are cached
+            client.libby_session.cookies.set("api", "xyz", domain="sentry.libbyapp.com")
+            refreshed_toc = client.refresh_loan(loan)
+            self.assertEqual(len(prepared_loans), 3)
+            self.assertEqual(refreshed_toc, expected_toc)
+            with cache_file.open("r", encoding="utf-8") as f:
+                self.assertEqual(
+                    [c["name"] for c in json.load(f)["cookies"]], ["_sscl_d"]
+                )
+            client.process_audiobook(loan, use_cache=True)
+            self.assertEqual(len(prepared_loans), 3)
+
+            client.clear_loan_cache(loan)
+            client.process_audiobook(loan, use_cache=True)
+            self.assertEqual(len(prepared_loans), 4)
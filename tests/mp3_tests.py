@@ -0,0 +1,217 @@
+from unittest.mock import patch
+
+import eyed3  # type: ignore[import]
+from mutagen.mp3 import MP3  # type: ignore[import]
+
+from odmpy.mp3 import (
+    Mp3StreamAnalyzer,
+    analyze_file,
+    read_header_duration_ms,
+    repair_info_frame,
+)
+from odmpy.utils import mp3_duration_ms
+from tests.base import BaseTestCase
+
+
+class Mp3Tests(BaseTestCase):
+    def test_analyze_file(self):
+        mp3_files = sorted(self.test_data_dir.joinpath("audiobook").glob("**/*.mp3"))
+        self.assertTrue(mp3_files)
+        for mp3_file in mp3_files:
+            with self.subTest(mp3=mp3_file.name):
+                info = analyze_file(mp3_file)
+                self.assertIsNotNone(info)
+                audio = MP3(mp3_file)
+                self.assertEqual(info.duration_ms, round(audio.info.length * 1000))
+                # MPEGInfo attributes are set dynamically
+                # pylint: disable=no-member
+                self.assertEqual(info.bitrate, audio.info.bitrate // 1000)
+                self.assertEqual(info.sample_rate, audio.info.sample_rate)
+                # pylint: enable=no-member
+                self.assertFalse(info.is_vbr)
+                tag = eyed3.load(mp3_file).tag
+                self.assertEqual(
+                    info.user_texts["OverDrive MediaMarkers"],
+                    tag.user_text_frames.get("OverDrive MediaMarkers").text,
+                )
+
+    def test_stream_chunks(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        data = mp3_file.read_bytes()
+        expected = analyze_file(mp3_file)
+        for chunk_size in (1, 97, 4096):
+            with self.subTest(chunk_size=chunk_size):
+                analyzer = Mp3StreamAnalyzer()
+                for offset in range(0, len(data), chunk_size):
+                    analyzer.feed(data[offset : offset + chunk_size], offset)
+                self.assertEqual(analyzer.position, len(data))
+                self.assertEqual(analyzer.info(), expected)
+
+        # restarted stream
+        analyzer = Mp3StreamAnalyzer()
+        analyzer.feed(data[:5000], 0)
+        analyzer.feed(data, 0)
+        self.assertEqual(analyzer.info(), expected)
+
+        # gap in the stream
+        analyzer = Mp3StreamAnalyzer()
+        analyzer.feed(data[:5000], 0)
+        analyzer.feed(data[6000:], 6000)
+        self.assertIsNone(analyzer.info())
+        self.assertTrue(analyzer.error)
+
+    def test_encoder_delay(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        lame_info = analyze_file(mp3_file)
+        data = bytearray(mp3_file.read_bytes())
+        encoder_offset = data.index(b"LAME3.99r")
+        self.assertGreater(encoder_offset, lame_info.audio_offset)
+        lame_samples = lame_info.duration_ms * lame_info.sample_rate / 1000
+        # the LAME encoder delay and padding is subtracted, as with mutagen
+        self.assertLess(lame_samples, lame_info.frame_count * 576)
+
+        # the same part encoded by ffmpeg, which has a Lavf tag with the same delay
+        data[encoder_offset : encoder_offset + 9] = b"Lavf58.76"
+        part_file = self.test_downloads_dir.joinpath("lavf.mp3")
+        part_file.write_bytes(data)
+        part_info = analyze_file(part_file)
+        self.assertEqual(
+            part_info.duration_ms, round(MP3(part_file).info.length * 1000)
+        )
+        self.assertEqual(
+            part_info.duration_ms,
+            round(part_info.frame_count * 576 * 1000 / part_info.sample_rate),
+        )
+
+        # the parts joined with all their frames, as when merged
+        parts_count = 4
+        audio_start = part_info.audio_offset + len(part_info.info_frame)
+        audio_frames = bytes(data[audio_start : audio_start + part_info.audio_size])
+        merged_info_frame = repair_info_frame(
+            part_info.info_frame,
+            part_info.frame_count * parts_count,
+            len(part_info.info_frame) + part_info.audio_size * parts_count,
+        )
+        merged_file = self.test_downloads_dir.joinpath("merged.mp3")
+        merged_file.write_bytes(merged_info_frame + audio_frames * parts_count)
+        merged_info = analyze_file(merged_file)
+        self.assertEqual(
+            merged_info.duration_ms, round(MP3(merged_file).info.length * 1000)
+        )
+        # the part durations add up to the merged duration, less rounding
+        self.assertAlmostEqual(
+            merged_info.duration_ms,
+            part_info.duration_ms * parts_count,
+            delta=parts_count,
+        )
+
+    def test_not_mp3(self):
+        analyzer = Mp3StreamAnalyzer()
+        analyzer.feed(b"\x00" * 1024 * 1024)
+        self.assertIsNone(analyzer.info())
+        self.assertIsNone(
+            analyze_file(self.test_data_dir.joinpath("test1.odm")),
+        )
+
+    def test_unparsed_id3_tag(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        expected = analyze_file(mp3_file)
+        data = bytearray(mp3_file.read_bytes())
+        self.assertEqual(data[:3], b"ID3")
+        # flag the tag as unsynchronised
+        data[5] |= 0x80
+        unsync_file = self.test_downloads_dir.joinpath("unsync.mp3")
+        unsync_file.write_bytes(data)
+        info = analyze_file(unsync_file)
+        self.assertIsNone(info.user_texts)
+        self.assertEqual(info, expected._replace(user_texts=None))
+
+    def test_mp3_duration_ms(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        data = bytearray(mp3_file.read_bytes())
+        encoder_offset = data.index(b"LAME3.99r")
+        # same length as mutagen for LAME (delay trimmed) and Lavf (not trimmed) tags
+        for encoder in (b"LAME3.99r", b"Lavf58.76", b"Lavc58.13"):
+            with self.subTest(encoder=encoder):
+                data[encoder_offset : encoder_offset + 9] = encoder
+                test_file = self.test_downloads_dir.joinpath("duration.mp3")
+                test_file.write_bytes(data)
+                self.assertEqual(
+                    mp3_duration_ms(test_file),
+                    round(MP3(test_file).info.length * 1000),
+                )
+        with self.assertRaises(ValueError):
+            mp3_duration_ms(self.test_data_dir.joinpath("test1.odm"))
+
+    def test_mp3_duration_ms_header(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        expected = analyze_file(mp3_file)
+        # the frame count in the Info header is used without scanning the frames
+        with patch("odmpy.utils.analyze_file", wraps=analyze_file) as mock_analyze:
+            self.assertEqual(mp3_duration_ms(mp3_file), expected.duration_ms)
+            mock_analyze.assert_not_called()
+        self.assertEqual(read_header_duration_ms(mp3_file), expected.duration_ms)
+
+        data = bytearray(mp3_file.read_bytes())
+        test_file = self.test_downloads_dir.joinpath("duration.mp3")
+        # truncated, so the frames are counted instead
+        test_file.write_bytes(data[: len(data) // 2])
+        self.assertIsNone(read_header_duration_ms(test_file))
+        with patch("odmpy.utils.analyze_file", wraps=analyze_file) as mock_analyze:
+            self.assertEqual(
+                mp3_duration_ms(test_file), analyze_file(test_file).duration_ms
+            )
+            mock_analyze.assert_called_once()
+        self.assertLess(mp3_duration_ms(test_file), expected.duration_ms)
+
+        # no frame count in the Info header
+        info_offset = data.index(b"Info", expected.audio_offset)
+        data[info_offset + 7] &= 0xFE
+        test_file.write_bytes(data)
+        self.assertIsNone(read_header_duration_ms(test_file))
+        self.assertEqual(
+            mp3_duration_ms(test_file), analyze_file(test_file).duration_ms
+        )
+
+    def test_repair_info_frame(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        info = analyze_file(mp3_file)
+        stream_size = len(info.info_frame) + info.audio_size
+        # already correct
+        self.assertEqual(
+            repair_info_frame(info.info_frame, info.frame_count, stream_size),
+            info.info_frame,
+        )
+
+        # header from a longer stream
+        data = bytearray(mp3_file.read_bytes())
+        frame_count_offset = info.audio_offset + info.info_frame.index(b"Info") + 8
+        data[frame_count_offset : frame_count_offset + 4] = (
+            info.frame_count + 100
+        ).to_bytes(4, "big")
+        broken_file = self.test_downloads_dir.joinpath("broken.mp3")
+        broken_file.write_bytes(data)
+        broken_info = analyze_file(broken_file)
+        self.assertEqual(broken_info.frame_count, info.frame_count)
+        # encoder delay/padding is not applied
+        self.assertGreater(broken_info.duration_ms, info.duration_ms)
+
+        repaired_frame = repair_info_frame(
+            broken_info.info_frame, broken_info.frame_count, stream_size
+        )
+        self.assertEqual(len(repaired_frame), len(info.info_frame))
+        data[info.audio_offset : info.audio_offset + len(repaired_frame)] = (
+            repaired_frame
+        )
+        repaired_file = self.test_downloads_dir.joinpath("repaired.mp3")
+        repaired_file.write_bytes(data)
+        self.assertEqual(
+            analyze_file(repaired_file),
+            broken_info._replace(info_frame=repaired_frame),
+        )
+        self.assertEqual(
+            round(MP3(repaired_file).info.length * 1000), broken_info.duration_ms
+        )
+
+        with self.assertRaises(ValueError):
+            repair_info_frame(b"\x00" * 208, 1, 208)
@@ -6,6 +6,7 @@ import responses
 from mutagen.mp3 import MP3
 
 from odmpy.odm import run
+from odmpy.state import get_state
 from .base import BaseTestCase
 from .data import (
     part_title_formats,
@@ -165,6 +166,106 @@ class OdmpyDlTests(BaseTestCase):
                             markers[test_odm_file][j + i - 1],
                         )
 
+    @responses.activate
+    def test_state_db(self):
+        """
+        `odmpy dl test.odm --statedb state.sqlite3`
+        """
+        test_odm_file = "test1.odm"
+        expected_result = get_expected_result(self.test_downloads_dir, test_odm_file)
+        state_db = self.test_downloads_dir.joinpath("state.sqlite3")
+        self._setup_common_responses()
+        run_command = [
+            "--noversioncheck",
+            "dl",
+            str(self.test_data_dir.joinpath(test_odm_file)),
+            "--downloaddir",
+            str(self.test_downloads_dir),
+            "--statedb",
+            str(state_db),
+            "--hideprogress",
+        ]
+        run(run_command, be_quiet=True)
+        mp3_calls = [c for c in responses.calls if c.request.url.endswith(".mp3")]
+        self.assertEqual(len(mp3_calls), expected_result.total_parts)
+        state = get_state(str(state_db))
+        # the odm id
+        saved_parts = state.get_parts("0fef5121-bb1f-42a5-b62a-d9fded939d50-425")
+        self.assertEqual(len(saved_parts), expected_result.total_parts)
+        for part_number, saved_part in saved_parts.items():
+            self.assertEqual(
+                saved_part.path,
+                expected_result.book_folder.joinpath(
+                    expected_result.mp3_name_format.format(part_number)
+                ).absolute(),
+            )
+            self.assertEqual(saved_part.size, saved_part.path.stat().st_size)
+
+        # saved parts are found even after the book folder format is changed
+        run(run_command + ["--bookfolderformat", "%(Title)s moved"], be_quiet=True)
+        mp3_calls = [c for c in responses.calls if c.request.url.endswith(".mp3")]
+        self.assertEqual(len(mp3_calls), expected_result.total_parts)
+
+        # a truncated part is downloaded again
+        truncated_part = saved_parts[1]
+        with truncated_part.path.open("r+b") as f:
+            f.truncate(truncated_part.size // 2)
+        self.assertFalse(truncated_part.is_intact())
+        run(run_command, be_quiet=True)
+        mp3_calls = [c for c in responses.calls if c.request.url.endswith(".mp3")]
+        self.assertEqual(len(mp3_calls), expected_result.total_parts + 1)
+        self.assertTrue(
+            state.get_parts("0fef5121-bb1f-42a5-b62a-d9fded939d50-425")[1].is_intact()
+        )
+
+    @responses.activate
+    def test_parallel_download(self):
+        """
+        `odmpy dl test.odm --chapters --parallel 3`
+        """
+        for test_odm_file in self.test_odms:
+            # clear remnant downloads
+            if self.test_downloads_dir.exists():
+                shutil.rmtree(self.test_downloads_dir, ignore_errors=True)
+
+            with self.subTest(odm=test_odm_file):
+                expected_result = get_expected_result(
+                    self.test_downloads_dir, test_odm_file
+                )
+                self._setup_common_responses()
+
+                run(
+                    [
+                        "--noversioncheck",
+                        "dl",
+                        str(self.test_data_dir.joinpath(test_odm_file)),
+                        "--downloaddir",
+                        str(self.test_downloads_dir),
+                        "--chapters",
+                        "--parallel",
+                        "3",
+                        "--hideprogress",
+                    ],
+                    be_quiet=True,
+                )
+                chapter_count = 0
+                for i in range(1, expected_result.total_parts + 1):
+                    book_file = expected_result.book_folder.joinpath(
+                        expected_result.mp3_name_format.format(i)
+                    )
+                    audio_file = MP3(book_file)
+                    self.assertEqual(audio_file.tags["TRCK"], str(i))
+                    # chapter numbering continues across parts in part order
+                    for chap_id in audio_file.tags["CTOC:toc"].child_element_ids:
+                        chapter_count += 1
+                        self.assertEqual(chap_id, f"ch{chapter_count:02d}")
+                        chap_tag = audio_file.tags[f"CHAP:{chap_id}"]
+                        self.assertEqual(
+                            chap_tag.sub_frames["TIT2"].text[0],
+                            markers[test_odm_file][chapter_count - 1],
+                        )
+                self.assertEqual(chapter_count, expected_result.total_chapters)
+
     @responses.activate
     def test_merge_formats(self):
         """
@@ -1,10 +1,13 @@
+import argparse
+import io
 import json
 import os.path
 import time
 import unittest
+import zipfile
 from datetime import datetime
 from http import HTTPStatus
-from typing import Dict
+from typing import Dict, Sequence, Tuple
 from unittest.mock import patch, MagicMock
 
 import ebooklib  # type: ignore[import]
@@ -18,7 +21,7 @@ from responses import matchers
 
 from odmpy.errors import LibbyNotConfiguredError, OdmpyRuntimeError
 from odmpy.libby import LibbyClient, LibbyFormats
-from odmpy.odm import run
+from odmpy.odm import run, watch_loans
 from .base import BaseTestCase
 
 
@@ -40,7 +43,16 @@ class OdmpyLibbyTests(BaseTestCase):
         settings_folder = self._generate_fake_settings()
         settings_file = settings_folder.joinpath("libby.json")
         self.assertTrue(settings_file.exists())
-        run(["libby", "--settings", str(settings_folder), "--reset"], be_quiet=True)
+        run(
+            [
+                "--noversioncheck",
+                "libby",
+                "--settings",
+                str(settings_folder),
+                "--reset",
+            ],
+            be_quiet=True,
+        )
         self.assertFalse(settings_file.exists())
 
     def test_libby_export(self):
@@ -71,7 +83,7 @@ class OdmpyLibbyTests(BaseTestCase):
         `odmpy libby --select N`
         """
         try:
-            run(["libby", "--check"], be_quiet=True)
+            run(["--noversioncheck", "libby", "--check"], be_quiet=True)
         except LibbyNotConfiguredError:
             self.skipTest("Libby not setup.")
 
@@ -79,7 +91,10 @@ class OdmpyLibbyTests(BaseTestCase):
         loans_file_name = self.test_downloads_dir.joinpath(f"test_loans_{ts}.json")
         download_folder = self.test_downloads_dir.joinpath(f"test_downloads_{ts}")
         download_folder.mkdir(parents=True, exist_ok=True)
-        run(["libby", "--exportloans", str(loans_file_name)], be_quiet=True)
+        run(
+            ["--noversioncheck", "libby", "--exportloans", str(loans_file_name)],
+            be_quiet=True,
+        )
         self.assertTrue(loans_file_name.exists())
         with loans_file_name.open("r", encoding="utf-8") as f:
             loans = json.load(f)
@@ -111,14 +126,17 @@ class OdmpyLibbyTests(BaseTestCase):
         `odmpy libby --latest N`
         """
         try:
-            run(["libby", "--check"], be_quiet=True)
+            run(["--noversioncheck", "libby", "--check"], be_quiet=True)
         except LibbyNotConfiguredError:
             self.skipTest("Libby not setup.")
         ts = int(datetime.utcnow().timestamp() * 1000)
         loans_file_name = self.test_downloads_dir.joinpath(f"test_loans_{ts}.json")
         download_folder = self.test_downloads_dir.joinpath(f"test_downloads_{ts}")
         download_folder.mkdir(parents=True, exist_ok=True)
-        run(["libby", "--exportloans", str(loans_file_name)], be_quiet=True)
+        run(
+            ["--noversioncheck", "libby", "--exportloans", str(loans_file_name)],
+            be_quiet=True,
+        )
         self.assertTrue(loans_file_name.exists())
         with loans_file_name.open("r", encoding="utf-8") as f:
             loans = json.load(f)
@@ -157,7 +175,16 @@ class OdmpyLibbyTests(BaseTestCase):
         loans_file_name = self.test_downloads_dir.joinpath(f"test_loans_{ts}.json")
         download_folder = self.test_downloads_dir.joinpath(f"test_downloads_{ts}")
         download_folder.mkdir(parents=True, exist_ok=True)
-        run(["libby", "--ebooks", "--exportloans", str(loans_file_name)], be_quiet=True)
+        run(
+            [
+                "--noversioncheck",
+                "libby",
+                "--ebooks",
+                "--exportloans",
+                str(loans_file_name),
+            ],
+            be_quiet=True,
+        )
         self.assertTrue(loans_file_name.exists())
         with loans_file_name.open("r", encoding="utf-8") as f:
             loans = json.load(f)
@@ -207,7 +234,16 @@ class OdmpyLibbyTests(BaseTestCase):
         loans_file_name = self.test_downloads_dir.joinpath(f"test_loans_{ts}.json")
         download_folder = self.test_downloads_dir.joinpath(f"test_downloads_{ts}")
         download_folder.mkdir(parents=True, exist_ok=True)
-        run(["libby", "--ebooks", "--exportloans", str(loans_file_name)], be_quiet=True)
+        run(
+            [
+                "--noversioncheck",
+                "libby",
+                "--ebooks",
+                "--exportloans",
+                str(loans_file_name),
+            ],
+            be_quiet=True,
+        )
         self.assertTrue(loans_file_name.exists())
         with loans_file_name.open("r", encoding="utf-8") as f:
             loans = json.load(f)
@@ -229,6 +265,7 @@ class OdmpyLibbyTests(BaseTestCase):
         try:
             run(
                 [
+                    "--noversioncheck",
                     "libby",
                     "--ebooks",
                     "--direct",
@@ -245,10 +282,18 @@ class OdmpyLibbyTests(BaseTestCase):
 
         self.assertTrue(download_folder.glob("*/*.epub"))
 
-    @responses.activate
-    def test_mock_libby_download_magazine(self):
-        settings_folder = self._generate_fake_settings()
+    def _add_magazine_responses(
+        self,
+        extra_spine_items: Sequence[Tuple[str, str]] = (),
+        page_head: str = "",
+    ) -> None:
+        """
+        Mock the responses for downloading the test magazine
 
+        :param extra_spine_items: Additional (path, media type) title contents
+        :param page_head: Appended to the head of each page
+        :return:
+        """
         with self.test_data_dir.joinpath("magazine", "sync.json").open(
             "r", encoding="utf-8"
         ) as s:
@@ -265,9 +310,19 @@ class OdmpyLibbyTests(BaseTestCase):
         with self.test_data_dir.joinpath("magazine", "openbook.json").open(
             "r", encoding="utf-8"
         ) as o:
+            openbook = json.load(o)
+            for path, media_type in extra_spine_items:
+                openbook["spine"].append(
+                    {
+                        "path": path,
+                        "media-type": media_type,
+                        "-odread-spine-position": len(openbook["spine"]),
+                        "-odread-original-path": path,
+                    }
+                )
             responses.get(
                 "http://localhost/mock/openbook.json",
-                json=json.load(o),
+                json=openbook,
             )
         responses.head(
             "http://localhost/mock",
@@ -310,7 +365,7 @@ class OdmpyLibbyTests(BaseTestCase):
                 responses.get(
                     f"http://localhost/{page}",
                     content_type="application/xhtml+xml",
-                    body=f.read(),
+                    body=f.read().replace("</head>", f"{page_head}</head>"),
                 )
         for img in ("assets/cover.jpg",):
             with self.test_data_dir.joinpath("magazine", "content", img).open(
@@ -331,9 +386,16 @@ class OdmpyLibbyTests(BaseTestCase):
                     body=f.read(),
                 )
 
+    @responses.activate
+    def test_mock_libby_download_magazine(self):
+        settings_folder = self._generate_fake_settings()
+
+        self._add_magazine_responses()
+
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -432,6 +494,86 @@ class OdmpyLibbyTests(BaseTestCase):
             if css_file.get_name() == "assets/fontfaces.css":
                 self.assertNotIn("src", css_content)
 
+    @responses.activate
+    def test_mock_libby_download_magazine_parallel(self):
+        settings_folder = self._generate_fake_settings()
+
+        font_url = "http://localhost/assets/fonts/SourceSerifPro-Regular.ttf"
+        # every page links to the same stylesheet
+        self._add_magazine_responses(
+            extra_spine_items=[
+                ("assets/fontfaces.css", "text/css"),
+                ("assets/fonts/SourceSerifPro-Regular.ttf", "font/ttf"),
+            ],
+            page_head='<link rel="stylesheet" href="../assets/shared.css"/>',
+        )
+
+        def font_callback(_):
+            # the css is fetched meanwhile but only saved after the font
+            time.sleep(0.5)
+            return 200, {"Content-Type": "font/ttf"}, b"font"
+
+        responses.add_callback(responses.GET, font_url, callback=font_callback)
+        responses.get(
+            "http://localhost/assets/shared.css", content_type="text/css", body="p {}"
+        )
+
+        test_folder = "test"
+        run_command = [
+            "--noversioncheck",
+            "libby",
+            "--settings",
+            str(settings_folder),
+            "--magazines",
+            "--downloaddir",
+            str(self.test_downloads_dir),
+            "--bookfolderformat",
+            test_folder,
+            "--bookfileformat",
+            "magazine",
+            "--latest",
+            "1",
+            "--parallel",
+            "3",
+            "--hideprogress",
+        ]
+        if self.is_verbose:
+            run_command.insert(0, "--verbose")
+        run(run_command, be_quiet=not self.is_verbose)
+
+        call_urls = [c.request.url for c in responses.calls]
+        self.assertLess(
+            call_urls.index("http://localhost/assets/fontfaces.css"),
+            call_urls.index(font_url),
+        )
+        # downloaded once for each page folder
+        self.assertEqual(call_urls.count("http://localhost/assets/shared.css"), 2)
+
+        epub_file_path = self.test_downloads_dir.joinpath(test_folder, "magazine.epub")
+        book = epub.read_epub(epub_file_path, {"ignore_ncx": True})
+        self.assertEqual(
+            book.get_item_with_href(
+                "assets/fonts/SourceSerifPro-Regular.ttf"
+            ).get_content(),
+            b"font",
+        )
+        css_content = (
+            book.get_item_with_href("assets/fontfaces.css")
+            .get_content()
+            .decode("utf-8")
+        )
+        # the src of the available font is kept
+        self.assertIn("fonts/SourceSerifPro-Regular.ttf", css_content)
+        self.assertNotIn("fonts/SourceSerifPro-Bold.ttf", css_content)
+        with zipfile.ZipFile(epub_file_path) as epub_zip:
+            for page_folder in ("pages", "stories"):
+                self.assertIn(f"OEBPS/{page_folder}/shared.css", epub_zip.namelist())
+            for story in ("story-01.xhtml", "story-02.xhtml"):
+                soup = BeautifulSoup(
+                    epub_zip.read(f"OEBPS/stories/{story}"), "html.parser"
+                )
+                self.assertTrue(soup.find("link", attrs={"href": "shared.css"}))
+
     @responses.activate
     def test_mock_libby_download_ebook_acsm(self):
         settings_folder = self._generate_fake_settings()
@@ -454,6 +596,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -561,6 +704,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -645,12 +789,15 @@ class OdmpyLibbyTests(BaseTestCase):
         with self.test_data_dir.joinpath("ebook", "dummy.epub").open("rb") as a:
             opener_open = MagicMock()
             opener_open.getcode.return_value = 200
-            opener_open.read.return_value = a.read()
+            opener_open.status = 200
+            opener_open.headers = {}
+            opener_open.read.side_effect = io.BytesIO(a.read()).read
             mock_opener.return_value = opener_open
 
             test_folder = "test"
 
             run_command = [
+                "--noversioncheck",
                 "libby",
                 "--settings",
                 str(settings_folder),
@@ -765,6 +912,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -822,6 +970,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -908,6 +1057,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -984,6 +1134,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -1027,6 +1178,7 @@ class OdmpyLibbyTests(BaseTestCase):
         )
         run(
             [
+                "--noversioncheck",
                 "libby",
                 "--settings",
                 str(settings_folder),
@@ -1054,6 +1206,7 @@ class OdmpyLibbyTests(BaseTestCase):
         )
         run(
             [
+                "--noversioncheck",
                 "libby",
                 "--settings",
                 str(settings_folder),
@@ -1092,7 +1245,10 @@ class OdmpyLibbyTests(BaseTestCase):
         )
         self._setup_audiobook_direct_responses()
         with self.assertLogs(run.__module__, level="INFO") as context:
-            run(["libby", "--settings", str(settings_folder)], be_quiet=True)
+            run(
+                ["--noversioncheck", "libby", "--settings", str(settings_folder)],
+                be_quiet=True,
+            )
         self.assertIn("Login successful.\n", [r.msg for r in context.records])
 
     @responses.activate
@@ -1113,7 +1269,10 @@ class OdmpyLibbyTests(BaseTestCase):
             json={},
         )
         with self.assertRaisesRegex(OdmpyRuntimeError, "Could not log in with code"):
-            run(["libby", "--settings", str(settings_folder)], be_quiet=True)
+            run(
+                ["--noversioncheck", "libby", "--settings", str(settings_folder)],
+                be_quiet=True,
+            )
 
     @responses.activate
     @patch("builtins.input", new=_libby_setup_prompt.__func__)  # type: ignore[attr-defined]
@@ -1139,7 +1298,10 @@ class OdmpyLibbyTests(BaseTestCase):
         with self.assertRaisesRegex(
             OdmpyRuntimeError, "at least 1 registered library card"
         ):
-            run(["libby", "--settings", str(settings_folder)], be_quiet=True)
+            run(
+                ["--noversioncheck", "libby", "--settings", str(settings_folder)],
+                be_quiet=True,
+            )
 
     @responses.activate
     @patch("builtins.input", new=lambda _: "")
@@ -1152,7 +1314,10 @@ class OdmpyLibbyTests(BaseTestCase):
                 "https://sentry-read.svc.overdrive.com/chip/sync", json=json.load(s)
             )
         with self.assertLogs(run.__module__, level="INFO") as context:
-            run(["libby", "--settings", str(settings_folder)], be_quiet=True)
+            run(
+                ["--noversioncheck", "libby", "--settings", str(settings_folder)],
+                be_quiet=True,
+            )
         self.assertIn("No downloadable loans found.", [r.msg for r in context.records])
 
     @responses.activate
@@ -1163,6 +1328,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -1185,11 +1351,21 @@ class OdmpyLibbyTests(BaseTestCase):
         if not settings_folder.exists():
             settings_folder.mkdir(parents=True, exist_ok=True)
         with self.assertRaises(LibbyNotConfiguredError):
-            run(["libby", "--settings", str(settings_folder), "--check"], be_quiet=True)
+            run(
+                [
+                    "--noversioncheck",
+                    "libby",
+                    "--settings",
+                    str(settings_folder),
+                    "--check",
+                ],
+                be_quiet=True,
+            )
 
         with self.assertRaises(OdmpyRuntimeError):
             run(
                 [
+                    "--noversioncheck",
                     "libby",
                     "--settings",
                     str(settings_folder),
@@ -1218,7 +1394,13 @@ class OdmpyLibbyTests(BaseTestCase):
                 },
                 f,
             )
-        run_command = ["libby", "--settings", str(settings_folder), "--check"]
+        run_command = [
+            "--noversioncheck",
+            "libby",
+            "--settings",
+            str(settings_folder),
+            "--check",
+        ]
         run(run_command, be_quiet=True)
         with libby_settings.open("r", encoding="utf-8") as f:
             settings = json.load(f)
@@ -1243,7 +1425,12 @@ class OdmpyLibbyTests(BaseTestCase):
                 json={},
             )
 
-        run_command = ["libbyreturn", "--settings", str(settings_folder)]
+        run_command = [
+            "--noversioncheck",
+            "libbyreturn",
+            "--settings",
+            str(settings_folder),
+        ]
         if self.is_verbose:
             run_command.insert(0, "--verbose")
         run(run_command, be_quiet=not self.is_verbose)
@@ -1267,7 +1454,12 @@ class OdmpyLibbyTests(BaseTestCase):
                 json=sync_state["loans"][0],
             )
 
-        run_command = ["libbyrenew", "--settings", str(settings_folder)]
+        run_command = [
+            "--noversioncheck",
+            "libbyrenew",
+            "--settings",
+            str(settings_folder),
+        ]
         if self.is_verbose:
             run_command.insert(0, "--verbose")
         run(run_command, be_quiet=not self.is_verbose)
@@ -1324,7 +1516,12 @@ class OdmpyLibbyTests(BaseTestCase):
                 },
             )
 
-        run_command = ["libbyrenew", "--settings", str(settings_folder)]
+        run_command = [
+            "--noversioncheck",
+            "libbyrenew",
+            "--settings",
+            str(settings_folder),
+        ]
         if self.is_verbose:
             run_command.insert(0, "--verbose")
 
@@ -1368,7 +1565,12 @@ class OdmpyLibbyTests(BaseTestCase):
                 json={},
             )
 
-        run_command = ["libbyreturn", "--settings", str(settings_folder)]
+        run_command = [
+            "--noversioncheck",
+            "libbyreturn",
+            "--settings",
+            str(settings_folder),
+        ]
         if self.is_verbose:
             run_command.insert(0, "--verbose")
         run(run_command, be_quiet=not self.is_verbose)
@@ -1395,6 +1597,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -1448,6 +1651,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -1492,6 +1696,7 @@ class OdmpyLibbyTests(BaseTestCase):
         test_folder = "test"
 
         run_command = [
+            "--noversioncheck",
             "libby",
             "--settings",
             str(settings_folder),
@@ -1528,3 +1733,92 @@ class OdmpyLibbyTests(BaseTestCase):
         self.assertTrue(run2_modfified_time)
 
         self.assertEqual(run1_modfified_time, run2_modfified_time)
+
+    @responses.activate
+    @patch.object(LibbyClient, "renew_chip_if_needed", return_value=False)
+    def test_mock_libby_watch(self, _):
+        """
+        `odmpy libby --watch`
+        """
+        settings_folder = self._generate_fake_settings()
+        snapshot_file = settings_folder.joinpath("watch_loans.json")
+        with self.test_data_dir.joinpath("audiobook", "sync.json").open(
+            "r", encoding="utf-8"
+        ) as s:
+            synced_state = json.load(s)
+        loan = synced_state["loans"][0]
+        new_loan = dict(loan, id="8888888", title="New Loan")
+        reborrowed_loan = dict(loan, checkoutDate="2023-04-01T00:00:00Z")
+
+        # baseline is saved on the first run and the sleep is interrupted by Ctrl+C
+        responses.get("https://sentry.libbyapp.com/chip/sync", json=synced_state)
+        with patch("odmpy.odm.time.sleep", side_effect=KeyboardInterrupt), patch(
+            "odmpy.odm.download_loan"
+        ) as mock_download:
+            run(
+                [
+                    "--noversioncheck",
+                    "libby",
+                    "--settings",
+                    str(settings_folder),
+                    "--watch",
+                ],
+                be_quiet=True,
+            )
+            mock_download.assert_not_called()
+        with snapshot_file.open("r", encoding="utf-8") as f:
+            self.assertEqual(
+                json.load(f), {"123456789:9999999": "2023-03-01T00:00:00Z"}
+            )
+
+        responses.reset()
+        responses.get(
+            "https://sentry.libbyapp.com/chip/sync",
+            json=dict(synced_state, loans=[reborrowed_loan, new_loan]),
+        )
+        libby_client = LibbyClient(settings_folder=str(settings_folder))
+        args = argparse.Namespace(
+            exclude_audiobooks=False,
+            include_ebooks=False,
+            include_magazines=False,
+            generate_opf=False,
+            libby_direct=True,
+            watch_interval=300,
+            watch_max_interval=500,
+        )
+        sleeps = []
+        with patch("odmpy.odm.download_loan") as mock_download:
+            # the new loan fails the first time and is retried in the next poll
+            mock_download.side_effect = [
+                OdmpyRuntimeError("Download failed"),
+                None,
+                None,
+            ]
+            watch_loans(
+                libby_client,
+                MagicMock(),
+                [loan],
+                synced_state["cards"],
+                args,
+                sleep=sleeps.append,
+                max_polls=6,
+            )
+            self.assertEqual(
+                [c.args[2]["id"] for c in mock_download.call_args_list],
+                ["8888888", "9999999", "8888888"],
+            )
+        # polls: baseline, 2 new/changed loans, retry, idle, idle (backed off)
+        self.assertEqual(len(sleeps), 5)
+        for sleep_secs in sleeps[:-1]:
+            self.assertGreaterEqual(sleep_secs, 300)
+            self.assertLessEqual(sleep_secs, 330)
+        self.assertGreaterEqual(sleeps[-1], 500)
+        self.assertLessEqual(sleeps[-1], 550)
+        with snapshot_file.open("r", encoding="utf-8") as f:
+            self.assertEqual(
+                json.load(f),
+                {
+                    "123456789:9999999": "2023-04-01T00:00:00Z",
+                    "123456789:8888888": "2023-03-01T00:00:00Z",
+                },
+            )
@@ -1,8 +1,30 @@
 import argparse
+import itertools
+import json
+import shutil
+import subprocess
+import time
+import threading
+import unittest
+import zipfile
 from functools import cmp_to_key
+from pathlib import Path
+from unittest.mock import patch
 
+import requests
+import responses
+from eyed3.id3 import ID3_V2_3, ID3_V2_4  # type: ignore[import]
+from responses import matchers
+
+from odmpy.errors import (
+    DownloadIncompleteError,
+    DownloadStalledError,
+    OdmpyRuntimeError,
+)
+from odmpy.mp3 import Mp3StreamAnalyzer, analyze_file
 from odmpy.processing import shared
-from odmpy.processing.ebook import _sort_title_contents
+from odmpy.processing.shared import _header_reserve_tag
+from odmpy.processing.ebook import _sort_title_contents, EpubStreamWriter
 from tests.base import BaseTestCase
 
 
@@ -141,3 +163,977 @@ class ProcessingSharedTests(BaseTestCase):
                 {"url": "http://localhost/assets/4.css"},
             ],
         )
+
+    @responses.activate
+    def test_download_part_files(self):
+        bodies = [f"part {i} ".encode("ascii") * 1000 for i in range(5)]
+        for i, body in enumerate(bodies):
+            responses.get(f"http://localhost/part-{i}.mp3", body=body)
+
+        for parallel in (1, 3):
+            with self.subTest(parallel=parallel):
+                part_downloads = [
+                    shared.PartDownload(
+                        url=f"http://localhost/part-{i}.mp3",
+                        tmp_filename=self.test_downloads_dir.joinpath(
+                            f"parallel-{parallel}-part-{i}.part"
+                        ),
+                        file_size=len(body),
+                        label=f"Part {i}",
+                    )
+                    for i, body in enumerate(bodies)
+                ]
+                downloaded = list(
+                    shared.download_part_files(
+                        session=requests.Session(),
+                        part_downloads=part_downloads,
+                        headers={},
+                        timeout=10,
+                        parallel=parallel,
+                        hide_progress=True,
+                    )
+                )
+                # files are returned in the same order as requested
+                self.assertEqual(downloaded, [pd.tmp_filename for pd in part_downloads])
+                for tmp_filename, body in zip(downloaded, bodies):
+                    self.assertEqual(tmp_filename.read_bytes(), body)
+
+                # post-processing finishes out of order but results are in order
+                def post_process(index, tmp_filename):
+                    time.sleep(0.01 * (len(bodies) - index))
+                    return index, tmp_filename.read_bytes()
+
+                processed = list(
+                    shared.download_part_files(
+                        session=requests.Session(),
+                        part_downloads=part_downloads,
+                        headers={},
+                        timeout=10,
+                        parallel=parallel,
+                        hide_progress=True,
+                        post_process=post_process,
+                    )
+                )
+                self.assertEqual(processed, list(enumerate(bodies)))
+
+    @responses.activate
+    def test_download_part_resume(self):
+        body = b"0123456789" * 1000
+        part_tmp_filename = self.test_downloads_dir.joinpath("resume.part")
+        part_tmp_filename.write_bytes(body[:1234])
+
+        def range_callback(request):
+            self.assertEqual(request.headers["Range"], "bytes=1234-")
+            return 206, {}, body[1234:]
+
+        responses.add_callback(
+            responses.GET, "http://localhost/resume.mp3", callback=range_callback
+        )
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/resume.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # resume after the space reserved for the tag
+        reserve_tag = _header_reserve_tag(5000)
+        part_tmp_filename.write_bytes(reserve_tag + body[:1234])
+        self.assertEqual(shared.get_header_reserve(part_tmp_filename), 5000)
+        self.assertEqual(shared.get_downloaded_size(part_tmp_filename), 1234)
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/resume.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+            header_reserve=5000,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), reserve_tag + body)
+
+        # server ignores Range and sends the full body
+        part_tmp_filename.write_bytes(body[:1234])
+        responses.replace(responses.GET, "http://localhost/resume.mp3", body=body)
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/resume.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # a new download starts with the reserved space
+        part_tmp_filename.unlink()
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/resume.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+            header_reserve=5000,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), reserve_tag + body)
+        shared.strip_header_reserve(part_tmp_filename)
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+    @responses.activate
+    def test_download_part_segmented(self):
+        body = bytes(range(256)) * 400
+        requested_ranges = []
+
+        def range_callback(request):
+            range_start, range_end = [
+                int(v) for v in request.headers["Range"][len("bytes=") :].split("-")
+            ]
+            requested_ranges.append((range_start, range_end))
+            return (
+                206,
+                {"Content-Range": f"bytes {range_start}-{range_end}/{len(body)}"},
+                body[range_start : range_end + 1],
+            )
+
+        responses.add_callback(
+            responses.GET, "http://localhost/segmented.mp3", callback=range_callback
+        )
+        part_tmp_filename = self.test_downloads_dir.joinpath("segmented.part")
+        progress = []
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/segmented.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+            progress_callback=progress.append,
+            file_size=len(body),
+            segments=4,
+            min_segment_size=10000,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+        self.assertEqual(
+            sorted(requested_ranges),
+            [(0, 25599), (25600, 51199), (51200, 76799), (76800, 102399)],
+        )
+        self.assertEqual(sum(progress), len(body))
+        self.assertFalse(
+            self.test_downloads_dir.joinpath("segmented.part.segments").exists()
+        )
+
+        # resume an interrupted segmented download
+        part_tmp_filename.write_bytes(body[:30000] + bytes(21200) + body[51200:])
+        self.test_downloads_dir.joinpath("segmented.part.segments").write_text(
+            "[[0, 51199, 30000], [51200, 102399, 51200]]", encoding="utf-8"
+        )
+        self.assertEqual(shared.get_downloaded_size(part_tmp_filename), 81200)
+        requested_ranges.clear()
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/segmented.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+            file_size=len(body),
+            min_segment_size=10000,
+        )
+        self.assertEqual(requested_ranges, [(30000, 51199)])
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # server ignores Range and sends the full body
+        part_tmp_filename.unlink()
+        responses.replace(responses.GET, "http://localhost/segmented.mp3", body=body)
+        progress.clear()
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/segmented.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+            progress_callback=progress.append,
+            file_size=len(body),
+            segments=4,
+            min_segment_size=10000,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+        self.assertEqual(sum(progress), len(body))
+
+    @responses.activate
+    @patch("odmpy.processing.shared.time.sleep")
+    def test_download_part_resume_retries(self, mock_sleep):
+        body = b"0123456789" * 20000
+        requested_ranges = []
+
+        def dropped_callback(request):
+            # connection drops after 100000 bytes every time
+            range_start = int(
+                request.headers.get("Range", "bytes=0-")[len("bytes=") :].rstrip("-")
+            )
+            requested_ranges.append(range_start)
+            return (
+                206 if range_start else 200,
+                {"Content-Length": str(len(body) - range_start)},
+                body[range_start : range_start + 100000],
+            )
+
+        responses.add_callback(
+            responses.GET, "http://localhost/dropped.mp3", callback=dropped_callback
+        )
+        part_tmp_filename = self.test_downloads_dir.joinpath("dropped.part")
+        shared.download_part(
+            session=requests.Session(),
+            url="http://localhost/dropped.mp3",
+            part_tmp_filename=part_tmp_filename,
+            headers={},
+            timeout=10,
+            file_size=len(body),
+            resume_retries=5,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+        # only whole chunks that were received before the drop are kept
+        chunk_size = shared.DOWNLOAD_CHUNK_SIZE
+        self.assertEqual(requested_ranges, [0, chunk_size, 2 * chunk_size])
+        # exponential backoff
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1, 2])
+
+        # retry budget exhausted
+        part_tmp_filename.unlink()
+        with self.assertRaises(DownloadIncompleteError):
+            shared.download_part(
+                session=requests.Session(),
+                url="http://localhost/dropped.mp3",
+                part_tmp_filename=part_tmp_filename,
+                headers={},
+                timeout=10,
+                file_size=len(body),
+                resume_retries=1,
+            )
+        self.assertEqual(part_tmp_filename.stat().st_size, 2 * chunk_size)
+
+    def test_throughput_watchdog(self):
+        with patch("odmpy.processing.shared.time.monotonic") as mock_monotonic:
+            mock_monotonic.return_value = 0
+            watchdog = shared.ThroughputWatchdog(min_rate=1000, window=10)
+            for t in range(0, 30, 5):
+                # 10000 bytes every 5s
+                mock_monotonic.return_value = t
+                watchdog.update(10000)
+            # 1000 bytes in the last 10s
+            mock_monotonic.return_value = 36
+            with self.assertRaises(DownloadStalledError):
+                watchdog.update(1000)
+
+            # disabled
+            watchdog = shared.ThroughputWatchdog(min_rate=0, window=10)
+            mock_monotonic.return_value = 100
+            watchdog.update(1)
+
+    @responses.activate
+    @patch("odmpy.processing.shared.time.sleep")
+    def test_download_part_files_stalled(self, _):
+        body = b"0123456789" * 20000
+        requested_ranges = []
+
+        def range_callback(request):
+            range_start = int(
+                request.headers.get("Range", "bytes=0-")[len("bytes=") :].rstrip("-")
+            )
+            requested_ranges.append(range_start)
+            return 206 if range_start else 200, {}, body[range_start:]
+
+        responses.add_callback(
+            responses.GET, "http://localhost/stalled.mp3", callback=range_callback
+        )
+        updates = []
+
+        def stall_once(_, n):
+            updates.append(n)
+            if len(updates) == 1:
+                raise DownloadStalledError("Too slow")
+
+        part_tmp_filename = self.test_downloads_dir.joinpath("stalled.part")
+        with patch.object(
+            shared.ThroughputWatchdog, "update", autospec=True, side_effect=stall_once
+        ), self.assertLogs(self.logger, level="INFO") as logs:
+            downloaded = list(
+                shared.download_part_files(
+                    session=requests.Session(),
+                    part_downloads=[
+                        shared.PartDownload(
+                            url="http://localhost/stalled.mp3",
+                            tmp_filename=part_tmp_filename,
+                            file_size=len(body),
+                            label="Part 1",
+                        )
+                    ],
+                    headers={},
+                    timeout=10,
+                    parallel=1,
+                    hide_progress=True,
+                    resume_retries=1,
+                    logger=self.logger,
+                    min_rate=1024,
+                )
+            )
+        self.assertEqual(downloaded[0].read_bytes(), body)
+        # reconnected after the first chunk
+        self.assertEqual(requested_ranges, [0, shared.DOWNLOAD_CHUNK_SIZE])
+        self.assertIn(
+            "Reconnected part downloads 1 time (1 after a stalled transfer).",
+            logs.output[-1],
+        )
+
+    @responses.activate
+    def test_download_part_files_analyzed(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        body = mp3_file.read_bytes()
+        responses.get("http://localhost/book.mp3", body=body)
+        part_downloads = [
+            shared.PartDownload(
+                url="http://localhost/book.mp3",
+                tmp_filename=self.test_downloads_dir.joinpath(f"book{i}.part"),
+                file_size=len(body),
+                label=f"Part {i}",
+                analyzer=Mp3StreamAnalyzer(self.logger),
+            )
+            for i in range(2)
+        ]
+        # resumed from a previous run, so only part of the stream is seen
+        part_downloads[1].tmp_filename.write_bytes(body[:1000])
+        responses.get(
+            "http://localhost/book.mp3",
+            body=body[1000:],
+            status=206,
+            match=[matchers.header_matcher({"Range": "bytes=1000-"})],
+        )
+        downloaded = list(
+            shared.download_part_files(
+                session=requests.Session(),
+                part_downloads=part_downloads,
+                headers={},
+                timeout=10,
+                parallel=1,
+                hide_progress=True,
+                post_process=lambda i, _: part_downloads[i].analyzer.info(),
+            )
+        )
+        self.assertEqual(downloaded[0], analyze_file(mp3_file))
+        self.assertIsNone(downloaded[1])
+        self.assertEqual(part_downloads[1].tmp_filename.read_bytes(), body)
+
+    @responses.activate
+    def test_download_part_files_auth_refresh(self):
+        body = b"x" * 1000
+        responses.get(
+            "http://localhost/part.mp3",
+            body=body,
+            match=[matchers.header_matcher({"Cookie": "auth=renewed"})],
+        )
+        responses.get(
+            "http://localhost/part.mp3",
+            status=403,
+            match=[lambda req: ("Cookie" not in req.headers, "Has cookie")],
+        )
+        session = requests.Session()
+        refresh_calls = []
+
+        def refresh_auth():
+            refresh_calls.append(1)
+            session.cookies.set("auth", "renewed", domain="localhost.local")
+
+        part_downloads = [
+            shared.PartDownload(
+                url="http://localhost/part.mp3",
+                tmp_filename=self.test_downloads_dir.joinpath(f"part{i}.part"),
+                file_size=len(body),
+                label=f"Part {i}",
+            )
+            for i in range(3)
+        ]
+        downloaded = list(
+            shared.download_part_files(
+                session=session,
+                part_downloads=part_downloads,
+                headers={},
+                timeout=10,
+                parallel=3,
+                hide_progress=True,
+                auth_refresh=refresh_auth,
+            )
+        )
+        self.assertEqual(len(refresh_calls), 1)
+        for part_tmp_filename in downloaded:
+            self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # still rejected after the refresh
+        session.cookies.clear()
+        with self.assertRaises(requests.HTTPError):
+            shared.download_part(
+                session=session,
+                url="http://localhost/part.mp3",
+                part_tmp_filename=self.test_downloads_dir.joinpath("rejected.part"),
+                headers={},
+                timeout=10,
+                auth_refresh=lambda: refresh_calls.append(1),
+            )
+        self.assertEqual(len(refresh_calls), 2)
+
+    @responses.activate
+    def test_download_part_files_refreshed_urls(self):
+        body = b"x" * 1000
+        for i in range(3):
+            responses.get(f"http://localhost/old/part{i}.mp3", status=403)
+            responses.get(f"http://localhost/new/part{i}.mp3", body=body)
+        refresh_calls = []
+
+        def refresh_auth():
+            refresh_calls.append(1)
+            return {
+                f"http://localhost/old/part{i}.mp3": f"http://localhost/new/part{i}.mp3"
+                for i in range(3)
+            }
+
+        part_downloads = [
+            shared.PartDownload(
+                url=f"http://localhost/old/part{i}.mp3",
+                tmp_filename=self.test_downloads_dir.joinpath(f"part{i}.part"),
+                file_size=len(body),
+                label=f"Part {i}",
+            )
+            for i in range(3)
+        ]
+        downloaded = list(
+            shared.download_part_files(
+                session=requests.Session(),
+                part_downloads=part_downloads,
+                headers={},
+                timeout=10,
+                parallel=1,
+                hide_progress=True,
+                auth_refresh=refresh_auth,
+            )
+        )
+        self.assertEqual(len(refresh_calls), 1)
+        for part_tmp_filename in downloaded:
+            self.assertEqual(part_tmp_filename.read_bytes(), body)
+        # the queued parts are downloaded from the refreshed urls straight away
+        self.assertEqual(
+            [c.request.url for c in responses.calls],
+            [
+                "http://localhost/old/part0.mp3",
+                "http://localhost/new/part0.mp3",
+                "http://localhost/new/part1.mp3",
+                "http://localhost/new/part2.mp3",
+            ],
+        )
+
+    def test_mp3_file(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        mp3_info = analyze_file(mp3_file)
+        audiofile = shared.Mp3File(mp3_file)
+        self.assertEqual(audiofile.info, mp3_info)
+        self.assertEqual(audiofile.tag.title, shared.TagOnlyFile(mp3_file).tag.title)
+        # info from the download stream is used as is
+        stream_info = mp3_info._replace(duration_ms=1)
+        self.assertIs(shared.Mp3File(mp3_file, info=stream_info).info, stream_info)
+        with self.assertRaises(ValueError):
+            shared.Mp3File(self.test_data_dir.joinpath("test1.odm"))
+
+    def test_finalize_mp3(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        mp3_info = analyze_file(mp3_file)
+        for is_tagged in (True, False):
+            with self.subTest(is_tagged=is_tagged):
+                part_tmp_filename = self.test_downloads_dir.joinpath("book.part")
+                part_tmp_filename.write_bytes(mp3_file.read_bytes())
+                part_filename = self.test_downloads_dir.joinpath(
+                    f"book-{is_tagged}.mp3"
+                )
+                tag_data = None
+                if is_tagged:
+                    audiofile = shared.TagOnlyFile(part_tmp_filename)
+                    audiofile.tag.title = "Finalized"
+                    tag_data = shared.ID3TagTemplate(
+                        ID3_V2_4, **self._tag_args(title="Test")
+                    ).render(audiofile.tag, part_number=1, total_parts=2, padding=10000)
+                shared.finalize_mp3(
+                    part_tmp_filename=part_tmp_filename,
+                    part_filename=part_filename,
+                    mp3_info=mp3_info,
+                    tag_data=tag_data,
+                )
+                self.assertFalse(part_tmp_filename.exists())
+                finalized_info = analyze_file(part_filename)
+                self.assertEqual(finalized_info.frame_count, mp3_info.frame_count)
+                self.assertEqual(finalized_info.duration_ms, mp3_info.duration_ms)
+                self.assertEqual(
+                    finalized_info.user_texts["OverDrive MediaMarkers"],
+                    mp3_info.user_texts["OverDrive MediaMarkers"],
+                )
+                # audio is copied as is
+                self.assertEqual(
+                    part_filename.read_bytes()[finalized_info.audio_offset :],
+                    mp3_file.read_bytes()[mp3_info.audio_offset :],
+                )
+                audiofile = shared.TagOnlyFile(part_filename)
+                if not is_tagged:
+                    self.assertEqual(part_filename.read_bytes(), mp3_file.read_bytes())
+                    continue
+                self.assertEqual(audiofile.tag.title, "Finalized")
+                self.assertEqual(audiofile.tag.version, ID3_V2_4)
+                self.assertEqual(audiofile.tag.file_info.tag_padding_size, 10000)
+
+    def test_finalize_mp3_in_place(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        mp3_info = analyze_file(mp3_file)
+        tag_template = shared.ID3TagTemplate(ID3_V2_4, **self._tag_args(title="Test"))
+        header_reserve = shared.estimate_id3_padding(
+            cover_bytes=self._tag_args()["cover_bytes"],
+            texts=["Test", "Test Subtitle", "Publisher", "<p>Line 1</p>"],
+            chapter_titles=[],
+        )
+        part_tmp_filename = self.test_downloads_dir.joinpath("book.part")
+        part_tmp_filename.write_bytes(
+            _header_reserve_tag(header_reserve) + mp3_file.read_bytes()
+        )
+        part_filename = self.test_downloads_dir.joinpath("book.mp3")
+        audiofile = shared.Mp3File(
+            part_tmp_filename, info=mp3_info, offset=header_reserve
+        )
+        # the downloaded tag is read after the reserved space
+        downloaded_title = shared.TagOnlyFile(mp3_file).tag.title
+        self.assertEqual(audiofile.tag.title, downloaded_title)
+        tag_data = tag_template.render(audiofile.tag, part_number=1, total_parts=2)
+        self.assertGreater(len(tag_data), mp3_info.audio_offset)
+        inode = part_tmp_filename.stat().st_ino
+        shared.finalize_mp3(
+            part_tmp_filename=part_tmp_filename,
+            part_filename=part_filename,
+            mp3_info=mp3_info,
+            tag_data=tag_data,
+        )
+        self.assertFalse(part_tmp_filename.exists())
+        # the downloaded file is renamed instead of copied
+        self.assertEqual(part_filename.stat().st_ino, inode)
+        finalized_info = analyze_file(part_filename)
+        self.assertEqual(
+            finalized_info.audio_offset, header_reserve + mp3_info.audio_offset
+        )
+        self.assertEqual(finalized_info.frame_count, mp3_info.frame_count)
+        self.assertEqual(
+            part_filename.read_bytes()[finalized_info.audio_offset :],
+            mp3_file.read_bytes()[mp3_info.audio_offset :],
+        )
+        tag = shared.TagOnlyFile(part_filename).tag
+        self.assertEqual(tag.title, downloaded_title)
+        self.assertEqual(tag.publisher, "Publisher")
+        self.assertEqual(tag.images[0].image_data, self._tag_args()["cover_bytes"])
+        self.assertEqual(
+            tag.file_info.tag_padding_size, finalized_info.audio_offset - len(tag_data)
+        )
+
+    @staticmethod
+    def _tag_args(**kwargs):
+        tag_args = {
+            "title": "Test Title",
+            "sub_title": "Test Subtitle",
+            "authors": ["Author A", "Author B"],
+            "narrators": ["Narrator"],
+            "publisher": "Publisher",
+            "description": "<p>Line 1</p>",
+            "cover_bytes": b"\xff\xd8" + b"\x00" * 100000,
+            "genres": ["Fiction"],
+            "languages": ["en"],
+            "published_date": "2020-01-02T00:00:00Z",
+            "series": "Series",
+            "overdrive_id": "12345",
+            "isbn": "9780000000000",
+        }
+        tag_args.update(kwargs)
+        return tag_args
+
+    def test_id3_tag_template(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+
+        def tag_frames(file_path):
+            tag = shared.TagOnlyFile(file_path).tag
+            return tag.version, sorted(
+                (frame.id, frame.render()) for frame in tag.frame_set.getAllFrames()
+            )
+
+        for version, always_overwrite in itertools.product(
+            (ID3_V2_3, ID3_V2_4), (False, True)
+        ):
+            with self.subTest(version=version, always_overwrite=always_overwrite):
+                tag_args = self._tag_args(always_overwrite=always_overwrite)
+                expected_file = self.test_downloads_dir.joinpath("expected.mp3")
+                expected_file.write_bytes(mp3_file.read_bytes())
+                audiofile = shared.TagOnlyFile(expected_file)
+                shared.write_tags(
+                    audiofile=audiofile, part_number=3, total_parts=5, **tag_args
+                )
+                audiofile.tag.save(version=version)
+
+                tag_template = shared.ID3TagTemplate(version, **tag_args)
+                rendered_file = self.test_downloads_dir.joinpath("rendered.mp3")
+                rendered_file.write_bytes(
+                    tag_template.render(
+                        shared.TagOnlyFile(mp3_file).tag, part_number=3, total_parts=5
+                    )
+                    + mp3_file.read_bytes()
+                )
+                self.assertEqual(tag_frames(rendered_file), tag_frames(expected_file))
+
+                # without an existing tag
+                expected_file.write_bytes(b"")
+                audiofile = shared.TagOnlyFile(expected_file)
+                shared.write_tags(
+                    audiofile=audiofile, part_number=3, total_parts=5, **tag_args
+                )
+                audiofile.tag.save(version=version)
+                rendered_file.write_bytes(
+                    tag_template.render(None, part_number=3, total_parts=5)
+                )
+                self.assertEqual(tag_frames(rendered_file), tag_frames(expected_file))
+
+    def test_build_ffmetadata(self):
+        metadata = shared.build_m4b_metadata(
+            title="Test Title",
+            sub_title=None,
+            authors=["Author A", "Author B"],
+            narrators=["Narrator"],
+            publisher="Publisher",
+            description="<p>Line 1; #2</p>",
+            genres=["Fiction"],
+            languages=["en"],
+            published_date="2020-01-02T00:00:00Z",
+            series="Series",
+            overdrive_id="1234",
+            isbn="9780000000000",
+            delimiter=";",
+        )
+        self.assertEqual(metadata["artist"], "Author A;Author B")
+        self.assertEqual(metadata["description"], "Line 1; #2")
+        self.assertEqual(metadata["Series"], "Series")
+        self.assertEqual(metadata["ISBN"], "9780000000000")
+        self.assertEqual(metadata["OverDrive Media ID"], "1234")
+        self.assertEqual(metadata["language"], "eng")
+        self.assertEqual(metadata["date"], "2020-01-02")
+
+        ffmetadata = shared.build_ffmetadata(
+            metadata, [("Chapter 1", 0, 1500), ("Chapter=2", 1500, 3000)]
+        )
+        lines = ffmetadata.splitlines()
+        self.assertEqual(lines[0], ";FFMETADATA1")
+        self.assertIn("artist=Author A\\;Author B", lines)
+        self.assertIn("description=Line 1\\; \\#2", lines)
+        # empty values are skipped
+        self.assertFalse([ln for ln in lines if ln.startswith("subtitle=")])
+        self.assertEqual(
+            lines[-10:],
+            [
+                "[CHAPTER]",
+                "TIMEBASE=1/1000",
+                "START=0",
+                "END=1500",
+                "title=Chapter 1",
+                "[CHAPTER]",
+                "TIMEBASE=1/1000",
+                "START=1500",
+                "END=3000",
+                "title=Chapter\\=2",
+            ],
+        )
+
+    def test_merge_into_m4b_segmented(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        part_duration_ms = analyze_file(mp3_file).duration_ms
+        file_tracks = []
+        for i in range(3):
+            part_file = self.test_downloads_dir.joinpath(f"part-{i}.mp3")
+            shutil.copy(mp3_file, part_file)
+            file_tracks.append({"file": part_file})
+        book_m4b_filename = self.test_downloads_dir.joinpath("book.m4b")
+        commands = []
+        ffmetadata = []
+        # each encoded segment is 40ms longer than its part
+        segment_duration_ms = part_duration_ms + 40
+
+        def mock_ffmpeg(cmd):
+            commands.append(cmd)
+            # create the output file
+            Path(cmd[-1]).write_bytes(b"")
+            if "concat" in cmd:
+                concat_list = Path(cmd[cmd.index("concat") + 4])
+                self.assertIn(".m4a", concat_list.read_text(encoding="utf-8"))
+                ffmetadata.extend(
+                    Path(cmd[cmd.index("concat") + 6])
+                    .read_text(encoding="utf-8")
+                    .splitlines()
+                )
+            return 0
+
+        def mock_ffprobe(cmd, **_):
+            self.assertEqual(cmd[0], "ffprobe")
+            self.assertTrue(cmd[-1].endswith(".m4a"))
+            return f"{segment_duration_ms / 1000:.6f}\n"
+
+        with patch("odmpy.processing.shared.subprocess.call", new=mock_ffmpeg), patch(
+            "odmpy.processing.shared.subprocess.check_output", new=mock_ffprobe
+        ):
+            shared.merge_into_m4b(
+                book_m4b_filename=book_m4b_filename,
+                file_tracks=file_tracks,
+                cover_filename=self.test_downloads_dir.joinpath("cover.jpg"),
+                metadata={"title": "Test"},
+                chapters=[
+                    ("Chapter 1", 0, 1000),
+                    ("Chapter 2", 1000, part_duration_ms + 500),
+                    ("Chapter 3", part_duration_ms + 500, part_duration_ms * 3),
+                ],
+                merge_codec="aac",
+                audio_bitrate=64,
+                ffmpeg_loglevel="fatal",
+                hide_progress=True,
+                logger=self.logger,
+                jobs=2,
+            )
+        self.assertTrue(book_m4b_filename.exists())
+        # each part is encoded, then the segments are joined without re-encoding
+        self.assertEqual(len(commands), len(file_tracks) + 1)
+        for cmd in commands[:-1]:
+            self.assertEqual(cmd[cmd.index("-c:a") + 1], "aac")
+        self.assertEqual(commands[-1][commands[-1].index("-c:a") + 1], "copy")
+        # chapters are shifted to where each part starts in the joined segments
+        self.assertEqual(
+            [line for line in ffmetadata if line.startswith(("START=", "END="))],
+            [
+                "START=0",
+                "END=1000",
+                "START=1000",
+                f"END={segment_duration_ms + 500}",
+                f"START={segment_duration_ms + 500}",
+                f"END={segment_duration_ms * 3}",
+            ],
+        )
+        # intermediate files are cleaned up
+        self.assertEqual(
+            sorted([f.name for f in self.test_downloads_dir.iterdir()]),
+            ["book.m4b", "part-0.mp3", "part-1.mp3", "part-2.mp3"],
+        )
+
+    def test_encode_aac_segments_failure(self):
+        file_tracks = []
+        for i in range(4):
+            part_file = self.test_downloads_dir.joinpath(f"part-{i}.mp3")
+            part_file.write_bytes(b"")
+            file_tracks.append({"file": part_file})
+        commands = []
+        # both workers are encoding when their parts fail
+        running = threading.Barrier(2, timeout=5)
+
+        def mock_ffmpeg(cmd):
+            commands.append(cmd)
+            Path(cmd[-1]).write_bytes(b"")
+            running.wait()
+            return 1
+
+        with patch("odmpy.processing.shared.subprocess.call", new=mock_ffmpeg):
+            with self.assertRaises(OdmpyRuntimeError):
+                shared.encode_aac_segments(
+                    file_tracks=file_tracks,
+                    merge_codec="aac",
+                    audio_bitrate=64,
+                    jobs=2,
+                    ffmpeg_loglevel="fatal",
+                    logger=self.logger,
+                )
+        # the pending encodes are not started
+        self.assertEqual(len(commands), 2)
+        self.assertEqual(
+            sorted([f.name for f in self.test_downloads_dir.iterdir()]),
+            [ft["file"].name for ft in file_tracks],
+        )
+
+    @unittest.skipUnless(
+        shutil.which("ffmpeg") and shutil.which("ffprobe"), "ffmpeg not found"
+    )
+    def test_merge_into_m4b_segmented_chapters(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        part_duration_ms = analyze_file(mp3_file).duration_ms
+        file_tracks = []
+        for i in range(3):
+            part_file = self.test_downloads_dir.joinpath(f"part-{i}.mp3")
+            shutil.copy(mp3_file, part_file)
+            file_tracks.append({"file": part_file})
+        # a chapter for each part
+        chapters = [
+            (f"Chapter {i + 1}", i * part_duration_ms, (i + 1) * part_duration_ms)
+            for i in range(len(file_tracks))
+        ]
+
+        outputs_chapters = []
+        for jobs in (1, len(file_tracks)):
+            book_m4b_filename = self.test_downloads_dir.joinpath(f"book-{jobs}.m4b")
+            shared.merge_into_m4b(
+                book_m4b_filename=book_m4b_filename,
+                file_tracks=file_tracks,
+                cover_filename=self.test_downloads_dir.joinpath("cover.jpg"),
+                metadata={"title": "Test"},
+                chapters=chapters,
+                merge_codec="aac",
+                audio_bitrate=64,
+                ffmpeg_loglevel="fatal",
+                hide_progress=True,
+                logger=self.logger,
+                jobs=jobs,
+            )
+            meta = json.loads(
+                subprocess.check_output(
+                    [
+                        "ffprobe",
+                        "-v",
+                        "quiet",
+                        "-print_format",
+                        "json",
+                        "-show_format",
+                        "-show_chapters",
+                        str(book_m4b_filename),
+                    ],
+                    text=True,
+                )
+            )
+            output_chapters = [
+                (float(c["start_time"]), float(c["end_time"])) for c in meta["chapters"]
+            ]
+            outputs_chapters.append(output_chapters)
+            # the last chapter ends with the audio
+            self.assertAlmostEqual(
+                output_chapters[-1][1], float(meta["format"]["duration"]), delta=0.01
+            )
+
+        # each chapter covers its part, give or take the AAC priming/padding frame
+        aac_frame_secs = 1024 / analyze_file(mp3_file).sample_rate
+        for (start, end), (segmented_start, segmented_end) in zip(*outputs_chapters):
+            self.assertAlmostEqual(
+                end - start, segmented_end - segmented_start, delta=aac_frame_secs
+            )
+
+    def test_merge_into_mp3_tag_in_place(self):
+        part_file = self.test_downloads_dir.joinpath("part-1.mp3")
+        part_file.write_bytes(b"")
+        book_filename = self.test_downloads_dir.joinpath("book.mp3")
+        audio_payload = b"\xff\xfb\x90\x64" + b"\x00" * 10000
+        cover_bytes = b"\xff\xd8\xff" + b"\x01" * 20000
+        chapter_titles = [f"Chapter {i}" for i in range(1, 51)]
+        id3_padding = shared.estimate_id3_padding(
+            cover_bytes=cover_bytes,
+            texts=["Test Title", "Author A", "A" * 2000, None],
+            chapter_titles=chapter_titles,
+        )
+
+        def mock_ffmpeg(cmd):
+            # emulate the ffmpeg mp3 muxer writing an empty ID3v2.4 tag with padding
+            padding = int(cmd[cmd.index("-metadata_header_padding") + 1])
+            syncsafe_size = bytes(
+                [(padding >> shift) & 0x7F for shift in (21, 14, 7, 0)]
+            )
+            Path(cmd[-1]).write_bytes(
+                b"ID3\x04\x00\x00" + syncsafe_size + b"\x00" * padding + audio_payload
+            )
+            return 0
+
+        with patch("odmpy.processing.shared.subprocess.call", new=mock_ffmpeg):
+            shared.merge_into_mp3(
+                book_filename=book_filename,
+                file_tracks=[{"file": part_file}],
+                audio_bitrate=64,
+                ffmpeg_loglevel="fatal",
+                hide_progress=True,
+                logger=self.logger,
+                id3_padding=id3_padding,
+            )
+        merged_size = book_filename.stat().st_size
+
+        audiofile = shared.TagOnlyFile(book_filename)
+        shared.write_tags(
+            audiofile=audiofile,
+            title="Test Title",
+            sub_title=None,
+            authors=["Author A"],
+            narrators=[],
+            publisher="",
+            description="A" * 2000,
+            cover_bytes=cover_bytes,
+            genres=[],
+            languages=[],
+            published_date=None,
+            series=None,
+            part_number=0,
+            total_parts=0,
+            overdrive_id="",
+        )
+        toc = audiofile.tag.table_of_contents.set(
+            b"toc", toplevel=True, ordered=True, child_ids=[]
+        )
+        for i, chapter_title in enumerate(chapter_titles):
+            chap = audiofile.tag.chapters.set(
+                f"ch{i}".encode("ascii"), times=(i * 1000, (i + 1) * 1000)
+            )
+            chap.title = chapter_title
+            toc.child_ids.append(chap.element_id)
+        audiofile.tag.save()
+
+        # tag fits in the reserved padding, so the file was not rewritten
+        self.assertEqual(book_filename.stat().st_size, merged_size)
+        self.assertTrue(book_filename.read_bytes().endswith(audio_payload))
+        saved = shared.TagOnlyFile(book_filename)
+        self.assertEqual(saved.tag.title, "Test Title")
+        self.assertEqual(len(saved.tag.chapters), len(chapter_titles))
+        self.assertEqual(len(saved.tag.images), 1)
+
+    def test_epub_stream_writer(self):
+        epub_file_path = self.test_downloads_dir.joinpath("book.epub")
+        writer = EpubStreamWriter(epub_file_path, self.logger)
+        writer.write("OEBPS/page.xhtml", "<html></html>")
+        writer.write("OEBPS/image.jpg", b"\xff\xd8\xff")
+        # interrupted
+        writer.close()
+        self.assertFalse(epub_file_path.exists())
+        self.assertTrue(writer.part_file_path.exists())
+
+        # add an entry that was not recorded as completed
+        with zipfile.ZipFile(writer.part_file_path, mode="a") as part_zip:
+            part_zip.writestr("OEBPS/partial.css", "body {")
+
+        writer = EpubStreamWriter(epub_file_path, self.logger)
+        self.assertTrue(writer.exists("OEBPS/page.xhtml"))
+        self.assertTrue(writer.exists("OEBPS/image.jpg"))
+        self.assertFalse(writer.exists("OEBPS/partial.css"))
+        self.assertEqual(writer.read("OEBPS/page.xhtml"), b"<html></html>")
+        writer.write("OEBPS/partial.css", "body {}")
+        writer.finalize()
+
+        self.assertTrue(epub_file_path.exists())
+        self.assertFalse(writer.part_file_path.exists())
+        self.assertFalse(writer.manifest_file_path.exists())
+        with zipfile.ZipFile(epub_file_path) as epub_zip:
+            self.assertEqual(
+                epub_zip.namelist(),
+                [
+                    "mimetype",
+                    "OEBPS/page.xhtml",
+                    "OEBPS/image.jpg",
+                    "OEBPS/partial.css",
+                ],
+            )
+            self.assertEqual(epub_zip.read("OEBPS/partial.css"), b"body {}")
+            for name, compress_type in (
+                ("mimetype", zipfile.ZIP_STORED),
+                ("OEBPS/page.xhtml", zipfile.ZIP_DEFLATED),
+                ("OEBPS/image.jpg", zipfile.ZIP_STORED),
+            ):
+                with self.subTest(name=name):
+                    self.assertEqual(
+                        epub_zip.getinfo(name).compress_type, compress_type
+                    )
@@ -4,12 +4,14 @@
 # https://opensource.org/licenses/MIT
 
 import json
+import time
 from http import HTTPStatus
 
 import responses
 from lxml import etree  # type: ignore[import]
 
 from odmpy.errors import OdmpyRuntimeError
+from odmpy import odm
 from odmpy.odm import run
 from odmpy.overdrive import OverDriveClient
 from .base import BaseTestCase
@@ -376,3 +378,57 @@ class OdmpyTests(BaseTestCase):
                 ],
                 be_quiet=True,
             )
+
+    @responses.activate
+    def test_check_version(self):
+        """
+        Version check is cached
+        """
+        responses.get(odm.TAGS_ENDPOINT, json=[{"name": "99.0.0"}])
+        # a settings folder that no other test uses
+        cache_file = self.test_downloads_dir.joinpath(
+            "version_check_settings", odm.VERSION_CHECK_CACHE_FILENAME
+        )
+        with self.assertLogs(run.__module__, level="WARNING") as context:
+            odm.start_version_check(1, 0, cache_file).join()
+        self.assertIn("99.0.0", context.records[0].msg)
+        self.assertEqual(len(responses.calls), 1)
+        with cache_file.open("r", encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["version"], "99.0.0")
+
+        # cached result is used
+        with self.assertLogs(run.__module__, level="WARNING") as context:
+            odm.check_version(1, 0, cache_file)
+        self.assertIn("99.0.0", context.records[0].msg)
+        self.assertEqual(len(responses.calls), 1)
+
+        # expired
+        with cache_file.open("w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": odm.__version__,
+                    "checked_at": time.time() - odm.VERSION_CHECK_TTL - 1,
+                },
+                f,
+            )
+        with self.assertLogs(run.__module__, level="WARNING"):
+            odm.check_version(1, 0, cache_file)
+        self.assertEqual(len(responses.calls), 2)
+
+        # the attempt is recorded before the request, and failed checks are not retried
+        cache_file.unlink()
+
+        def tags_callback(_):
+            with cache_file.open("r", encoding="utf-8") as f:
+                self.assertLess(time.time() - json.load(f)["checked_at"], 60)
+            return HTTPStatus.FORBIDDEN, {}, ""
+
+        responses.replace(
+            responses.CallbackResponse(
+                responses.GET, odm.TAGS_ENDPOINT, callback=tags_callback
+            )
+        )
+        odm.start_version_check(1, 0, cache_file).join()
+        self.assertEqual(len(responses.calls), 3)
+        odm.start_version_check(1, 0, cache_file).join()
+        self.assertEqual(len(responses.calls), 3)
@@ -1,8 +1,10 @@
 import logging
 
 import requests
+import responses
+from responses import matchers
 
-from odmpy.overdrive import OverDriveClient
+from odmpy.overdrive import OverDriveClient, THUNDER_API_URL
 from tests.base import BaseTestCase
 
 test_logger = logging.getLogger(__name__)
@@ -152,6 +154,34 @@ class OverDriveClientTests(BaseTestCase):
             self.client.library_media_availability("brooklyn", "2006069")
         self.assertEqual(context.exception.response.status_code, 404)
 
+    @responses.activate
+    def test_library_media_bulk(self):
+        responses.get(
+            f"{THUNDER_API_URL}libraries/lapl/media/bulk",
+            match=[
+                matchers.query_param_matcher(
+                    {"x-client-id": "dewey", "titleIds": "7017021,1330527"}
+                )
+            ],
+            json=[
+                {
+                    "id": title_id,
+                    "title": f"Title {title_id}",
+                    "formats": [{"id": "audiobook-mp3"}],
+                    "isOwned": True,
+                    "isAvailable": False,
+                }
+                for title_id in ("7017021", "1330527")
+            ],
+        )
+        items = self.client.library_media_bulk("lapl", ["7017021", "1330527"])
+        self.assertIsInstance(items, list)
+        self.assertEqual(len(items), 2)
+        for item in items:
+            for k in ("id", "title", "formats", "isOwned", "isAvailable"):
+                with self.subTest(key=k):
+                    self.assertIn(k, item, msg=f'"{k}" not found')
+
     def test_library_media(self):
         media = self.client.library_media("lapl", "7017021")
 
@@ -180,3 +210,29 @@ class OverDriveClientTests(BaseTestCase):
         ):
             with self.subTest(key=k):
                 self.assertIn(k, media, msg=f'"{k}" not found')
+
+    @responses.activate
+    def test_prefetch_media(self):
+        client = OverDriveClient()
+        responses.get(
+            f"{THUNDER_API_URL}media/bulk",
+            json=[
+                {"id": "1", "reserveId": "AAAA-1", "title": "One"},
+                {"id": "2", "reserveId": "BBBB-2", "title": "Two"},
+            ],
+        )
+        responses.get(
+            f"{THUNDER_API_URL}libraries/lapl/media/bulk",
+            json=[{"id": "3", "title": "Three"}],
+        )
+        client.prefetch_media(["1", "2", "1"])
+        client.prefetch_library_media("lapl", ["3"])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertIn("titleIds=1%2C2", responses.calls[0].request.url)
+
+        # served from memory
+        self.assertEqual(client.media("1")["title"], "One")
+        self.assertEqual(client.media("bbbb-2")["title"], "Two")
+        self.assertEqual(client.library_media("lapl", "3")["title"], "Three")
+        client.prefetch_media(["2"])
+        self.assertEqual(len(responses.calls), 2)
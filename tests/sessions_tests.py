@@ -0,0 +1,61 @@
+from odmpy.libby import LibbyClient
+from odmpy.overdrive import OverDriveClient
+from odmpy.processing.shared import init_session
+from odmpy.sessions import (
+    get_session,
+    new_session,
+    configure_sessions,
+    close_sessions,
+)
+from tests.base import BaseTestCase
+
+
+class SessionsTests(BaseTestCase):
+    def tearDown(self) -> None:
+        super().tearDown()
+        configure_sessions()
+        close_sessions()
+
+    def test_get_session(self):
+        self.assertIs(get_session(max_retries=1), init_session(1))
+        self.assertIs(
+            OverDriveClient(retry=1).session, OverDriveClient(retry=1).session
+        )
+        self.assertIsNot(get_session(max_retries=1), get_session(max_retries=2))
+        libby_client = LibbyClient(logger=self.logger, identity_token=".")
+        other_libby_client = LibbyClient(logger=self.logger, identity_token=".")
+        # the libby session holds an auth cookie and is not shared with other clients
+        self.assertIsNot(libby_client.libby_session, get_session())
+        self.assertIsNot(libby_client.libby_session, other_libby_client.libby_session)
+        libby_client.libby_session.cookies.set("auth", "1", domain="libbyapp.com")
+        self.assertEqual(len(other_libby_client.libby_session.cookies), 0)
+        # but the connection pools are
+        self.assertIs(
+            libby_client.libby_session.get_adapter("https://example.com"),
+            other_libby_client.libby_session.get_adapter("https://example.com"),
+        )
+        self.assertIs(
+            new_session().get_adapter("https://example.com"),
+            get_session().get_adapter("https://example.com"),
+        )
+
+    def test_pool_size(self):
+        configure_sessions(pool_connections=4, pool_maxsize=6)
+        adapter = get_session().get_adapter("https://example.com")
+        self.assertEqual(len(adapter.poolmanager.pools), 0)
+        for i in range(5):
+            adapter.poolmanager.connection_from_host(f"{i}.example.com", 443, "https")
+        # least recently used pools are discarded
+        self.assertEqual(len(adapter.poolmanager.pools), 4)
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], 6)
+
+        # grows to fit the number of concurrent downloads
+        adapter = init_session(pool_maxsize=20).get_adapter("https://example.com")
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], 20)
+        adapter = init_session(pool_maxsize=2).get_adapter("https://example.com")
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], 20)
+        # sessions created earlier are remounted with the larger pool
+        libby_client = LibbyClient(logger=self.logger, identity_token=".")
+        init_session(pool_maxsize=30)
+        adapter = libby_client.libby_session.get_adapter("https://example.com")
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], 30)
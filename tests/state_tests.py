@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import time
+from unittest.mock import patch
+
+from odmpy.state import DownloadState, get_state, file_sha256
+from tests.base import BaseTestCase
+
+
+class StateTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db_path = self.test_downloads_dir.joinpath("state.sqlite3")
+        self.state = DownloadState(self.db_path)
+
+    def tearDown(self) -> None:
+        self.state.close()
+        super().tearDown()
+
+    def test_output(self):
+        book_file = self.test_downloads_dir.joinpath("book.m4b")
+        self.assertIsNone(self.state.get_output("123", "m4b"))
+        self.state.set_output("123", "m4b", book_file, "Test")
+        self.assertEqual(self.state.get_output("123", "m4b"), book_file.absolute())
+        self.assertIsNone(self.state.get_output("123", "mp3"))
+        self.assertIsNone(self.state.get_output("456", "m4b"))
+
+        # persisted
+        state = DownloadState(self.db_path)
+        self.assertEqual(state.get_output("123", "m4b"), book_file.absolute())
+        state.close()
+
+    def test_parts(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        self.assertEqual(self.state.get_parts("123"), {})
+        saved_part = self.state.set_part("123", 1, mp3_file)
+        self.assertEqual(saved_part.size, mp3_file.stat().st_size)
+        self.assertEqual(saved_part.sha256, file_sha256(mp3_file))
+        self.assertEqual(self.state.get_parts("123"), {1: saved_part})
+        self.assertEqual(self.state.get_parts("456"), {})
+
+        # changed parts are detected
+        self.assertTrue(saved_part.is_intact())
+        part_file = self.test_downloads_dir.joinpath("part.mp3")
+        part_file.write_bytes(mp3_file.read_bytes())
+        saved_part = self.state.set_part("123", 2, part_file)
+        self.assertTrue(saved_part.is_intact())
+        data = bytearray(part_file.read_bytes())
+        data[-1] ^= 0xFF
+        part_file.write_bytes(data)
+        self.assertFalse(saved_part.is_intact())
+        part_file.write_bytes(data[:-1])
+        self.assertFalse(saved_part.is_intact())
+        part_file.unlink()
+        self.assertFalse(saved_part.is_intact())
+
+        self.state.clear_parts("123")
+        self.assertEqual(self.state.get_parts("123"), {})
+
+    def test_verify_part(self):
+        part_file = self.test_downloads_dir.joinpath("part.mp3")
+        part_file.write_bytes(
+            self.test_data_dir.joinpath("audiobook", "book.mp3").read_bytes()
+        )
+        saved_part = self.state.set_part("123", 1, part_file)
+        # modified right before it was saved, so the checksum is always verified
+        with patch("odmpy.state.file_sha256", wraps=file_sha256) as mock_sha256:
+            self.assertTrue(saved_part.is_intact())
+            self.assertTrue(self.state.verify_part("123", 1, saved_part))
+            self.assertEqual(mock_sha256.call_count, 2)
+
+        # a part that is touched is verified again and its modification time recorded
+        mtime = time.time() - 60
+        os.utime(part_file, (mtime, mtime))
+        saved_part = self.state.get_parts("123")[1]
+        self.assertFalse(saved_part.is_unmodified(part_file.stat()))
+        with patch("odmpy.state.file_sha256", wraps=file_sha256) as mock_sha256:
+            self.assertTrue(self.state.verify_part("123", 1, saved_part))
+            mock_sha256.assert_called_once()
+
+        # so only the size and modification time are checked after that
+        saved_part = self.state.get_parts("123")[1]
+        self.assertEqual(saved_part.mtime_ns, part_file.stat().st_mtime_ns)
+        self.assertTrue(saved_part.is_unmodified(part_file.stat()))
+        with patch("odmpy.state.file_sha256", wraps=file_sha256) as mock_sha256:
+            self.assertTrue(self.state.verify_part("123", 1, saved_part))
+            self.assertTrue(saved_part.is_intact())
+            mock_sha256.assert_not_called()
+
+        # changed parts are detected
+        with part_file.open("r+b") as f:
+            f.truncate(saved_part.size - 1)
+        self.assertFalse(self.state.verify_part("123", 1, saved_part))
+        part_file.unlink()
+        self.assertFalse(self.state.verify_part("123", 1, saved_part))
+
+    def test_schema_upgrade(self):
+        self.state.close()
+        self.db_path.unlink()
+        conn = sqlite3.connect(str(self.db_path))
+        with conn:
+            conn.execute(
+                "CREATE TABLE parts (loan_id TEXT NOT NULL, part_number INTEGER NOT NULL, "
+                "path TEXT NOT NULL, size INTEGER NOT NULL, sha256 TEXT NOT NULL, "
+                "saved_at REAL NOT NULL, PRIMARY KEY (loan_id, part_number))"
+            )
+            conn.execute(
+                "INSERT INTO parts VALUES ('123', 1, '/tmp/part.mp3', 1, 'abc', 1.0)"
+            )
+            conn.execute("PRAGMA user_version=1")
+        conn.close()
+
+        self.state = DownloadState(self.db_path)
+        saved_part = self.state.get_parts("123")[1]
+        self.assertEqual(saved_part.sha256, "abc")
+        self.assertEqual(saved_part.mtime_ns, 0)
+
+    def test_get_state(self):
+        self.assertIsNone(get_state(""))
+        state = get_state(str(self.db_path))
+        self.assertIs(get_state(str(self.db_path)), state)
+
+        # the connection to a removed database is closed and replaced
+        self.state.close()
+        self.db_path.unlink()
+        new_state = get_state(str(self.db_path))
+        self.assertIsNot(new_state, state)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            state.get_parts("123")
+        self.assertEqual(new_state.get_parts("123"), {})
+        self.state = new_state